@@ -5,7 +5,18 @@
 #include "astar.h"
 
 #include <array>
+#include <cmath>
+#include <limits>
+#include <string>
 #include <fstream>
+#include <cstdint>
+#include <cstdio>
+#include <stdexcept>
+
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 
 const float PI = 3.141592; // Pi
 
@@ -13,52 +24,6 @@ double degree_to_radian(double degree) {
     return degree * PI / 180;
 }
 
-// Class: Vertex
-Vertex::Vertex(int id, std::pair<double, double> coord) : id(id), coord(coord) {
-    this->visited = 0;
-    this->distance = std::numeric_limits<double>::infinity();
-    this->heuristic = std::numeric_limits<double>::infinity();
-    this->cost = std::numeric_limits<double>::infinity();
-}
-
-// Initialize
-void Vertex::initialize() {
-    this->visited = 0;
-    this->distance = std::numeric_limits<double>::infinity();
-    this->heuristic = std::numeric_limits<double>::infinity();
-    this->cost = std::numeric_limits<double>::infinity();
-}
-
-// GET
-int Vertex::get_id() {return this->id;}
-
-std::set<Vertex*> Vertex::get_connection() {
-    std::set<Vertex*> neighbor;
-    for (auto adj: this->adjacent) {
-        neighbor.insert(adj.first);
-    }
-    return neighbor;
-}
-
-double Vertex::get_weight(Vertex* neighbor) {return this->adjacent[neighbor];}
-
-// ADD
-void Vertex::add_neighbor(Vertex *neighbor, double weight) {
-    (this->adjacent).insert(std::make_pair(neighbor, weight));
-}
-
-// SET
-void Vertex::set_distance(double dist) {
-    this->distance = dist;
-    this->set_cost();
-}
-
-void Vertex::set_cost() {this->cost = this->distance + this->heuristic;}
-
-void Vertex::set_visited() {this->visited = 1;}
-
-void Vertex::set_previous(Vertex* prev) {this->prev = prev;}
-
 // Class: Graph
 // heuristic function
 double Graph::haversine(std::pair<double, double> frm_coord, std::pair<double, double> to_coord) {
@@ -85,158 +50,438 @@ double Graph::heu_carbon_emission(std::pair<double, double> frm_coord, std::pair
 }
 
 double Graph::heuristic(std::pair<double, double> frm_coord, std::pair<double, double> to_coord) {
-    return this->alpha * this->haversine(frm_coord, to_coord)
-    + this->beta * this->heu_travel_time(frm_coord, to_coord)
-    + this->gamma * this->heu_carbon_emission(frm_coord, to_coord);
+    return this->heuristic(frm_coord, to_coord, this->weights);
+}
+
+double Graph::heuristic(std::pair<double, double> frm_coord, std::pair<double, double> to_coord, const Weights& w) {
+    return w.alpha * this->haversine(frm_coord, to_coord)
+    + w.beta * this->heu_travel_time(frm_coord, to_coord)
+    + w.gamma * this->heu_carbon_emission(frm_coord, to_coord);
+}
+
+double Graph::heuristic(int u, int end, const Weights& w) {
+    return this->heuristic(std::make_pair(longitude[u], latitude[u]), std::make_pair(longitude[end], latitude[end]), w);
+}
+
+// Class: SearchState
+void SearchState::resize(int n) {
+    stamp.assign(n, 0);
+    visited.assign(n, 0);
+    distance.assign(n, std::numeric_limits<double>::infinity());
+    h.assign(n, 0.0);
+    prev.assign(n, -1);
+    prev_edge.assign(n, -1);
+    generation = 0;
+}
+
+// Initialize: a new generation invalidates the search state of every node at once
+void SearchState::initialize() {
+    this->generation++;
+    if (this->generation == 0) {
+        std::fill(stamp.begin(), stamp.end(), 0);
+        this->generation = 1;
+    }
+    this->stats = SearchStats();
+}
+
+bool SearchState::touch(int u) {
+    if (stamp[u] == generation) {
+        return false;
+    }
+    stamp[u] = generation;
+    visited[u] = 0;
+    distance[u] = std::numeric_limits<double>::infinity();
+    h[u] = 0.0;
+    prev[u] = -1;
+    prev_edge[u] = -1;
+    return true;
+}
+
+size_t SearchState::bytes() {
+    return stamp.capacity() * sizeof(unsigned int) + visited.capacity() * sizeof(char)
+           + (distance.capacity() + h.capacity()) * sizeof(double) + (prev.capacity() + prev_edge.capacity()) * sizeof(int);
 }
 
-// Initialize
+// Class: Graph
 void Graph::initialize() {
-    for (auto elem: this->graph) {
-        elem.second->initialize();
+    this->state.initialize();
+}
+
+void Graph::finalize() {
+    int n = this->num_nodes();
+    typedef std::tuple<int, int, double, double, double> Edge;
+
+    // keep the first metrics of duplicated links, as the former adjacency map did
+    std::stable_sort(pending.begin(), pending.end(), [](const Edge& a, const Edge& b) {
+        return std::make_pair(std::get<0>(a), std::get<1>(a)) < std::make_pair(std::get<0>(b), std::get<1>(b));
+    });
+    pending.erase(std::unique(pending.begin(), pending.end(), [](const Edge& a, const Edge& b) {
+        return std::get<0>(a) == std::get<0>(b) && std::get<1>(a) == std::get<1>(b);
+    }), pending.end());
+
+    std::vector<int> offset(n + 1, 0), target(pending.size());
+    std::vector<double> street_length(pending.size()), time(pending.size()), carbon_emission(pending.size());
+    for (auto &edge: pending) {
+        offset[std::get<0>(edge) + 1]++;
+    }
+    for (int u = 0; u < n; u++) {
+        offset[u + 1] += offset[u];
+    }
+    for (size_t e = 0; e < pending.size(); e++) {
+        target[e] = std::get<1>(pending[e]);
+        street_length[e] = std::get<2>(pending[e]);
+        time[e] = std::get<3>(pending[e]);
+        carbon_emission[e] = std::get<4>(pending[e]);
+    }
+    std::vector<Edge>().swap(pending);
+
+    offsets.assign(std::move(offset));
+    targets.assign(std::move(target));
+    length.assign(std::move(street_length));
+    travel_time.assign(std::move(time));
+    emission.assign(std::move(carbon_emission));
+
+    this->prepare();
+}
+
+void Graph::prepare() {
+    int n = this->num_nodes();
+
+    if ((int) index.size() != n) {
+        index.clear();
+        index.reserve(n);
+        for (int u = 0; u < n; u++) {
+            index[node_ids[u]] = u;
+        }
+    }
+    this->state.resize(n);
+}
+
+// Binary cache
+// layout: header, then the double arrays (longitude, latitude, length, travel_time, emission)
+// and the int arrays (node_ids, offsets, targets), each section padded to 8 bytes
+struct CacheHeader {
+    char magic[8];
+    uint32_t version;
+    uint32_t reserved;
+    uint64_t nodes;
+    uint64_t edges;
+};
+
+const char CACHE_MAGIC[8] = {'M', 'O', 'D', 'G', 'R', 'A', 'P', 'H'};
+const uint32_t CACHE_VERSION = 1;
+
+size_t padded(size_t bytes) {
+    return (bytes + 7) / 8 * 8;
+}
+
+template <typename T>
+const char* take(Buffer<T>& buffer, const char* cursor, size_t count) {
+    buffer.map((const T*) cursor, count);
+    return cursor + padded(count * sizeof(T));
+}
+
+void Graph::save(const std::string& path) {
+    CacheHeader header = {};
+    std::copy(CACHE_MAGIC, CACHE_MAGIC + 8, header.magic);
+    header.version = CACHE_VERSION;
+    header.nodes = this->num_nodes();
+    header.edges = this->num_edges();
+
+    std::string tmp = path + ".tmp";
+    std::ofstream out(tmp, std::ios::binary | std::ios::trunc);
+    if (!out.is_open()) {
+        throw std::runtime_error("cannot write the graph cache " + path);
+    }
+    const char zeros[8] = {};
+    auto write = [&](const void* data, size_t bytes) {
+        out.write((const char*) data, bytes);
+        out.write(zeros, padded(bytes) - bytes);
+    };
+    write(&header, sizeof(header));
+    for (auto buffer: {&longitude, &latitude, &length, &travel_time, &emission}) {
+        write(buffer->data, buffer->size * sizeof(double));
+    }
+    for (auto buffer: {&node_ids, &offsets, &targets}) {
+        write(buffer->data, buffer->size * sizeof(int));
+    }
+    out.close();
+
+    // replace atomically so that running processes keep their mapping of the old file
+    if (std::rename(tmp.c_str(), path.c_str()) != 0) {
+        throw std::runtime_error("cannot write the graph cache " + path);
+    }
+}
+
+bool Graph::load(const std::string& path) {
+    int fd = open(path.c_str(), O_RDONLY);
+    if (fd < 0) {
+        return false;
+    }
+    struct stat st;
+    if (fstat(fd, &st) != 0 || (size_t) st.st_size < sizeof(CacheHeader)) {
+        close(fd);
+        return false;
+    }
+    void* addr = mmap(nullptr, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (addr == MAP_FAILED) {
+        return false;
+    }
+
+    const CacheHeader* header = (const CacheHeader*) addr;
+    size_t n = header->nodes, m = header->edges;
+    size_t expected = padded(sizeof(CacheHeader)) + 2 * padded(n * sizeof(double)) + 3 * padded(m * sizeof(double))
+            + padded(n * sizeof(int)) + padded((n + 1) * sizeof(int)) + padded(m * sizeof(int));
+    if (!std::equal(CACHE_MAGIC, CACHE_MAGIC + 8, header->magic) || header->version != CACHE_VERSION
+        || (size_t) st.st_size != expected) {
+        munmap(addr, st.st_size);
+        return false;
+    }
+
+    const char* cursor = (const char*) addr + padded(sizeof(CacheHeader));
+    cursor = take(longitude, cursor, n);
+    cursor = take(latitude, cursor, n);
+    cursor = take(length, cursor, m);
+    cursor = take(travel_time, cursor, m);
+    cursor = take(emission, cursor, m);
+    cursor = take(node_ids, cursor, n);
+    cursor = take(offsets, cursor, n + 1);
+    take(targets, cursor, m);
+
+    mapped = addr;
+    mapped_size = st.st_size;
+    index.clear();
+    this->prepare();
+    return true;
+}
+
+Graph::~Graph() {
+    if (mapped != nullptr) {
+        munmap(mapped, mapped_size);
     }
 }
 
 // GET
+int Graph::get_index(int node_id) {
+    auto found = index.find(node_id);
+    if (found == index.end()) {
+        throw std::invalid_argument("unknown node ID " + std::to_string(node_id));
+    }
+    return found->second;
+}
+
 std::pair<double, double> Graph::get_coordinate(int node_id) {
-    return (*graph[node_id]).coord;
+    int u = this->get_index(node_id);
+    return std::make_pair(longitude[u], latitude[u]);
 }
 
-Vertex* Graph::get_vertex(int id) {return graph[id];}
+size_t Graph::memory_usage() {
+    size_t nodes = node_ids.bytes() + longitude.bytes() + latitude.bytes()
+            + index.size() * (sizeof(std::pair<const int, int>) + sizeof(void*)) + index.bucket_count() * sizeof(void*);
+    size_t edges = offsets.bytes() + targets.bytes() + length.bytes() + travel_time.bytes() + emission.bytes();
+    return nodes + edges + this->state.bytes();
+}
 
 // ADD
-void Graph::add_vertex(int node_id, double longitude, double latitude) {
-    Vertex* pVertex = new Vertex(node_id, std::make_pair(longitude, latitude));
-    this->graph.insert(std::make_pair(node_id, pVertex));
+void Graph::add_vertex(int node_id, double lon, double lat) {
+    if (this->has_node(node_id)) {
+        return;
+    }
+    index[node_id] = node_ids.size;
+    node_ids.push_back(node_id);
+    longitude.push_back(lon);
+    latitude.push_back(lat);
 }
 
-void Graph::add_edge(int frm, int to, double weight) {
-    std::pair<double, double> frm_coord = get_coordinate(frm);
-    std::pair<double, double> to_coord = get_coordinate(to);
-    graph[frm]->add_neighbor(graph[to], weight);
+void Graph::add_edge(int frm, int to, double street_length, double time, double carbon_emission) {
+    pending.push_back(std::make_tuple(this->get_index(frm), this->get_index(to), street_length, time, carbon_emission));
 }
 
-void Graph::add_heuristic(int node, int end_node) {
-    std::pair<double, double> node_coord = get_coordinate(node);
-    std::pair<double, double> end_coord = get_coordinate(end_node);
-    graph[node]->heuristic = this->heuristic(node_coord, end_coord);
-    graph[node]->set_cost();
+double Graph::route_planning(int start_node, int end_node) {
+    return this->route_planning(start_node, end_node, this->weights, this->state);
 }
 
-double Graph::route_planning(int start_node, int end_node) {
-    Vertex* current;
-    std::set<Vertex*> current_adjacent;
-    std::set<Vertex> heap;
-    double new_cost;
+double Graph::route_planning(int start_node, int end_node, const Weights& w, SearchState& s) {
+    // A* on a binary heap with lazy deletion: outdated entries stay in the heap and are skipped when popped
+    typedef std::pair<double, int> Entry;
+    std::priority_queue<Entry, std::vector<Entry>, std::greater<Entry>> heap;
 
-    Vertex* start = this->get_vertex(start_node);
-    Vertex* end = this->get_vertex(end_node);
+    int start = this->get_index(start_node);
+    int end = this->get_index(end_node);
 
-    start->set_distance(0.0);
-    this->add_heuristic(start_node, end_node);
+    s.initialize();
 
+    s.touch(start);
+    s.h[start] = this->heuristic(start, end, w);
+    s.distance[start] = 0.0;
+    heap.push(std::make_pair(s.h[start], start));
+    s.stats.pushes++;
 
-    for (auto itr=this->graph.begin(); itr!=this->graph.end(); itr++) {
-        heap.insert(*itr->second);
-    }
+    while (!heap.empty()) {
+        Entry pop = heap.top();
+        heap.pop();
 
-    while (current != end) {
-        auto pop = heap.begin();
-        heap.erase(pop);
+        int current = pop.second;
+        if (s.visited[current] || pop.first > s.distance[current] + s.h[current]) {
+            continue;
+        }
+        s.visited[current] = 1;
+        s.stats.settled++;
 
-        current = this->get_vertex(pop->id);
-        current->set_visited();
+        if (current == end) {
+            break;
+        }
 
-        current_adjacent = current->get_connection();
-        for (auto &adj: current_adjacent) {
-            //std::cout << *adj << std::endl;
-            if (adj->visited == 0) {
-                this->add_heuristic(adj->get_id(), end_node);
-                new_cost = current->distance + current->get_weight(adj) + adj->heuristic; // new cost
-                if (new_cost < adj->cost) {
-                    adj->set_distance(current->distance + current->get_weight(adj));
-                    adj->set_previous(current);
-                }
-                heap.insert(*adj);
-            } else {
+        for (int e = offsets[current]; e < offsets[current + 1]; e++) {
+            int next = targets[e];
+            if (s.touch(next)) {
+                s.h[next] = this->heuristic(next, end, w);
+            } else if (s.visited[next]) {
                 continue;
             }
+            double new_distance = s.distance[current] + this->weight(e, w);
+            if (new_distance < s.distance[next]) {
+                s.distance[next] = new_distance;
+                s.prev[next] = current;
+                s.prev_edge[next] = e;
+                heap.push(std::make_pair(new_distance + s.h[next], next));
+                s.stats.pushes++;
+            }
         }
     }
 
-    return end->cost;
+    // the slot of an unreached target still holds the distance of an earlier query
+    if (s.stamp[end] != s.generation) {
+        return std::numeric_limits<double>::infinity();
+    }
+    return s.distance[end];
 }
 
 void Graph::route_planning_details(int start_node, int end_node) {
-    Vertex* current;
-    std::set<Vertex*> current_adjacent;
-    std::set<double> heap;
-    std::set<Vertex*> unvisited_queue;
-    double pop;
-    double new_cost;
-
-    std::vector<double> longitude;
-    std::vector<double> latitude;
-
-    Vertex* start = this->get_vertex(start_node);
-    Vertex* end = this->get_vertex(end_node);
-
-    std::pair<int*, double*> res;
-
-    start->set_distance(0.0);
-    this->add_heuristic(start->get_id(), end_node);
-    heap.insert(start->cost);
-    unvisited_queue.insert(start);
-
-    while (current != end) {
-        pop = *(heap.begin());
-        heap.erase(heap.begin());
-
-        for (auto &element: unvisited_queue) {
-            if ((*element).cost == pop) {
-                current = element;
-                current->set_visited();
-                break;
-            }
-        }
+    std::vector<double> path_longitude;
+    std::vector<double> path_latitude;
 
-        current_adjacent = current->get_connection();
-        for (auto &adj: current_adjacent) {
-            if (adj->visited == 0) {
-                this->add_heuristic(adj->get_id(), end_node);
-                unvisited_queue.insert(adj);
-
-                new_cost = current->distance + current->get_weight(adj) + adj->heuristic;
-                if (new_cost < adj->cost) {
-                    adj->set_distance(current->distance + current->get_weight(adj));
-                    adj->set_previous(current);
-                }
-                heap.insert(adj->cost);
-            }
-        }
-        unvisited_queue.erase(current);
-    }
+    this->route_planning(start_node, end_node);
 
     // Find the optimal path ...
-    Vertex* cause = end;
-    while (cause != start) {
-        (longitude).push_back(cause->coord.first);
-        (latitude).push_back(cause->coord.second);
-        cause = cause->prev;
+    for (int u: this->path_nodes(end_node, this->state)) {
+        path_longitude.push_back(this->longitude[u]);
+        path_latitude.push_back(this->latitude[u]);
     }
-    (longitude).push_back(start->coord.first);
-    (latitude).push_back(start->coord.second);
-
-    std::reverse((longitude).begin(), (longitude).end());
-    std::reverse((latitude).begin(), (latitude).end());
 
     std::ofstream result;
     result.open("./result/optimal_path.csv");
 
     result << "longitude" << "," << "latitude" << "\n";
-    for (int i = 0; i < longitude.size(); i++) {
-        result << longitude[i] << "," << latitude[i] << "\n";
+    for (size_t i = 0; i < path_longitude.size(); i++) {
+        result << path_longitude[i] << "," << path_latitude[i] << "\n";
     }
 
     result.close();
 }
+
+std::vector<double> Graph::one_to_many(int start_node, const std::vector<int>& end_nodes) {
+    return this->one_to_many(start_node, end_nodes, this->weights, this->state);
+}
+
+std::vector<double> Graph::one_to_many(int start_node, const std::vector<int>& end_nodes, const Weights& w,
+                                       SearchState& s, std::vector<PathMetrics>* metrics) {
+    // Dijkstra tree from start_node, stopped as soon as every target is settled.
+    typedef std::pair<double, int> Entry;
+    std::priority_queue<Entry, std::vector<Entry>, std::greater<Entry>> heap;
+    std::vector<double> res(end_nodes.size(), std::numeric_limits<double>::infinity());
+    std::unordered_map<int, std::vector<size_t>> goals;    // target index -> positions in end_nodes
+
+    int start = this->get_index(start_node);
+    for (size_t i = 0; i < end_nodes.size(); i++) {
+        goals[this->get_index(end_nodes[i])].push_back(i);
+    }
+    int remaining = goals.size();
+    if (metrics != nullptr) {
+        metrics->assign(end_nodes.size(), PathMetrics());
+    }
+
+    s.initialize();
+
+    s.touch(start);
+    s.distance[start] = 0.0;
+    heap.push(std::make_pair(0.0, start));
+    s.stats.pushes++;
+
+    while (!heap.empty() && remaining > 0) {
+        Entry pop = heap.top();
+        heap.pop();
+
+        int current = pop.second;
+        if (s.visited[current] || pop.first > s.distance[current]) {
+            continue;
+        }
+        s.visited[current] = 1;
+        s.stats.settled++;
+
+        auto found = goals.find(current);
+        if (found != goals.end()) {
+            for (size_t i: found->second) {
+                res[i] = s.distance[current];
+            }
+            if (metrics != nullptr) {
+                PathMetrics path = this->trace(current, s);
+                for (size_t i: found->second) {
+                    (*metrics)[i] = path;
+                }
+            }
+            remaining--;
+        }
+
+        for (int e = offsets[current]; e < offsets[current + 1]; e++) {
+            int next = targets[e];
+            double new_distance = s.distance[current] + this->weight(e, w);
+            s.touch(next);
+            if (s.visited[next] == 0 && new_distance < s.distance[next]) {
+                s.distance[next] = new_distance;
+                s.prev[next] = current;
+                s.prev_edge[next] = e;
+                heap.push(std::make_pair(new_distance, next));
+                s.stats.pushes++;
+            }
+        }
+    }
+
+    return res;
+}
+
+PathMetrics Graph::trace(int end, SearchState& s) {
+    PathMetrics res;
+    if (s.stamp[end] != s.generation || s.distance[end] == std::numeric_limits<double>::infinity()) {
+        return res;
+    }
+    res.cost = s.distance[end];
+    for (int u = end; s.prev_edge[u] != -1; u = s.prev[u]) {
+        int e = s.prev_edge[u];
+        res.length += length[e];
+        res.travel_time += travel_time[e];
+        res.emission += emission[e];
+    }
+    return res;
+}
+
+PathMetrics Graph::path_metrics(int end_node, SearchState& s) {
+    return this->trace(this->get_index(end_node), s);
+}
+
+std::vector<int> Graph::path_nodes(int end_node, SearchState& s) {
+    // empty if the last search did not reach end_node
+    std::vector<int> res;
+    int u = this->get_index(end_node);
+    if (s.stamp[u] != s.generation || s.distance[u] == std::numeric_limits<double>::infinity()) {
+        return res;
+    }
+    res.push_back(u);
+    while (s.prev_edge[u] != -1) {
+        u = s.prev[u];
+        res.push_back(u);
+    }
+    std::reverse(res.begin(), res.end());
+    return res;
+}
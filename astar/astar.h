@@ -7,94 +7,175 @@
 
 #include <set>
 #include <map>
+#include <queue>
+#include <tuple>
+#include <string>
+#include <vector>
 #include <random>
+#include <limits>
 #include <iostream>
 #include <algorithm>
+#include <unordered_map>
 
-// information of nodes
-class Vertex {
-public:
-    bool visited;
-    int id;
-    std::pair<double, double> coord;
-    std::map<Vertex*, double> adjacent; // neighbors
-    double distance;                    // g_hat(n)
-    double heuristic;                   // f_hat(n)
-    double cost;                        // g_hat(n) + f_hat(n)
-    Vertex* prev;
+// per-query search statistics
+struct SearchStats {
+    long settled = 0;                   // nodes popped from the heap and finalized
+    long pushes = 0;                    // heap insertions, stale entries included
 
-    // constructor
-    Vertex(int id, std::pair<double, double> coord);
+    SearchStats& operator+=(const SearchStats& other) {
+        settled += other.settled;
+        pushes += other.pushes;
+        return *this;
+    };
+};
 
-    // initialize
+// weights of the link metrics in the blended cost
+struct Weights {
+    double alpha = 0.0;                 // street length
+    double beta = 0.0;                  // travel time
+    double gamma = 0.0;                 // carbon emission
+
+    Weights() {};
+    Weights(double alpha, double beta, double gamma) : alpha(alpha), beta(beta), gamma(gamma) {};
+};
+
+// component breakdown of a path
+struct PathMetrics {
+    double cost = std::numeric_limits<double>::infinity();
+    double length = 0.0;
+    double travel_time = 0.0;
+    double emission = 0.0;
+};
+
+// search state of one query, each thread searching the graph owns its own
+// the entries of a node are valid only if its stamp equals the current generation
+struct SearchState {
+    unsigned int generation = 0;
+    std::vector<unsigned int> stamp;
+    std::vector<char> visited;
+    std::vector<double> distance;       // g_hat(n)
+    std::vector<double> h;              // f_hat(n)
+    std::vector<int> prev;
+    std::vector<int> prev_edge;
+    SearchStats stats;                  // statistics of the last query
+
+    void resize(int n);
     void initialize();
+    bool touch(int u);
+    size_t bytes();
+};
 
-    // GET
-    int get_id();
-    std::set<Vertex*> get_connection();
-    double get_weight(Vertex* neighbor);
+// contiguous array, either owned by the graph or mapped read-only from the binary cache file
+template <typename T>
+class Buffer {
+public:
+    const T* data = nullptr;
+    size_t size = 0;
+    std::vector<T> owned;
+
+    void assign(std::vector<T>&& values) {
+        owned = std::move(values);
+        data = owned.data();
+        size = owned.size();
+    };
 
-    // ADD
-    void add_neighbor(Vertex* neighbor, double weight=0);   // add a neighbor
-
-    // SET
-    void set_distance(double dist);
-    void set_cost();
-    void set_previous(Vertex* prev);
-    void set_visited();
-
-    // <
-    bool operator<(const Vertex& v) const {
-        if (cost == v.cost) {
-            return id < v.id;
-        }
-        return cost < v.cost;
+    void push_back(T value) {
+        owned.push_back(value);
+        data = owned.data();
+        size = owned.size();
     };
 
-    // <<
-    friend std::ostream& operator<<(std::ostream& o, Vertex& v){
-        o << "Node ID: " << v.id << " / (x,y): " << "(" << v.coord.first << "," << v.coord.second << ")" << " / Cost: " << v.cost;
-        return o;
+    void map(const T* values, size_t n) {
+        std::vector<T>().swap(owned);
+        data = values;
+        size = n;
     };
+
+    size_t bytes() const {return owned.capacity() * sizeof(T);};
+
+    const T& operator[](size_t i) const {return data[i];};
 };
 
-// road network
+// road network in compressed sparse row (CSR) layout
+// nodes are remapped to dense indices 0..n-1, the outgoing edges of node u are
+// targets[offsets[u]] ... targets[offsets[u+1]-1] with the matching weights
 class Graph {
 public:
-    std::map<int, Vertex*> graph;
+    // nodes
+    Buffer<int> node_ids;               // dense index -> node ID
+    Buffer<double> longitude;
+    Buffer<double> latitude;
+    std::unordered_map<int, int> index; // node ID -> dense index
+
+    // edges
+    Buffer<int> offsets;
+    Buffer<int> targets;
+    Buffer<double> length;              // street length (m)
+    Buffer<double> travel_time;         // travel time (s)
+    Buffer<double> emission;            // carbon emission factor * street length
+
+    Weights weights;                    // default weights of the queries
+
     double max_speed_limit = 22.352;
     double min_carbon_emission = -3.609;
 
+    SearchState state;                  // state of the single-threaded queries
+
     // constructor
-    Graph(double alpha, double beta, double gamma) : alpha(alpha), beta(beta), gamma(gamma) {};
+    Graph(double alpha, double beta, double gamma) : weights(alpha, beta, gamma) {};
 
     // initialize
     void initialize();
+    SearchState new_state() {SearchState s; s.resize(this->num_nodes()); return s;};
+    void finalize();                    // build the CSR arrays from the added edges
+
+    // binary cache
+    bool load(const std::string& path);
+    void save(const std::string& path);
 
     // GET
+    int num_nodes() {return node_ids.size;};
+    int num_edges() {return targets.size;};
+    bool has_node(int node_id) {return index.count(node_id) > 0;};
+    int get_index(int node_id);
     std::pair<double, double> get_coordinate(int node_id);
-    Vertex* get_vertex(int id);
+    size_t memory_usage();
+    size_t mapped_bytes() {return mapped_size;};
+    double weight(int e, const Weights& w) const {
+        return w.alpha * length[e] + w.beta * travel_time[e] + w.gamma * emission[e];
+    };
 
     // ADD
     void add_vertex(int node_id, double longitude, double latitude);
-    void add_edge(int frm, int to, double weight);
-    void add_heuristic(int node, int end_node);
+    void add_edge(int frm, int to, double street_length, double time, double carbon_emission);
 
     // Heuristic functions
     double haversine(std::pair<double, double> frm_coord, std::pair<double, double> to_coord);
     double heu_travel_time(std::pair<double, double> frm_coord, std::pair<double, double> to_coord);
     double heu_carbon_emission(std::pair<double, double> frm_coord, std::pair<double, double> to_coord);
     double heuristic(std::pair<double, double> frm_coord, std::pair<double, double> to_coord);
+    double heuristic(std::pair<double, double> frm_coord, std::pair<double, double> to_coord, const Weights& w);
 
     double route_planning(int start_node, int end_node);
+    double route_planning(int start_node, int end_node, const Weights& w, SearchState& s);
     void route_planning_details(int start_node, int end_node);
+    std::vector<double> one_to_many(int start_node, const std::vector<int>& end_nodes);
+    std::vector<double> one_to_many(int start_node, const std::vector<int>& end_nodes, const Weights& w,
+                                    SearchState& s, std::vector<PathMetrics>* metrics = nullptr);
+    PathMetrics path_metrics(int end_node, SearchState& s);     // breakdown of the path found by the last search
+    std::vector<int> path_nodes(int end_node, SearchState& s);  // node indices of the path found by the last search
 
-    ~Graph() {};
+    ~Graph();
 
 private:
-    double alpha = 0.0;
-    double beta = 0.0;
-    double gamma = 0.0;
+    std::vector<std::tuple<int, int, double, double, double>> pending;     // edges added before finalize()
+
+    void* mapped = nullptr;             // binary cache mapping backing the node and edge arrays
+    size_t mapped_size = 0;
+    void prepare();                     // index and search state of the loaded arrays
+
+    double heuristic(int u, int end, const Weights& w);
+    PathMetrics trace(int end, SearchState& s);
 };
 
 #endif //ROUTING_ASTAR_H
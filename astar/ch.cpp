@@ -0,0 +1,358 @@
+//
+// Contraction hierarchies on top of the CSR road network
+//
+
+#include "ch.h"
+
+#include <limits>
+#include <stdexcept>
+
+typedef std::pair<double, int> Entry;
+typedef std::priority_queue<Entry, std::vector<Entry>, std::greater<Entry>> Heap;
+
+const double INF = std::numeric_limits<double>::infinity();
+const int WITNESS_SETTLE_LIMIT = 500;   // witness searches give up (and keep the shortcut) after this many nodes
+
+// dynamic graph of the nodes that are not contracted yet
+class Contraction {
+public:
+    typedef ContractionHierarchy::Arc Arc;
+
+    std::vector<std::vector<Arc>> out;
+    std::vector<std::vector<Arc>> in;
+    std::vector<char> contracted;
+    std::vector<int> deleted_neighbors;
+
+    Contraction(Graph& graph) {
+        int n = graph.num_nodes();
+        out.resize(n);
+        in.resize(n);
+        contracted.assign(n, 0);
+        deleted_neighbors.assign(n, 0);
+        stamp.assign(n, 0);
+        dist.assign(n, INF);
+
+        for (int u = 0; u < n; u++) {
+            for (int e = graph.offsets[u]; e < graph.offsets[u + 1]; e++) {
+                double weight = graph.weight(e, graph.weights);
+                if (weight < 0) {
+                    throw std::domain_error("contraction hierarchies need non-negative link weights");
+                }
+                if (graph.targets[e] != u) {
+                    add_arc(u, graph.targets[e], weight);
+                }
+            }
+        }
+    }
+
+    void add_arc(int frm, int to, double weight) {
+        for (auto &arc: out[frm]) {
+            if (arc.to == to) {
+                if (weight < arc.weight) {
+                    arc.weight = weight;
+                    for (auto &back: in[to]) {
+                        if (back.to == frm) {
+                            back.weight = weight;
+                        }
+                    }
+                }
+                return;
+            }
+        }
+        out[frm].push_back(Arc{to, weight});
+        in[to].push_back(Arc{frm, weight});
+    }
+
+    // contract v, or only count the shortcuts it would need if simulate is set
+    int contract(int v, bool simulate) {
+        std::vector<std::pair<int, Arc>> shortcuts;
+
+        double max_out = 0.0;
+        for (auto &arc: out[v]) {
+            max_out = std::max(max_out, arc.weight);
+        }
+        for (auto &arc_in: in[v]) {
+            int u = arc_in.to;
+            witness_search(u, v, arc_in.weight + max_out);
+            for (auto &arc_out: out[v]) {
+                int x = arc_out.to;
+                if (x == u) {
+                    continue;
+                }
+                double via = arc_in.weight + arc_out.weight;
+                if (distance(x) > via) {
+                    shortcuts.push_back(std::make_pair(u, Arc{x, via}));
+                }
+            }
+        }
+
+        if (!simulate) {
+            for (auto &shortcut: shortcuts) {
+                add_arc(shortcut.first, shortcut.second.to, shortcut.second.weight);
+            }
+        }
+        return shortcuts.size();
+    }
+
+    int importance(int v) {
+        return this->contract(v, true) - (int) (in[v].size() + out[v].size()) + deleted_neighbors[v];
+    }
+
+    // detach a contracted node from the remaining graph
+    void remove(int v) {
+        contracted[v] = 1;
+        for (auto &arc: in[v]) {
+            erase(out[arc.to], v);
+            deleted_neighbors[arc.to]++;
+        }
+        for (auto &arc: out[v]) {
+            erase(in[arc.to], v);
+            deleted_neighbors[arc.to]++;
+        }
+    }
+
+private:
+    unsigned int generation = 0;
+    std::vector<unsigned int> stamp;
+    std::vector<double> dist;
+
+    double distance(int u) {
+        return stamp[u] == generation ? dist[u] : INF;
+    }
+
+    static void erase(std::vector<Arc>& arcs, int to) {
+        for (size_t i = 0; i < arcs.size(); i++) {
+            if (arcs[i].to == to) {
+                arcs[i] = arcs.back();
+                arcs.pop_back();
+                return;
+            }
+        }
+    }
+
+    // bounded Dijkstra from start among the remaining nodes, avoiding the node being contracted
+    void witness_search(int start, int avoid, double limit) {
+        Heap heap;
+        generation++;
+        stamp[start] = generation;
+        dist[start] = 0.0;
+        heap.push(std::make_pair(0.0, start));
+
+        int settled = 0;
+        while (!heap.empty()) {
+            Entry pop = heap.top();
+            heap.pop();
+            int current = pop.second;
+            if (pop.first > dist[current]) {
+                continue;
+            }
+            if (pop.first > limit || ++settled > WITNESS_SETTLE_LIMIT) {
+                break;
+            }
+            for (auto &arc: out[current]) {
+                if (arc.to == avoid) {
+                    continue;
+                }
+                double new_distance = dist[current] + arc.weight;
+                if (new_distance < distance(arc.to)) {
+                    stamp[arc.to] = generation;
+                    dist[arc.to] = new_distance;
+                    heap.push(std::make_pair(new_distance, arc.to));
+                }
+            }
+        }
+    }
+};
+
+void ContractionHierarchy::build(Graph& graph) {
+    n = graph.num_nodes();
+    Contraction contraction(graph);
+    std::vector<std::vector<Arc>> up(n), down(n);
+
+    long original = 0;
+    for (int u = 0; u < n; u++) {
+        original += contraction.out[u].size();
+    }
+
+    // lazy updates: a node is contracted only if its refreshed importance is still the smallest
+    std::priority_queue<std::pair<int, int>, std::vector<std::pair<int, int>>, std::greater<std::pair<int, int>>> order;
+    for (int u = 0; u < n; u++) {
+        order.push(std::make_pair(contraction.importance(u), u));
+    }
+
+    rank.assign(n, 0);
+    int next_rank = 0;
+    while (!order.empty()) {
+        int v = order.top().second;
+        order.pop();
+        int importance = contraction.importance(v);
+        if (!order.empty() && importance > order.top().first) {
+            order.push(std::make_pair(importance, v));
+            continue;
+        }
+
+        contraction.contract(v, false);
+        // every remaining neighbor gets a higher rank than v
+        up[v] = contraction.out[v];
+        down[v] = contraction.in[v];
+        contraction.remove(v);
+        rank[v] = next_rank++;
+    }
+
+    long total = 0;
+    for (auto direction: {std::make_pair(&up, std::make_pair(&up_offsets, &up_arcs)),
+                          std::make_pair(&down, std::make_pair(&down_offsets, &down_arcs))}) {
+        std::vector<std::vector<Arc>>& lists = *direction.first;
+        std::vector<int>& offsets = *direction.second.first;
+        std::vector<Arc>& arcs = *direction.second.second;
+        offsets.assign(n + 1, 0);
+        arcs.clear();
+        for (int u = 0; u < n; u++) {
+            arcs.insert(arcs.end(), lists[u].begin(), lists[u].end());
+            offsets[u + 1] = arcs.size();
+        }
+        total += arcs.size();
+    }
+    shortcuts = total - original;
+
+    stamp.assign(n, 0);
+    forward.assign(n, INF);
+    backward.assign(n, INF);
+    generation = 0;
+}
+
+void ContractionHierarchy::initialize() {
+    this->generation++;
+    if (this->generation == 0) {
+        std::fill(stamp.begin(), stamp.end(), 0);
+        this->generation = 1;
+    }
+}
+
+void ContractionHierarchy::touch(int u) {
+    if (stamp[u] != generation) {
+        stamp[u] = generation;
+        forward[u] = INF;
+        backward[u] = INF;
+    }
+}
+
+double ContractionHierarchy::query(int source, int target) {
+    // bidirectional Dijkstra, both directions only climb to higher ranked nodes
+    Heap heaps[2];
+    std::vector<double>* dist[2] = {&forward, &backward};
+    const std::vector<int>* offsets[2] = {&up_offsets, &down_offsets};
+    const std::vector<Arc>* arcs[2] = {&up_arcs, &down_arcs};
+
+    this->initialize();
+    this->stats = SearchStats();
+
+    this->touch(source);
+    this->touch(target);
+    forward[source] = 0.0;
+    backward[target] = 0.0;
+    heaps[0].push(std::make_pair(0.0, source));
+    heaps[1].push(std::make_pair(0.0, target));
+    this->stats.pushes += 2;
+
+    double best = INF;
+    while (!heaps[0].empty() || !heaps[1].empty()) {
+        int side = heaps[1].empty() || (!heaps[0].empty() && heaps[0].top().first <= heaps[1].top().first) ? 0 : 1;
+        Entry pop = heaps[side].top();
+        heaps[side].pop();
+
+        // nothing left in this direction can improve the best meeting point
+        if (pop.first >= best) {
+            heaps[side] = Heap();
+            continue;
+        }
+
+        int current = pop.second;
+        std::vector<double>& d = *dist[side];
+        if (pop.first > d[current]) {
+            continue;
+        }
+        this->stats.settled++;
+        best = std::min(best, d[current] + (*dist[1 - side])[current]);
+
+        for (int e = (*offsets[side])[current]; e < (*offsets[side])[current + 1]; e++) {
+            const Arc& arc = (*arcs[side])[e];
+            this->touch(arc.to);
+            double new_distance = d[current] + arc.weight;
+            if (new_distance < d[arc.to]) {
+                d[arc.to] = new_distance;
+                heaps[side].push(std::make_pair(new_distance, arc.to));
+                this->stats.pushes++;
+            }
+        }
+    }
+
+    return source == target ? 0.0 : best;
+}
+
+void ContractionHierarchy::upward_search(int start, const std::vector<int>& offsets, const std::vector<Arc>& arcs,
+                                         std::vector<double>& dist, std::vector<int>& settled) {
+    Heap heap;
+    this->initialize();
+    this->touch(start);
+    dist[start] = 0.0;
+    heap.push(std::make_pair(0.0, start));
+    this->stats.pushes++;
+
+    while (!heap.empty()) {
+        Entry pop = heap.top();
+        heap.pop();
+        int current = pop.second;
+        if (pop.first > dist[current]) {
+            continue;
+        }
+        settled.push_back(current);
+        this->stats.settled++;
+
+        for (int e = offsets[current]; e < offsets[current + 1]; e++) {
+            const Arc& arc = arcs[e];
+            this->touch(arc.to);
+            double new_distance = dist[current] + arc.weight;
+            if (new_distance < dist[arc.to]) {
+                dist[arc.to] = new_distance;
+                heap.push(std::make_pair(new_distance, arc.to));
+                this->stats.pushes++;
+            }
+        }
+    }
+}
+
+std::vector<std::vector<double>> ContractionHierarchy::many_to_many(const std::vector<int>& sources,
+                                                                    const std::vector<int>& targets) {
+    // bucket query: the backward search spaces of the targets are stored at the nodes they reach,
+    // then every forward search from a source scans the buckets of the nodes it settles
+    std::vector<std::vector<double>> res(sources.size(), std::vector<double>(targets.size(), INF));
+    std::unordered_map<int, std::vector<std::pair<size_t, double>>> buckets;
+    std::vector<int> settled;
+
+    this->stats = SearchStats();
+
+    for (size_t j = 0; j < targets.size(); j++) {
+        settled.clear();
+        this->upward_search(targets[j], down_offsets, down_arcs, backward, settled);
+        for (int u: settled) {
+            buckets[u].push_back(std::make_pair(j, backward[u]));
+        }
+    }
+
+    for (size_t i = 0; i < sources.size(); i++) {
+        settled.clear();
+        this->upward_search(sources[i], up_offsets, up_arcs, forward, settled);
+        for (int u: settled) {
+            auto found = buckets.find(u);
+            if (found == buckets.end()) {
+                continue;
+            }
+            for (auto &entry: found->second) {
+                res[i][entry.first] = std::min(res[i][entry.first], forward[u] + entry.second);
+            }
+        }
+    }
+
+    return res;
+}
@@ -0,0 +1,52 @@
+//
+// Contraction hierarchies on top of the CSR road network
+//
+
+#ifndef ROUTING_CH_H
+#define ROUTING_CH_H
+
+#include <vector>
+
+#include "astar.h"
+
+// preprocessed speed-up index for one weighting of the graph
+class ContractionHierarchy {
+public:
+    struct Arc {
+        int to;
+        double weight;
+    };
+
+    int n = 0;
+    long shortcuts = 0;                 // number of shortcut edges added by the contraction
+    std::vector<int> rank;              // contraction order of every node
+
+    // upward graphs in CSR layout
+    std::vector<int> up_offsets;        // forward: edges u -> v with rank[v] > rank[u]
+    std::vector<Arc> up_arcs;
+    std::vector<int> down_offsets;      // backward: edges v -> u with rank[v] > rank[u], stored at u
+    std::vector<Arc> down_arcs;
+
+    SearchStats stats;                  // statistics of the last query
+
+    // contract every node of graph, weighted by its current weights
+    void build(Graph& graph);
+    bool empty() {return n == 0;};
+
+    double query(int source, int target);
+    std::vector<std::vector<double>> many_to_many(const std::vector<int>& sources, const std::vector<int>& targets);
+
+private:
+    // search state, valid for a node only if its stamp equals the current generation
+    unsigned int generation = 0;
+    std::vector<unsigned int> stamp;
+    std::vector<double> forward;
+    std::vector<double> backward;
+
+    void initialize();
+    void touch(int u);
+    void upward_search(int start, const std::vector<int>& offsets, const std::vector<Arc>& arcs,
+                       std::vector<double>& dist, std::vector<int>& settled);
+};
+
+#endif //ROUTING_CH_H
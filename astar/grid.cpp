@@ -0,0 +1,129 @@
+//
+// Uniform grid over the node coordinates for nearest node and radius queries
+//
+
+#include "grid.h"
+
+#include <cmath>
+#include <algorithm>
+#include <stdexcept>
+
+const double METERS_PER_DEGREE = 111195.0;  // along a meridian, on the sphere of Graph::haversine
+
+void SpatialGrid::build(Graph& graph, double cell) {
+    int n = graph.num_nodes();
+    if (n == 0) {
+        throw std::runtime_error("the road network has no nodes");
+    }
+
+    double max_lon = graph.longitude[0], max_lat = graph.latitude[0];
+    this->min_lon = max_lon;
+    this->min_lat = max_lat;
+    for (int u = 1; u < n; u++) {
+        this->min_lon = std::min(this->min_lon, graph.longitude[u]);
+        this->min_lat = std::min(this->min_lat, graph.latitude[u]);
+        max_lon = std::max(max_lon, graph.longitude[u]);
+        max_lat = std::max(max_lat, graph.latitude[u]);
+    }
+
+    // about 4 nodes per cell unless given
+    if (cell <= 0) {
+        cell = std::sqrt(std::max((max_lon - this->min_lon) * (max_lat - this->min_lat), 1e-12) * 4 / n);
+    }
+    this->cell = cell;
+    this->cols = (int) ((max_lon - this->min_lon) / cell) + 1;
+    this->rows = (int) ((max_lat - this->min_lat) / cell) + 1;
+
+    // a degree of longitude is shortest at the latitude farthest from the equator
+    double widest = std::max(std::abs(this->min_lat), std::abs(max_lat)) * M_PI / 180;
+    this->meters_per_cell = 0.99 * cell * METERS_PER_DEGREE * std::cos(std::min(widest, M_PI / 2));
+
+    // counting sort of the nodes by cell
+    std::vector<int> cells(n);
+    this->offsets.assign((size_t) this->cols * this->rows + 1, 0);
+    for (int u = 0; u < n; u++) {
+        cells[u] = this->row(graph.latitude[u]) * this->cols + this->col(graph.longitude[u]);
+        this->offsets[cells[u] + 1]++;
+    }
+    for (size_t c = 1; c < this->offsets.size(); c++) {
+        this->offsets[c] += this->offsets[c - 1];
+    }
+    std::vector<int> next(this->offsets.begin(), this->offsets.end() - 1);
+    this->nodes.assign(n, 0);
+    for (int u = 0; u < n; u++) {
+        this->nodes[next[cells[u]]++] = u;
+    }
+}
+
+int SpatialGrid::col(double lon) const {
+    return std::max(0, std::min(this->cols - 1, (int) std::floor((lon - this->min_lon) / this->cell)));
+}
+
+int SpatialGrid::row(double lat) const {
+    return std::max(0, std::min(this->rows - 1, (int) std::floor((lat - this->min_lat) / this->cell)));
+}
+
+void SpatialGrid::scan(Graph& graph, int c, int r, double lon, double lat, std::vector<std::pair<double, int>>& found) {
+    if (c < 0 || c >= this->cols || r < 0 || r >= this->rows) {
+        return;
+    }
+    int k = r * this->cols + c;
+    for (int i = this->offsets[k]; i < this->offsets[k + 1]; i++) {
+        int u = this->nodes[i];
+        double d = graph.haversine(std::make_pair(lon, lat), std::make_pair(graph.longitude[u], graph.latitude[u]));
+        found.push_back(std::make_pair(d, u));
+    }
+}
+
+std::vector<std::pair<double, int>> SpatialGrid::nearest(Graph& graph, double lon, double lat, int k) {
+    // rings of cells around the cell of the query, every node outside ring r is at least r cells away
+    std::vector<std::pair<double, int>> found;
+    int c = this->col(lon), r = this->row(lat);
+    int last = std::max(this->cols, this->rows);
+    k = std::min(k, (int) this->nodes.size());
+    if (k <= 0) {
+        return found;
+    }
+    for (int ring = 0; ring <= last; ring++) {
+        if (ring == 0) {
+            this->scan(graph, c, r, lon, lat, found);
+        } else {
+            for (int dc = -ring; dc <= ring; dc++) {
+                this->scan(graph, c + dc, r - ring, lon, lat, found);
+                this->scan(graph, c + dc, r + ring, lon, lat, found);
+            }
+            for (int dr = -ring + 1; dr < ring; dr++) {
+                this->scan(graph, c - ring, r + dr, lon, lat, found);
+                this->scan(graph, c + ring, r + dr, lon, lat, found);
+            }
+        }
+        if ((int) found.size() >= k) {
+            std::nth_element(found.begin(), found.begin() + k - 1, found.end());
+            if (found[k - 1].first <= ring * this->meters_per_cell) {
+                break;
+            }
+        }
+    }
+    std::sort(found.begin(), found.end());
+    found.resize(k);
+    return found;
+}
+
+std::vector<std::pair<double, int>> SpatialGrid::within(Graph& graph, double lon, double lat, double radius) {
+    std::vector<std::pair<double, int>> found;
+    int reach = (int) std::min(std::ceil(radius / this->meters_per_cell), (double) std::max(this->cols, this->rows));
+    int c = this->col(lon), r = this->row(lat);
+    for (int rr = std::max(0, r - reach); rr <= std::min(this->rows - 1, r + reach); rr++) {
+        for (int cc = std::max(0, c - reach); cc <= std::min(this->cols - 1, c + reach); cc++) {
+            this->scan(graph, cc, rr, lon, lat, found);
+        }
+    }
+    std::vector<std::pair<double, int>> res;
+    for (auto& entry: found) {
+        if (entry.first <= radius) {
+            res.push_back(entry);
+        }
+    }
+    std::sort(res.begin(), res.end());
+    return res;
+}
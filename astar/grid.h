@@ -0,0 +1,39 @@
+//
+// Uniform grid over the node coordinates for nearest node and radius queries
+//
+
+#ifndef ROUTING_GRID_H
+#define ROUTING_GRID_H
+
+#include <vector>
+
+#include "astar.h"
+
+// the nodes of every cell are stored contiguously, cell c holds nodes[offsets[c]] ... nodes[offsets[c+1]-1]
+class SpatialGrid {
+public:
+    double cell = 0.0;                  // cell size (degree)
+    double min_lon = 0.0;
+    double min_lat = 0.0;
+    int cols = 0;
+    int rows = 0;
+    double meters_per_cell = 0.0;       // lower bound of the distance spanned by a cell in any direction
+
+    std::vector<int> offsets;
+    std::vector<int> nodes;             // dense node indices
+
+    void build(Graph& graph, double cell);
+    bool empty() const {return offsets.empty();};
+    size_t bytes() const {return (offsets.capacity() + nodes.capacity()) * sizeof(int);};
+
+    // (distance (m), dense index) sorted by distance
+    std::vector<std::pair<double, int>> nearest(Graph& graph, double lon, double lat, int k);
+    std::vector<std::pair<double, int>> within(Graph& graph, double lon, double lat, double radius);
+
+private:
+    int col(double lon) const;
+    int row(double lat) const;
+    void scan(Graph& graph, int c, int r, double lon, double lat, std::vector<std::pair<double, int>>& found);
+};
+
+#endif //ROUTING_GRID_H
@@ -1,23 +1,53 @@
 #include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
+#include <pybind11/stl.h>
 #include <iostream>
 #include <sstream>
 #include <fstream>
+#include <atomic>
+#include <mutex>
+#include <chrono>
+#include <thread>
 #include <string>
 
+#include <sys/stat.h>
+
 #include "astar.h"
+#include "ch.h"
+#include "grid.h"
+
+namespace py = pybind11;
+
+const char* NODE_FILE = "./data/nodes_N96570.csv";
+const char* LINK_FILE = "./data/links_L260855.csv";
+const char* GRAPH_CACHE = "./data/graph.bin";
 
 // find an optimal path
 class RoutingPlanner {
 public:
     Graph *pGraph;
+    ContractionHierarchy ch;    // optional speed-up index, built by build_ch()
+    SpatialGrid grid;           // spatial index of the nodes, built by build_grid() or by the first spatial query
+    SearchStats last_stats;     // statistics of the last astar / cost_matrix call
+    int threads = 1;            // worker threads of the batch queries
+    std::vector<SearchState> idle;      // search states of the batch queries, checked out by every call
+    std::mutex idle_mutex;
+    std::mutex ch_mutex;                // the contraction hierarchy keeps one search state
 
     RoutingPlanner(double alpha, double beta, double gamma) {
         pGraph = new Graph(alpha, beta, gamma);
 
-        // get graph information
+        // the binary cache is shared by every process on the host, the CSV files are the fallback
+        if (!(cache_is_fresh() && pGraph->load(GRAPH_CACHE))) {
+            read_csv(pGraph);
+        }
+    }
+
+    // read the graph information from the road network CSV files
+    static void read_csv(Graph* graph) {
         // file pointer
-        std::fstream fnode("./data/nodes_N96570.csv", std::ios::in);
-        std::fstream flink("./data/links_L260855.csv", std::ios::in);
+        std::fstream fnode(NODE_FILE, std::ios::in);
+        std::fstream flink(LINK_FILE, std::ios::in);
 
         // read the data from the file as string vector
         std::vector<std::string> row;
@@ -32,7 +62,7 @@ public:
                 while (std::getline(str, word, ',')) {
                     row.push_back(word);
                 }
-                pGraph->add_vertex(std::stoi(row[1]), std::stod(row[2]), std::stod(row[3]));
+                graph->add_vertex(std::stoi(row[1]), std::stod(row[2]), std::stod(row[3]));
             }
         }
 
@@ -45,13 +75,28 @@ public:
                 while (std::getline(str, word, ',')) {
                     row.push_back(word);
                 }
-                // alpha * distance + beta * travel_time + gamma * carbon_emission
+                // distance, travel_time and carbon_emission are weighted by alpha, beta and gamma in Graph
                 // 7-th column: street length, 8-th column: travel time, 9-th column: speed limit, 10-th column: elevation
-                pGraph->add_edge(std::stoi(row[1]), std::stoi(row[2]),
-                                 alpha * std::stod(row[7]) + beta * std::stod(row[8])
-                                 + gamma * std::stod(row[11]) * std::stod(row[7]));
+                graph->add_edge(std::stoi(row[1]), std::stoi(row[2]),
+                                std::stod(row[7]), std::stod(row[8]), std::stod(row[11]) * std::stod(row[7]));
             }
         }
+
+        graph->finalize();
+    }
+
+    // the cache is stale if a CSV file was modified after it was compiled
+    static bool cache_is_fresh() {
+        struct stat cache, source;
+        if (stat(GRAPH_CACHE, &cache) != 0) {
+            return false;
+        }
+        for (const char* path: {NODE_FILE, LINK_FILE}) {
+            if (stat(path, &source) == 0 && source.st_mtime > cache.st_mtime) {
+                return false;
+            }
+        }
+        return true;
     }
 
     void init() {
@@ -59,24 +104,442 @@ public:
     }
 
     double astar(int frm, int to) {
-        return this->pGraph->route_planning(frm, to);
+        double cost = this->pGraph->route_planning(frm, to);
+        this->last_stats = this->pGraph->state.stats;
+        return cost;
     }
 
     void astar_path(int frm, int to) {
         return this->pGraph->route_planning_details(frm, to);
     }
 
+    // per-query weights (alpha, beta, gamma), the weights of the planner if None
+    Weights get_weights(py::object weights) {
+        if (weights.is_none()) {
+            return this->pGraph->weights;
+        }
+        std::vector<double> w = weights.cast<std::vector<double>>();
+        if (w.size() != 3) {
+            throw std::invalid_argument("weights must be (alpha, beta, gamma)");
+        }
+        return Weights(w[0], w[1], w[2]);
+    }
+
+    py::dict route(int frm, int to, py::object weights) {
+        this->check_nodes({frm, to});
+        this->pGraph->route_planning(frm, to, this->get_weights(weights), this->pGraph->state);
+        this->last_stats = this->pGraph->state.stats;
+        PathMetrics path = this->pGraph->path_metrics(to, this->pGraph->state);
+
+        py::dict res;
+        res["cost"] = path.cost;
+        res["length"] = path.length;
+        res["travel_time"] = path.travel_time;
+        res["emission"] = path.emission;
+        return res;
+    }
+
+    // node IDs and coordinates of a sequence of node indices
+    py::tuple path_arrays(const std::vector<int>& nodes) {
+        py::array_t<int> ids(nodes.size());
+        py::array_t<double> coords({nodes.size(), (size_t) 2});
+        auto c = coords.mutable_unchecked<2>();
+        for (size_t i = 0; i < nodes.size(); i++) {
+            ids.mutable_data()[i] = this->pGraph->node_ids[nodes[i]];
+            c(i, 0) = this->pGraph->longitude[nodes[i]];
+            c(i, 1) = this->pGraph->latitude[nodes[i]];
+        }
+        return py::make_tuple(ids, coords);
+    }
+
+    py::tuple path(int frm, int to, py::object weights) {
+        this->check_nodes({frm, to});
+        this->pGraph->route_planning(frm, to, this->get_weights(weights), this->pGraph->state);
+        this->last_stats = this->pGraph->state.stats;
+        std::vector<int> nodes = this->pGraph->path_nodes(to, this->pGraph->state);
+        if (nodes.empty()) {
+            throw std::runtime_error("no path from " + std::to_string(frm) + " to " + std::to_string(to));
+        }
+        return this->path_arrays(nodes);
+    }
+
+    // the legs between consecutive stops, searched on the worker threads and concatenated
+    // offsets[k] is the position of stop k in the node sequence
+    py::tuple route_path(std::vector<int> stops, py::object weights, int threads) {
+        this->check_nodes(stops);
+        Weights w = this->get_weights(weights);
+
+        size_t legs = stops.size() > 1 ? stops.size() - 1 : 0;
+        std::vector<std::vector<int>> paths(legs);
+        this->parallel_for(legs, threads, [&](size_t i, SearchState& s) {
+            this->pGraph->route_planning(stops[i], stops[i + 1], w, s);
+            paths[i] = this->pGraph->path_nodes(stops[i + 1], s);
+        });
+
+        std::vector<int> nodes;
+        py::array_t<int> offsets(stops.size());
+        if (!stops.empty()) {
+            nodes.push_back(this->pGraph->get_index(stops[0]));
+            offsets.mutable_data()[0] = 0;
+        }
+        for (size_t i = 0; i < legs; i++) {
+            if (paths[i].empty()) {
+                throw std::runtime_error("no path from " + std::to_string(stops[i]) + " to " + std::to_string(stops[i + 1]));
+            }
+            // every leg starts where the last one ended
+            nodes.insert(nodes.end(), paths[i].begin() + 1, paths[i].end());
+            offsets.mutable_data()[i + 1] = nodes.size() - 1;
+        }
+
+        py::tuple arrays = this->path_arrays(nodes);
+        return py::make_tuple(arrays[0], arrays[1], offsets);
+    }
+
+    void set_threads(int threads) {
+        if (threads < 1) {
+            throw std::invalid_argument("the number of threads must be positive");
+        }
+        this->threads = threads;
+    }
+
+    // run task(i, state) for every source i on the worker threads, without holding the GIL
+    template <typename Task>
+    void parallel_for(size_t count, int workers, Task task) {
+        workers = std::max(1, std::min(workers > 0 ? workers : this->threads, (int) count));
+
+        std::atomic<size_t> next(0);
+        std::vector<SearchStats> totals(workers);
+        std::vector<SearchState> states;
+        auto work = [&](int k) {
+            for (size_t i = next++; i < count; i = next++) {
+                task(i, states[k]);
+                totals[k] += states[k].stats;
+            }
+        };
+
+        {
+            // concurrent calls from other Python threads get search states of their own
+            py::gil_scoped_release release;
+            {
+                std::lock_guard<std::mutex> lock(this->idle_mutex);
+                while ((int) states.size() < workers && !this->idle.empty()) {
+                    states.push_back(std::move(this->idle.back()));
+                    this->idle.pop_back();
+                }
+            }
+            while ((int) states.size() < workers) {
+                states.push_back(this->pGraph->new_state());
+            }
+
+            std::vector<std::thread> pool;
+            for (int k = 1; k < workers; k++) {
+                pool.emplace_back(work, k);
+            }
+            work(0);
+            for (auto &t: pool) {
+                t.join();
+            }
+
+            std::lock_guard<std::mutex> lock(this->idle_mutex);
+            for (auto &state: states) {
+                this->idle.push_back(std::move(state));
+            }
+        }
+
+        this->last_stats = SearchStats();
+        for (auto &total: totals) {
+            this->last_stats += total;
+        }
+    }
+
+    py::array_t<double> cost_matrix(std::vector<int> sources, std::vector<int> targets, py::object weights, int threads) {
+        this->check_nodes(sources);
+        this->check_nodes(targets);
+        Weights w = this->get_weights(weights);
+
+        py::array_t<double> res({sources.size(), targets.size()});
+        double* r = res.mutable_data();
+        size_t m = targets.size();
+        this->parallel_for(sources.size(), threads, [&](size_t i, SearchState& s) {
+            std::vector<double> row = this->pGraph->one_to_many(sources[i], targets, w, s);
+            std::copy(row.begin(), row.end(), r + i * m);
+        });
+        return res;
+    }
+
+    // cost, length, travel time and emission of the optimal paths, stacked on the last axis
+    py::array_t<double> metric_matrix(std::vector<int> sources, std::vector<int> targets, py::object weights, int threads) {
+        this->check_nodes(sources);
+        this->check_nodes(targets);
+        Weights w = this->get_weights(weights);
+
+        py::array_t<double> res({sources.size(), targets.size(), (size_t) 4});
+        double* r = res.mutable_data();
+        size_t m = targets.size();
+        this->parallel_for(sources.size(), threads, [&](size_t i, SearchState& s) {
+            std::vector<PathMetrics> paths;
+            this->pGraph->one_to_many(sources[i], targets, w, s, &paths);
+            for (size_t j = 0; j < m; j++) {
+                double* cell = r + (i * m + j) * 4;
+                cell[0] = paths[j].cost;
+                cell[1] = paths[j].length;
+                cell[2] = paths[j].travel_time;
+                cell[3] = paths[j].emission;
+            }
+        });
+        return res;
+    }
+
+    void check_nodes(const std::vector<int>& ids) {
+        for (int id: ids) {
+            if (!this->pGraph->has_node(id)) {
+                throw std::invalid_argument("unknown node ID " + std::to_string(id));
+            }
+        }
+    }
+
+    // contraction hierarchies
+    py::dict build_ch() {
+        auto begin = std::chrono::steady_clock::now();
+        std::lock_guard<std::mutex> lock(this->ch_mutex);
+        this->ch.build(*this->pGraph);
+        std::chrono::duration<double> elapsed = std::chrono::steady_clock::now() - begin;
+
+        py::dict res;
+        res["shortcuts"] = this->ch.shortcuts;
+        res["seconds"] = elapsed.count();
+        return res;
+    }
+
+    void check_ch() {
+        if (this->ch.empty()) {
+            throw std::runtime_error("the contraction hierarchy is not built, call build_ch() first");
+        }
+    }
+
+    double ch_query(int frm, int to) {
+        this->check_ch();
+        std::lock_guard<std::mutex> lock(this->ch_mutex);
+        double cost = this->ch.query(this->pGraph->get_index(frm), this->pGraph->get_index(to));
+        this->last_stats = this->ch.stats;
+        return cost;
+    }
+
+    py::array_t<double> ch_cost_matrix(std::vector<int> sources, std::vector<int> targets) {
+        this->check_ch();
+        std::vector<int> source_idx, target_idx;
+        for (int id: sources) {
+            source_idx.push_back(this->pGraph->get_index(id));
+        }
+        for (int id: targets) {
+            target_idx.push_back(this->pGraph->get_index(id));
+        }
+
+        std::vector<std::vector<double>> matrix;
+        SearchStats stats;
+        {
+            py::gil_scoped_release release;
+            std::lock_guard<std::mutex> lock(this->ch_mutex);
+            matrix = this->ch.many_to_many(source_idx, target_idx);
+            stats = this->ch.stats;
+        }
+        this->last_stats = stats;
+
+        py::array_t<double> res({sources.size(), targets.size()});
+        auto r = res.mutable_unchecked<2>();
+        for (size_t i = 0; i < sources.size(); i++) {
+            for (size_t j = 0; j < targets.size(); j++) {
+                r(i, j) = matrix[i][j];
+            }
+        }
+        return res;
+    }
+
+    // compare the contraction hierarchy against A* on random pairs
+    py::dict verify_ch(int samples, unsigned int seed) {
+        this->check_ch();
+        std::lock_guard<std::mutex> lock(this->ch_mutex);
+        std::mt19937 gen(seed);
+        std::uniform_int_distribution<int> node(0, this->pGraph->num_nodes() - 1);
+
+        int mismatches = 0;
+        double max_error = 0.0;
+        for (int i = 0; i < samples; i++) {
+            int frm = this->pGraph->node_ids[node(gen)];
+            int to = this->pGraph->node_ids[node(gen)];
+            double expected = this->pGraph->route_planning(frm, to);
+            double actual = this->ch.query(this->pGraph->get_index(frm), this->pGraph->get_index(to));
+            double error = expected == actual ? 0.0 : std::abs(expected - actual);
+            if (error > 1e-6 * std::max(1.0, std::abs(expected))) {
+                mismatches++;
+            }
+            max_error = std::max(max_error, error);
+        }
+
+        py::dict res;
+        res["samples"] = samples;
+        res["mismatches"] = mismatches;
+        res["max_error"] = max_error;
+        return res;
+    }
+
+    py::array_t<int> node_ids() {
+        py::array_t<int> res(this->pGraph->num_nodes());
+        std::copy(this->pGraph->node_ids.data, this->pGraph->node_ids.data + this->pGraph->num_nodes(), res.mutable_data());
+        return res;
+    }
+
+    // spatial index
+    py::dict build_grid(double cell) {
+        auto begin = std::chrono::steady_clock::now();
+        this->grid.build(*this->pGraph, cell);
+        std::chrono::duration<double> elapsed = std::chrono::steady_clock::now() - begin;
+
+        py::dict res;
+        res["cell"] = this->grid.cell;
+        res["cells"] = this->grid.cols * this->grid.rows;
+        res["seconds"] = elapsed.count();
+        return res;
+    }
+
+    void check_grid() {
+        if (this->grid.empty()) {
+            this->grid.build(*this->pGraph, 0);
+        }
+    }
+
+    // node IDs and distances (m) of the found nodes, nearest first
+    py::tuple found_nodes(const std::vector<std::pair<double, int>>& found) {
+        py::array_t<int> ids(found.size());
+        py::array_t<double> distances(found.size());
+        for (size_t i = 0; i < found.size(); i++) {
+            ids.mutable_data()[i] = this->pGraph->node_ids[found[i].second];
+            distances.mutable_data()[i] = found[i].first;
+        }
+        return py::make_tuple(ids, distances);
+    }
+
+    py::tuple nearest(double lon, double lat, int k) {
+        this->check_grid();
+        return this->found_nodes(this->grid.nearest(*this->pGraph, lon, lat, k));
+    }
+
+    py::tuple within(double lon, double lat, double radius) {
+        this->check_grid();
+        return this->found_nodes(this->grid.within(*this->pGraph, lon, lat, radius));
+    }
+
+    // nearest node of every coordinate
+    py::array_t<int> snap(std::vector<double> lons, std::vector<double> lats) {
+        if (lons.size() != lats.size()) {
+            throw std::invalid_argument("lons and lats must have the same length");
+        }
+        this->check_grid();
+        py::array_t<int> res(lons.size());
+        for (size_t i = 0; i < lons.size(); i++) {
+            std::vector<std::pair<double, int>> found = this->grid.nearest(*this->pGraph, lons[i], lats[i], 1);
+            if (found.empty()) {
+                throw std::runtime_error("no node to snap to, the road network is empty");
+            }
+            res.mutable_data()[i] = this->pGraph->node_ids[found[0].second];
+        }
+        return res;
+    }
+
+    // longitude and latitude of the given nodes, one row per node
+    py::array_t<double> coordinates(std::vector<int> ids) {
+        this->check_nodes(ids);
+        py::array_t<double> res({ids.size(), (size_t) 2});
+        auto r = res.mutable_unchecked<2>();
+        for (size_t i = 0; i < ids.size(); i++) {
+            std::pair<double, double> coord = this->pGraph->get_coordinate(ids[i]);
+            r(i, 0) = coord.first;
+            r(i, 1) = coord.second;
+        }
+        return res;
+    }
+
+    py::dict stats() {
+        py::dict res;
+        res["settled"] = this->last_stats.settled;
+        res["pushes"] = this->last_stats.pushes;
+        return res;
+    }
+
+    py::dict memory_usage() {
+        py::dict res;
+        res["nodes"] = this->pGraph->num_nodes();
+        res["edges"] = this->pGraph->num_edges();
+        res["bytes"] = this->pGraph->memory_usage();
+        res["mapped"] = this->pGraph->mapped_bytes();
+        res["grid"] = this->grid.bytes();
+        return res;
+    }
+
+    // default weights and a hash of the road network, the costs computed by two planners agree if both match
+    py::dict signature() {
+        const Graph& g = *this->pGraph;
+        uint64_t hash = 1469598103934665603ULL;
+        auto mix = [&hash](const void* data, size_t bytes) {
+            const unsigned char* p = static_cast<const unsigned char*>(data);
+            for (size_t i = 0; i < bytes; i++) {
+                hash = (hash ^ p[i]) * 1099511628211ULL;
+            }
+        };
+        mix(g.node_ids.data, g.node_ids.size * sizeof(int));
+        mix(g.offsets.data, g.offsets.size * sizeof(int));
+        mix(g.targets.data, g.targets.size * sizeof(int));
+        mix(g.length.data, g.length.size * sizeof(double));
+        mix(g.travel_time.data, g.travel_time.size * sizeof(double));
+        mix(g.emission.data, g.emission.size * sizeof(double));
+
+        std::ostringstream graph;
+        graph << std::hex << hash;
+        py::dict res;
+        res["weights"] = py::make_tuple(g.weights.alpha, g.weights.beta, g.weights.gamma);
+        res["graph"] = graph.str();
+        return res;
+    }
+
     // Destructor
-    ~RoutingPlanner() {};
+    ~RoutingPlanner() {
+        delete pGraph;
+    };
 
 };
 
-namespace py = pybind11;
+// one-time compile step: parse the CSV files and write the binary graph cache
+void compile_graph() {
+    Graph graph(0, 0, 0);
+    RoutingPlanner::read_csv(&graph);
+    graph.save(GRAPH_CACHE);
+}
 
 PYBIND11_MODULE(planner, m) {
+    m.def("compile_graph", &compile_graph, "write the binary graph cache loaded by RoutingPlanner");
     py::class_<RoutingPlanner>(m, "RoutingPlanner")
             .def(py::init<int, int, int> ())
-            .def("init", &RoutingPlanner::init, "initialize graph")
+            .def("init", &RoutingPlanner::init, "reset the vertices reached by the last query")
             .def("astar", &RoutingPlanner::astar, "get the cost of the optimal cost", py::arg("frm"), py::arg("to"))
-            .def("astar_path", &RoutingPlanner::astar_path, "get the coordinates of the optimal path in the result directory", py::arg("frm"), py::arg("to"));
+            .def("astar_path", &RoutingPlanner::astar_path, "get the coordinates of the optimal path in the result directory", py::arg("frm"), py::arg("to"))
+            .def("route", &RoutingPlanner::route, "get the cost, length, travel time and emission of the optimal path", py::arg("frm"), py::arg("to"), py::arg("weights") = py::none())
+            .def("path", &RoutingPlanner::path, "get the node IDs and coordinates of the optimal path as arrays", py::arg("frm"), py::arg("to"), py::arg("weights") = py::none())
+            .def("route_path", &RoutingPlanner::route_path, "get the node IDs and coordinates of the optimal paths along a sequence of stops, and the position of every stop", py::arg("stops"), py::arg("weights") = py::none(), py::arg("threads") = 0)
+            .def("cost_matrix", &RoutingPlanner::cost_matrix, "get the costs from every source to every target as an array", py::arg("sources"), py::arg("targets"), py::arg("weights") = py::none(), py::arg("threads") = 0)
+            .def("metric_matrix", &RoutingPlanner::metric_matrix, "get the cost, length, travel time and emission from every source to every target", py::arg("sources"), py::arg("targets"), py::arg("weights") = py::none(), py::arg("threads") = 0)
+            .def("set_threads", &RoutingPlanner::set_threads, "set the default number of worker threads of the batch queries", py::arg("threads"))
+            .def_readonly("threads", &RoutingPlanner::threads)
+            .def("build_ch", &RoutingPlanner::build_ch, "build the contraction hierarchy for the weights of the planner")
+            .def("ch_query", &RoutingPlanner::ch_query, "get the cost of the optimal path with the contraction hierarchy", py::arg("frm"), py::arg("to"))
+            .def("ch_cost_matrix", &RoutingPlanner::ch_cost_matrix, "get the costs from every source to every target with the contraction hierarchy", py::arg("sources"), py::arg("targets"))
+            .def("verify_ch", &RoutingPlanner::verify_ch, "compare the contraction hierarchy with A* on random pairs", py::arg("samples") = 100, py::arg("seed") = 0)
+            .def("node_ids", &RoutingPlanner::node_ids, "get the IDs of every node of the road network")
+            .def("build_grid", &RoutingPlanner::build_grid, "build the spatial index of the nodes, with about 4 nodes per cell if the cell size (degree) is 0", py::arg("cell") = 0.0)
+            .def("nearest", &RoutingPlanner::nearest, "get the IDs and distances (m) of the k nearest nodes of a coordinate", py::arg("lon"), py::arg("lat"), py::arg("k") = 1)
+            .def("within", &RoutingPlanner::within, "get the IDs and distances (m) of the nodes within a radius (m) of a coordinate", py::arg("lon"), py::arg("lat"), py::arg("radius"))
+            .def("snap", &RoutingPlanner::snap, "get the nearest node ID of every coordinate", py::arg("lons"), py::arg("lats"))
+            .def("coordinates", &RoutingPlanner::coordinates, "get the longitude and latitude of the given nodes as an array", py::arg("ids"))
+            .def("stats", &RoutingPlanner::stats, "get the number of settled nodes and heap pushes of the last query")
+            .def("signature", &RoutingPlanner::signature, "get the default weights and a hash of the road network")
+            .def("memory_usage", &RoutingPlanner::memory_usage, "get the number of nodes and edges and the bytes held and mapped by the graph");
 }
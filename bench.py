@@ -0,0 +1,400 @@
+# built-in
+import os
+import json
+import time
+import logging
+import argparse
+import tracemalloc
+import datetime
+import numpy as np
+import pandas as pd
+
+from tabulate import tabulate
+
+# my own
+from user import User
+from system import System
+from vehicle import Vehicle
+from zoning import Zoning, SCHEMES
+from astar.planner import *
+
+logger = logging.getLogger("Benchmark")
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.WARNING)
+
+TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+
+def bench_threads(planner, size, max_threads, seed):
+    # random sources and targets over the road network
+    rng = np.random.default_rng(seed)
+    node_ids = planner.node_ids()
+    sources = rng.choice(node_ids, size).tolist()
+    targets = rng.choice(node_ids, size).tolist()
+
+    result = {"threads": [],
+              "time (s)": [],
+              "speedup": [],
+              "settled nodes": []}
+    expected = None
+    for threads in range(1, max_threads + 1):
+        start_time = time.perf_counter()
+        matrix = planner.cost_matrix(sources, targets, threads=threads)
+        elapsed = time.perf_counter() - start_time
+
+        if expected is None:
+            expected = matrix
+        assert np.array_equal(matrix, expected), "The cost matrix depends on the number of threads."
+
+        result["threads"].append(threads)
+        result["time (s)"].append(round(elapsed, 3))
+        result["speedup"].append(round(result["time (s)"][0] / elapsed, 2))
+        result["settled nodes"].append(planner.stats()["settled"])
+
+    print("[%s x %s cost matrix]" % (size, size))
+    print(tabulate(result, headers="keys", tablefmt="fancy_grid"))
+
+
+def bench_queries(planner, size, seed):
+    # point queries reuse one search state, every pair is queried right after its reverse, whose search settles the
+    # target of the next one, and must agree with the cost matrix, unreachable pairs included
+    rng = np.random.default_rng(seed)
+    node_ids = planner.node_ids()
+    sources = rng.choice(node_ids, size).tolist()
+    targets = rng.choice(node_ids, size).tolist()
+    expected = np.array([planner.cost_matrix([frm], [to])[0, 0] for frm, to in zip(sources, targets)])
+
+    start_time = time.perf_counter()
+    costs = []
+    for frm, to in zip(sources, targets):
+        planner.astar(to, frm)
+        costs.append(planner.astar(frm, to))
+    elapsed = time.perf_counter() - start_time
+    mismatches = int((np.array(costs) != expected).sum())
+    assert mismatches == 0, "%s of %s point queries disagree with the cost matrix." % (mismatches, size)
+
+    result = {"pairs": [size],
+              "unreachable": [int(np.isinf(expected).sum())],
+              "time (s)": [round(elapsed, 3)],
+              "mismatches": [mismatches]}
+    print("[%s point queries after their reverse]" % size)
+    print(tabulate(result, headers="keys", tablefmt="fancy_grid"))
+
+
+def bench_memory(size, route_length):
+    # bytes held per user and per vehicle, the vehicles with routes of route_length stops of their own users
+    start = datetime.datetime.strptime("2024/08/16 00:00:00", TIME_FORMAT)
+    result = {"object": [], "count": [], "bytes per object": []}
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    users = [User(start, idx, idx, idx + 1, 1, logger) for idx in range(size)]
+    result["object"].append("user")
+    result["count"].append(size)
+    result["bytes per object"].append(round((tracemalloc.get_traced_memory()[0] - before) / size, 1))
+
+    before = tracemalloc.get_traced_memory()[0]
+    vehicles = []
+    for idx in range(size // route_length):
+        v = Vehicle(start, idx, idx, 10800, 6, 1.5, logger)
+        v.reset()
+        for k, user in enumerate(users[idx * route_length:(idx + 1) * route_length]):
+            v.add_route((user.pu, user, float(k)))
+            v.accept_user(user)
+        vehicles.append(v)
+    result["object"].append("vehicle (%s stops)" % route_length)
+    result["count"].append(len(vehicles))
+    result["bytes per object"].append(round((tracemalloc.get_traced_memory()[0] - before) / max(len(vehicles), 1), 1))
+    tracemalloc.stop()
+
+    print(tabulate(result, headers="keys", tablefmt="fancy_grid"))
+
+
+def read_inputs(call_path, veh_path):
+    call = pd.read_csv(call_path)
+    call["time"] = pd.to_datetime(call["time"], format=TIME_FORMAT)
+    veh = pd.read_csv(veh_path)
+    veh["time"] = pd.to_datetime(veh["time"], format=TIME_FORMAT)
+    return call, veh
+
+
+def synthetic_inputs(node_ids, rate, fleet, duration, seed, start, working_time, capacity):
+    # calls arrive as a Poisson process of rate per minute between random distinct nodes, groups of 1 to 3 users
+    # the whole fleet enters service at random nodes at the start
+    rng = np.random.default_rng(seed)
+    times = np.cumsum(rng.exponential(60 / rate, size=int(rate * duration * 2) + 10))
+    times = times[times < duration * 60]
+    pu = rng.choice(node_ids, len(times))
+    do = rng.choice(node_ids, len(times))
+    while np.any(pu == do):
+        do[pu == do] = rng.choice(node_ids, np.count_nonzero(pu == do))
+
+    call = pd.DataFrame({"time": (start + pd.to_timedelta(times, unit="s")).floor("s"),
+                         "id": np.arange(len(times)),
+                         "pick up": pu,
+                         "drop off": do,
+                         "num": rng.integers(1, 4, len(times))})
+    veh = pd.DataFrame({"time": [start] * fleet,
+                        "id": np.arange(fleet),
+                        "location": rng.choice(node_ids, fleet),
+                        "working time": working_time,
+                        "capacity": capacity})
+    return call, veh
+
+
+def cycles(call, veh, step):
+    # calls and vehicles arriving in every dispatch cycle of step seconds
+    now = min(call["time"].min(), veh["time"].min())
+    last = max(call["time"].max(), veh["time"].max())
+    before = now - datetime.timedelta(seconds=step)
+    while before < last:
+        call_ = call[(call["time"] > before) & (call["time"] <= now)]
+        veh_ = veh[(veh["time"] > before) & (veh["time"] <= now)]
+        yield now, call_, veh_
+        before = now
+        now = now + datetime.timedelta(seconds=step)
+
+
+def arrive(system, now, call_, veh_, detour):
+    system.set_time(now)
+    system.add_users([User(row["time"], row["id"], row["pick up"], row["drop off"], row["num"], logger)
+                      for idx, row in call_.iterrows()])
+    system.add_vehicles([Vehicle(row["time"], row["id"], row["location"], row["working time"],
+                                 row["capacity"], detour, logger) for idx, row in veh_.iterrows()])
+
+
+def kpis(system, penalty):
+    # service KPIs of the whole run, over the users in the system and the served users that already left it
+    served = [user for v in system.vehicles for user in v.on_board]
+    completed = system.completed
+    count = len(served) + completed["users"]
+    return {"users": len(system.users) + completed["users"],
+            "served": count,
+            "rejected": system.rejections,
+            "waiting time": (sum(user.expected_waiting_time for user in served) + completed["waiting time"]) / count
+            if count else 0,
+            "detour ratio": (sum(user.expected_travel_time / user.shortest_time for user in served)
+                             + completed["detour ratio"]) / count if count else 0,
+            "objective": system.objective(penalty) - completed["seats"]}
+
+
+def bench_engines(planner, call_path, veh_path, step, penalty, detour, search_time):
+    call, veh = read_inputs(call_path, veh_path)
+
+    # one system per engine, both replay the same calls and vehicles
+    systems = {"milp": System(logger), "insertion": System(logger)}
+    for system in systems.values():
+        system.set_planner(planner)
+
+    result = {"time": [],
+              "users": [],
+              "vehicles": [],
+              "milp (s)": [],
+              "insertion (s)": [],
+              "milp objective": [],
+              "insertion objective": [],
+              "gap (%)": []}
+    for now, call_, veh_ in cycles(call, veh, step):
+        for engine, system in systems.items():
+            arrive(system, now, call_, veh_, detour)
+
+            start_time = time.perf_counter()
+            if engine == "milp":
+                system.opt(penalty, detour)
+            else:
+                system.insert(detour, search_time)
+            result[engine + " (s)"].append(round(time.perf_counter() - start_time, 4))
+            result[engine + " objective"].append(kpis(system, penalty)["objective"])
+
+        # positive when the heuristic is worse, the objectives are minimized and counted after the detour repair
+        milp = result["milp objective"][-1]
+        gap = result["insertion objective"][-1] - milp
+        result["time"].append(now.strftime("%H:%M:%S"))
+        result["users"].append(len(systems["milp"].users))
+        result["vehicles"].append(len(systems["milp"].vehicles))
+        result["gap (%)"].append(round(100 * gap / abs(milp), 2) if milp != 0 else 0.0)
+
+    print("[Insertion heuristic against the MILP]")
+    print(tabulate(result, headers="keys", tablefmt="fancy_grid"))
+
+
+def bench_zones(planner, args):
+    start = datetime.datetime.strptime(args.start, TIME_FORMAT)
+    call, veh = synthetic_inputs(planner.node_ids(), args.rate, args.fleet, args.duration, args.seed, start,
+                                 args.working_time, args.capacity)
+
+    # the single model and the zone models replay the same calls and vehicles
+    systems = {"single": System(logger, rolling=args.rolling), "zones": System(logger, rolling=args.rolling)}
+    for system in systems.values():
+        system.set_planner(planner)
+    systems["zones"].set_zoning(Zoning(planner, args.zones, args.partition), args.workers)
+
+    result = {"time": [],
+              "users": [],
+              "vehicles": [],
+              "single (s)": [],
+              "zones (s)": [],
+              "single objective": [],
+              "zones objective": [],
+              "gap (%)": []}
+    for now, call_, veh_ in cycles(call, veh, args.step):
+        for name, system in systems.items():
+            arrive(system, now, call_, veh_, args.detour)
+            start_time = time.perf_counter()
+            system.opt(args.penalty, args.detour)
+            result[name + " (s)"].append(round(time.perf_counter() - start_time, 4))
+            result[name + " objective"].append(kpis(system, args.penalty)["objective"])
+
+        # positive when the zones are worse
+        single = result["single objective"][-1]
+        gap = result["zones objective"][-1] - single
+        result["time"].append(now.strftime("%H:%M:%S"))
+        result["users"].append(len(systems["single"].users))
+        result["vehicles"].append(len(systems["single"].vehicles))
+        result["gap (%)"].append(round(100 * gap / abs(single), 2) if single != 0 else 0.0)
+    systems["zones"].close()
+
+    print("[%s %s zones, %s workers against the single model]" % (args.zones, args.partition, args.workers))
+    print(tabulate(result, headers="keys", tablefmt="fancy_grid"))
+    print("Wall time %.2f s against %.2f s, objective %s against %s."
+          % (sum(result["zones (s)"]), sum(result["single (s)"]),
+             result["zones objective"][-1], result["single objective"][-1]))
+
+
+def bench_dispatch(planner, args):
+    start = datetime.datetime.strptime(args.start, TIME_FORMAT)
+    call, veh = synthetic_inputs(planner.node_ids(), args.rate, args.fleet, args.duration, args.seed, start,
+                                 args.working_time, args.capacity)
+    if args.inputs is not None:
+        # the same scenario can be replayed with main.py --replay
+        os.makedirs(args.inputs, exist_ok=True)
+        call.to_csv(os.path.join(args.inputs, "call.csv"), index=False, date_format=TIME_FORMAT)
+        veh.to_csv(os.path.join(args.inputs, "veh.csv"), index=False, date_format=TIME_FORMAT)
+
+    system = System(logger, rolling=args.rolling, radius=args.radius)
+    system.set_planner(planner)
+    system.set_solver(args.time_limit, args.mip_gap)
+
+    records = []
+    with open(args.output, "w") as f:
+        for cycle, (now, call_, veh_) in enumerate(cycles(call, veh, args.step)):
+            system.reset_timings()
+            start_time = time.perf_counter()
+            arrive(system, now, call_, veh_, args.detour)
+            if args.engine == "milp":
+                system.opt(args.penalty, args.detour)
+            else:
+                system.insert(args.detour, args.search_time)
+            elapsed = time.perf_counter() - start_time
+
+            service = kpis(system, args.penalty)
+            record = {"cycle": cycle,
+                      "time": now.strftime(TIME_FORMAT),
+                      "calls": len(call_),
+                      "users": len(system.users),
+                      "vehicles": len(system.vehicles),
+                      "stops": len(system.stops),
+                      "cached costs": system.distance.stats()["size"],
+                      **{phase: round(seconds, 6) for phase, seconds in system.timings.items()},
+                      "total": round(elapsed, 6),
+                      "real time": elapsed <= args.step,
+                      "served": service["served"],
+                      "waiting time": service["waiting time"],
+                      "detour ratio": service["detour ratio"],
+                      "objective": service["objective"]}
+            f.write(json.dumps(record) + "\n")
+            records.append(record)
+
+    summary = {"": ["mean (s)", "max (s)"]}
+    for phase in list(system.timings) + ["total"]:
+        summary[phase] = [round(np.mean([r[phase] for r in records]), 4), round(max(r[phase] for r in records), 4)]
+    print("[%s cycles, %s calls, %s vehicles, %s engine]" % (len(records), len(call), len(veh), args.engine))
+    print(tabulate(summary, headers="keys", tablefmt="fancy_grid"))
+    print("%s of %s cycles took longer than the %s s step, per-cycle records are in %s."
+          % (sum(not r["real time"] for r in records), len(records), args.step, args.output))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmarks of the routing planner and the dispatcher")
+    parser.add_argument("-w", "--weight", type=int, default=[0, 1, 0], nargs=3, help="alpha, beta, gamma")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    threads_parser = subparsers.add_parser("threads", help="cost matrix throughput against the number of threads")
+    threads_parser.add_argument("-n", "--size", type=int, default=500, help="number of sources and targets")
+    threads_parser.add_argument("-t", "--max-threads", type=int, default=os.cpu_count(), help="largest thread count")
+    threads_parser.add_argument("-s", "--seed", type=int, default=0, help="random seed")
+
+    queries_parser = subparsers.add_parser("queries", help="point queries after their reverse against the cost matrix")
+    queries_parser.add_argument("-n", "--size", type=int, default=500, help="number of pairs")
+    queries_parser.add_argument("-s", "--seed", type=int, default=0, help="random seed")
+
+    memory_parser = subparsers.add_parser("memory", help="bytes held per user and per vehicle")
+    memory_parser.add_argument("-n", "--size", type=int, default=100000, help="number of users")
+    memory_parser.add_argument("--route-length", type=int, default=10, help="stops per vehicle route")
+
+    engines_parser = subparsers.add_parser("engines", help="latency and objective of the insertion heuristic "
+                                                           "against the MILP on the same inputs")
+    engines_parser.add_argument("--calls", type=str, default="./input/call-test.csv", help="passenger calls")
+    engines_parser.add_argument("--vehicles", type=str, default="./input/veh-test.csv", help="vehicles")
+    engines_parser.add_argument("--step", type=int, default=60, help="seconds between dispatch cycles")
+    engines_parser.add_argument("-p", "--penalty", type=int, default=10, help="penalty for unvisited stations")
+    engines_parser.add_argument("-d", "--detour", type=float, default=1.5, help="detour ratio")
+    engines_parser.add_argument("--search-time", type=float, default=0, help="seconds of local search")
+
+    zones_parser = subparsers.add_parser("zones", help="wall time and objective of the zone models "
+                                                       "against the single model on synthetic demand")
+    zones_parser.add_argument("-z", "--zones", type=int, default=4, help="number of zones")
+    zones_parser.add_argument("--partition", type=str, default="grid", choices=SCHEMES, help="zoning scheme")
+    zones_parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes of the zones")
+    zones_parser.add_argument("-r", "--rate", type=float, default=2, help="calls per minute")
+    zones_parser.add_argument("-f", "--fleet", type=int, default=8, help="number of vehicles")
+    zones_parser.add_argument("--duration", type=float, default=10, help="minutes of calls")
+    zones_parser.add_argument("--start", type=str, default="2024/08/16 00:00:00", help="first call time")
+    zones_parser.add_argument("--working-time", type=int, default=10800, help="working time of the vehicles")
+    zones_parser.add_argument("--capacity", type=int, default=6, help="capacity of the vehicles")
+    zones_parser.add_argument("--step", type=int, default=60, help="seconds between dispatch cycles")
+    zones_parser.add_argument("-p", "--penalty", type=int, default=10, help="penalty for unvisited stations")
+    zones_parser.add_argument("-d", "--detour", type=float, default=1.5, help="detour ratio")
+    zones_parser.add_argument("--rolling", action="store_true", help="rolling-horizon dispatch")
+    zones_parser.add_argument("-s", "--seed", type=int, default=0, help="random seed")
+
+    dispatch_parser = subparsers.add_parser("dispatch", help="end-to-end dispatch cycles on synthetic demand")
+    dispatch_parser.add_argument("-r", "--rate", type=float, default=2, help="calls per minute")
+    dispatch_parser.add_argument("-f", "--fleet", type=int, default=5, help="number of vehicles")
+    dispatch_parser.add_argument("--duration", type=float, default=10, help="minutes of calls")
+    dispatch_parser.add_argument("--start", type=str, default="2024/08/16 00:00:00", help="first call time")
+    dispatch_parser.add_argument("--working-time", type=int, default=10800, help="working time of the vehicles")
+    dispatch_parser.add_argument("--capacity", type=int, default=6, help="capacity of the vehicles")
+    dispatch_parser.add_argument("--step", type=int, default=60, help="seconds between dispatch cycles")
+    dispatch_parser.add_argument("-p", "--penalty", type=int, default=10, help="penalty for unvisited stations")
+    dispatch_parser.add_argument("-d", "--detour", type=float, default=1.5, help="detour ratio")
+    dispatch_parser.add_argument("--engine", type=str, default="milp", choices=["milp", "insertion"])
+    dispatch_parser.add_argument("--search-time", type=float, default=0, help="seconds of local search")
+    dispatch_parser.add_argument("--time-limit", type=float, default=None, help="seconds the MILP may take per cycle")
+    dispatch_parser.add_argument("--mip-gap", type=float, default=None, help="relative MIP gap of the MILP")
+    dispatch_parser.add_argument("-s", "--seed", type=int, default=0, help="random seed")
+    dispatch_parser.add_argument("--rolling", action="store_true", help="rolling-horizon dispatch")
+    dispatch_parser.add_argument("--radius", type=float, default=None,
+                                 help="exact costs only between the locations within this distance (m)")
+    dispatch_parser.add_argument("-o", "--output", type=str, default="./dispatch-bench.jsonl",
+                                 help="per-cycle timings and service metrics (JSON lines)")
+    dispatch_parser.add_argument("--inputs", type=str, default=None,
+                                 help="directory to save the generated call.csv and veh.csv")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "memory":
+        bench_memory(args.size, args.route_length)
+    else:
+        planner = RoutingPlanner(args.weight[0], args.weight[1], args.weight[2])
+
+        if args.benchmark == "threads":
+            bench_threads(planner, args.size, args.max_threads, args.seed)
+        elif args.benchmark == "queries":
+            bench_queries(planner, args.size, args.seed)
+        elif args.benchmark == "engines":
+            bench_engines(planner, args.calls, args.vehicles, args.step, args.penalty, args.detour, args.search_time)
+        elif args.benchmark == "zones":
+            bench_zones(planner, args)
+        elif args.benchmark == "dispatch":
+            bench_dispatch(planner, args)
@@ -0,0 +1,91 @@
+# built-in
+import os
+import json
+import numpy as np
+from collections import OrderedDict
+
+# format of the warm-start file, bumped when its layout changes
+VERSION = 1
+
+
+# bounded least-recently-used store of pair costs
+# (from node, to node) is packed into one integer key and the keys are kept in recency order,
+# so the least recently used entry is always the first one
+class DistanceCache:
+    def __init__(self, capacity, logger=None):
+        super(DistanceCache, self).__init__()
+        self.capacity = capacity
+        self.store = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.logger = logger
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, pair):
+        return self.key(*pair) in self.store
+
+    @staticmethod
+    def key(frm, to):
+        return (int(frm) << 32) | int(to)
+
+    # GET
+    def get(self, frm, to):
+        key = self.key(frm, to)
+        value = self.store.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.store.move_to_end(key)     # the most recently used entry goes last
+        return value
+
+    def stats(self):
+        return {"size": len(self.store),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+    # SET
+    def put(self, frm, to, value):
+        key = self.key(frm, to)
+        self.store[key] = value
+        self.store.move_to_end(key)
+        while len(self.store) > self.capacity:
+            self.store.popitem(last=False)
+            self.evictions += 1
+
+    # FILE
+    def load(self, path, signature=None):
+        # signature: weights and road network the costs were computed with, the file is skipped if they differ
+        if path is None or not os.path.exists(path):
+            return
+        expected = json.dumps(dict(signature or {}, version=VERSION), sort_keys=True)
+        with np.load(path) as data:
+            found = str(data["signature"]) if "signature" in data else None
+            if found != expected:
+                if self.logger is not None:
+                    self.logger.warning("The distances in %s are skipped, they were computed for %s and not %s.",
+                                        path, found, expected)
+                return
+            keys, values = data["keys"].tolist(), data["values"].tolist()
+        for key, value in zip(keys, values):
+            self.store[key] = value
+        while len(self.store) > self.capacity:
+            self.store.popitem(last=False)
+        if self.logger is not None:
+            self.logger.info("%s distances are loaded from %s.", len(self.store), path)
+
+    def save(self, path, signature=None):
+        if path is None:
+            return
+        # keep the recency order, the oldest entries are evicted first after a warm start
+        with open(path, "wb") as f:
+            np.savez(f,
+                     signature=np.array(json.dumps(dict(signature or {}, version=VERSION), sort_keys=True)),
+                     keys=np.fromiter(self.store.keys(), dtype=np.int64, count=len(self.store)),
+                     values=np.fromiter(self.store.values(), dtype=np.float64, count=len(self.store)))
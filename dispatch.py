@@ -0,0 +1,455 @@
+# built-in
+import math
+import time
+import itertools
+import numpy as np
+
+# solver
+import gurobipy as gp
+from gurobipy import GRB
+
+# artificial depot, every route ends there
+DEPOT = (0, 0)
+
+
+# pickup and delivery model kept alive across dispatch cycles
+# stops are keyed by (location, user or vehicle) and vehicles by their objects, so every cycle only adds the variables
+# and constraints of new stops and vehicles and removes those of the ones that left the system
+class DispatchModel:
+    def __init__(self, logger):
+        super(DispatchModel, self).__init__()
+        self.m = gp.Model()
+        self.m.Params.outputFlag = False
+        self.m.Params.lazyConstraints = 1
+
+        self.kind = {}          # stop -> "depot", "origin", "pickup" or "dropoff"
+        self.vehicles = []
+        self.users = {}         # users in the order they were added, as keys
+        self.penalty = None
+        self.detour = None
+        self.cost = None        # cost between two locations
+        self.big_m = 16         # upper bound of the sequences, doubled whenever the stops outgrow it
+
+        # edges of the current solve as arrays of stop and vehicle positions, read by the subtour callback
+        self.tails = None
+        self.heads = None
+        self.fleet = None
+        self.depot = 0
+        self.callbacks = 0      # MIPSOL callbacks of the last solve
+        self.callback_time = 0  # ... and the seconds spent in them
+
+        # variables
+        self.e = {}             # (i, j, v) edges
+        self.p = {}             # (i, v) passengers
+        self.pty = {}           # i penalties
+        self.s = {}             # i sequences
+        self.incident = {}      # stop or vehicle -> keys of its edges
+
+        # constraints
+        self.cons2 = {}         # (i, v) outgoing edge of a visited stop
+        self.cons3 = {}         # (j, v) ingoing edge of a visited stop
+        self.cons4 = {}         # v      ingoing edge of the depot
+        self.cons5 = {}         # v      outgoing edge of the origin
+        self.cons6 = {}         # v      working time limit
+        self.cons7 = {}         # v      capacity limit
+        self.cons8 = {}         # i      penalty
+        self.cons9 = {}         # (u, v) pickup-dropoff pairs
+        self.cons10_1 = {}      # (i, j, v) sequences along the edges
+        self.cons10_2 = {}      # u      pickup before dropoff
+
+        self.fixed = []         # keys of the variables fixed to 1 in the current cycle only
+
+        self.added = 0
+        self.removed = 0
+        self.candidates = 0     # edges of the new stops and vehicles before pruning
+        self.kept = 0           # ... and after
+
+        self.logger = logger
+
+    # GET
+    def origin(self, v):
+        return v.origin, v
+
+    def bound(self, frm, to):
+        # lower bound of the cost between two locations, 0 for the pairs pruned by the radius
+        c = self.cost(frm, to)
+        return c if c < math.inf else 0
+
+    def is_edge(self, i, j, v, c):
+        kind_i, kind_j = self.kind[i], self.kind[j]
+
+        # nothing leaves the depot, nothing enters an origin and an origin is only left by its own vehicle
+        if kind_i == "depot" or kind_j == "origin":
+            return False
+        if kind_i == "origin" and i != self.origin(v):
+            return False
+        # a pickup is followed by its dropoff, which is never followed by the pickup of the same user
+        if kind_i == "pickup" and kind_j == "depot":
+            return False
+        if kind_i == "dropoff" and kind_j == "pickup" and i[1] is j[1]:
+            return False
+
+        # the users of both stops fit in the vehicle together
+        users = {x[1] for x in (i, j) if self.kind[x] in ("pickup", "dropoff")}
+        if sum(user.cap for user in users) > v.capacity:
+            return False
+        # the vehicle reaches j through i within the working time left at its origin
+        if self.bound(v.origin, i[0]) + c > v.working_time - v.offset:
+            return False
+        # the ride of a user through j, or through i, is within the detour ratio
+        if kind_i == "pickup" and j != (i[1].do, i[1]):
+            if c + self.bound(j[0], i[1].do) > self.detour * i[1].shortest_time:
+                return False
+        if kind_j == "dropoff" and i != (j[1].pu, j[1]):
+            if self.bound(j[1].pu, i[0]) + c > self.detour * j[1].shortest_time:
+                return False
+        return True
+
+    def routes(self):
+        sol = {v: {} for v in self.vehicles}
+        keys = list(self.e.keys())
+        for (i, j, v), x in zip(keys, self.m.getAttr("X", [self.e[key] for key in keys])):
+            if x > 0.5:
+                sol[v][i] = j
+        return sol
+
+    # SET
+    def update(self, stops, vehicles, users, cost, penalty, detour):
+        start = time.time()
+        self.added = 0
+        self.removed = 0
+        self.candidates = 0
+        self.kept = 0
+        self.cost = cost
+        self.detour = detour
+
+        vehicles = list(vehicles)
+        users = list(users)
+        current = set(stops)
+
+        # removed vehicles, users and stops
+        fleet = set(vehicles)
+        garbage = []
+        for v in [v for v in self.vehicles if v not in fleet]:
+            self.remove_vehicle(v, garbage)
+        active = set(users)
+        for user in [user for user in self.users if user not in active]:
+            self.remove_user(user, garbage)
+        for i in [i for i in self.kind if i not in current]:
+            self.remove_stop(i, garbage)
+        self.removed = len(garbage)
+        self.m.remove(garbage)
+
+        # penalty may change between cycles
+        if penalty != self.penalty:
+            for var in self.pty.values():
+                var.Obj = penalty
+            self.penalty = penalty
+
+        # new vehicles, users and stops
+        old_stops = list(self.kind)
+        new_stops = [i for i in stops if i not in self.kind]
+        new_vehicles = [v for v in vehicles if v not in self.cons6]
+        new_users = [user for user in users if user not in self.users]
+        for i in new_stops:
+            loc, user = i
+            if i == DEPOT:
+                self.kind[i] = "depot"
+            elif user in fleet:
+                self.kind[i] = "origin"
+            elif user.pu == loc:
+                self.kind[i] = "pickup"
+            else:
+                self.kind[i] = "dropoff"
+        self.vehicles += new_vehicles
+        self.users.update(dict.fromkeys(new_users))
+
+        self.add_stops(new_stops)
+        self.add_vehicles(new_vehicles, old_stops)
+        self.add_users(new_users, new_vehicles)
+        self.add_edges(new_stops, new_vehicles)
+
+        self.m.update()
+        self.logger.info("Model updated in %.3f s (%s of %s new edges kept, %s variables and constraints added, "
+                         "%s removed, %s variables, %s constraints).",
+                         time.time() - start, self.kept, self.candidates, self.added, self.removed,
+                         self.m.NumVars, self.m.NumConstrs)
+
+    def add_stops(self, new_stops):
+        m = self.m
+        for i in new_stops:
+            if self.kind[i] != "depot":
+                self.pty[i] = m.addVar(obj=self.penalty, vtype=GRB.BINARY)
+                self.s[i] = m.addVar(lb=1, ub=self.big_m, vtype=GRB.INTEGER)
+                self.added += 2
+            for v in self.vehicles:
+                self.add_visit(i, v)
+            if self.kind[i] != "depot":
+                # Constraint 8: penalty
+                self.cons8[i] = m.addConstr(self.pty[i] + gp.quicksum(self.p[i, v] for v in self.vehicles) == 1)
+                self.added += 1
+
+        # the sequences must be able to order every stop
+        if len(self.s) > self.big_m:
+            while len(self.s) > self.big_m:
+                self.big_m *= 2
+            for var in self.s.values():
+                var.UB = self.big_m
+            for (i, j, v), constr in self.cons10_1.items():
+                m.chgCoeff(constr, self.e[i, j, v], self.big_m)
+                constr.RHS = self.big_m - 1
+
+    def add_vehicles(self, new_vehicles, old_stops):
+        m = self.m
+        for v in new_vehicles:
+            for i in old_stops:
+                self.add_visit(i, v)
+                if i in self.cons8:
+                    m.chgCoeff(self.cons8[i], self.p[i, v], 1)
+            # Constraint 4: considering the depot, completed by the edges.
+            self.cons4[v] = m.addConstr(gp.LinExpr() == 1)
+            # Constraint 5: fixed initial positions, completed by the edges.
+            self.cons5[v] = m.addConstr(-1 * self.p[self.origin(v), v] == 0)
+            # Constraint 6: working time limit, completed by the edges.
+            self.cons6[v] = m.addConstr(gp.LinExpr() <= v.working_time)
+            # Constraint 7: capacity limit
+            self.cons7[v] = m.addConstr(gp.quicksum(i[1].cap * self.p[i, v]
+                                                    for i, kind in self.kind.items() if kind == "pickup")
+                                        <= v.capacity)
+            # Constraint 9: pickup-dropoff pairs of the users already in the model
+            for user in self.users:
+                self.add_pair(user, v)
+            self.added += 4
+
+    def add_users(self, new_users, new_vehicles):
+        m = self.m
+        for user in new_users:
+            for v in self.vehicles:
+                if v not in new_vehicles:
+                    self.add_pair(user, v)
+            # Constraint 10: pickup before dropoff
+            self.cons10_2[user] = m.addConstr(self.s[user.pu, user] + 1 <= self.s[user.do, user])
+            self.added += 1
+
+    def add_visit(self, i, v):
+        # the depot and the origin of the vehicle are always visited
+        lb = 1 if i == DEPOT or i == self.origin(v) else 0
+        obj = -1 * i[1].cap if self.kind[i] == "pickup" else 0
+        self.p[i, v] = self.m.addVar(lb=lb, obj=obj, vtype=GRB.BINARY)
+        self.added += 1
+        if i == self.origin(v) and v in self.cons5:
+            # the origin of the vehicle moved forward
+            self.m.chgCoeff(self.cons5[v], self.p[i, v], -1)
+        if self.kind[i] in ("pickup", "dropoff"):
+            # Constraint 2, 3: a visited stop must have an outgoing and an ingoing edge, completed by the edges.
+            self.cons2[i, v] = self.m.addConstr(-1 * self.p[i, v] == 0)
+            self.cons3[i, v] = self.m.addConstr(-1 * self.p[i, v] == 0)
+            self.added += 2
+            if v in self.cons7 and self.kind[i] == "pickup":
+                self.m.chgCoeff(self.cons7[v], self.p[i, v], i[1].cap)
+
+    def add_pair(self, user, v):
+        self.cons9[user, v] = self.m.addConstr(self.p[(user.pu, user), v] == self.p[(user.do, user), v])
+        self.added += 1
+
+    def add_edges(self, new_stops, new_vehicles):
+        stops = list(self.kind)
+        new = set(new_stops)
+        old = [i for i in stops if i not in new]
+
+        # edges touching a new stop, for every vehicle
+        for i, j in itertools.chain(itertools.product(new_stops, stops), itertools.product(old, new_stops)):
+            if i != j:
+                c = self.cost(i[0], j[0])
+                self.candidates += len(self.vehicles)
+                for v in self.vehicles:
+                    if self.is_edge(i, j, v, c):
+                        self.add_edge(i, j, v, c)
+        # edges between the old stops, for the new vehicles
+        for i, j in itertools.product(old, old):
+            if i != j:
+                c = self.cost(i[0], j[0])
+                self.candidates += len(new_vehicles)
+                for v in new_vehicles:
+                    if self.is_edge(i, j, v, c):
+                        self.add_edge(i, j, v, c)
+
+    def add_edge(self, i, j, v, c):
+        m = self.m
+        constrs = [self.cons6[v]]
+        coeffs = [c]
+        if (i, v) in self.cons2:
+            constrs.append(self.cons2[i, v])
+            coeffs.append(1)
+        if (j, v) in self.cons3:
+            constrs.append(self.cons3[j, v])
+            coeffs.append(1)
+        if j == DEPOT:
+            constrs.append(self.cons4[v])
+            coeffs.append(1)
+        if i == self.origin(v):
+            constrs.append(self.cons5[v])
+            coeffs.append(1)
+
+        key = (i, j, v)
+        var = m.addVar(vtype=GRB.BINARY, column=gp.Column(coeffs, constrs))
+        self.e[key] = var
+        self.added += 1
+        self.kept += 1
+        for x in key:
+            self.incident.setdefault(x, set()).add(key)
+
+        # Constraint 10: sequences
+        if j != DEPOT:
+            self.cons10_1[key] = m.addConstr(self.s[i] - self.s[j] + self.big_m * var <= self.big_m - 1)
+            self.added += 1
+
+    def fix(self, vehicles):
+        for family, key in self.fixed:
+            if key in family:
+                family[key].LB = 0
+        self.fixed = []
+
+        for v in vehicles:
+            # the working time and the seats left after the committed prefix of the route
+            self.cons6[v].RHS = v.working_time - v.offset
+            self.cons7[v].RHS = v.capacity - sum(user.cap for user in v.riding)
+            for user in v.on_board:
+                # the riding users are only left with their dropoffs
+                key = ((user.do, user) if user in v.riding else (user.pu, user), v)
+                if key in self.p:
+                    self.p[key].LB = 1
+                    self.fixed.append((self.p, key))
+            # the current route stays representable even if the repair after the last solve joined pruned stops
+            stops = [(loc, u) for loc, u, _ in v.route] + [DEPOT]
+            for i, j in zip(stops[:-1], stops[1:]):
+                if (i, j, v) not in self.e and i in self.kind and j in self.kind:
+                    self.add_edge(i, j, v, self.cost(i[0], j[0]))
+            if v.next_loc is not None:
+                key = (v.here, v.next_loc, v)
+                if key in self.e:
+                    self.e[key].LB = 1
+                    self.fixed.append((self.e, key))
+
+    # REMOVE
+    def pop(self, family, key, garbage):
+        if key in family:
+            garbage.append(family.pop(key))
+
+    def remove_edges(self, x, garbage):
+        for key in self.incident.pop(x, ()):
+            for y in key:
+                if y != x and y in self.incident:
+                    self.incident[y].discard(key)
+            self.pop(self.e, key, garbage)
+            self.pop(self.cons10_1, key, garbage)
+
+    def remove_vehicle(self, v, garbage):
+        self.remove_edges(v, garbage)
+        for i in self.kind:
+            for family in (self.p, self.cons2, self.cons3):
+                self.pop(family, (i, v), garbage)
+        for family in (self.cons4, self.cons5, self.cons6, self.cons7):
+            self.pop(family, v, garbage)
+        for user in self.users:
+            self.pop(self.cons9, (user, v), garbage)
+        self.vehicles.remove(v)
+
+    def remove_user(self, user, garbage):
+        for v in self.vehicles:
+            self.pop(self.cons9, (user, v), garbage)
+        self.pop(self.cons10_2, user, garbage)
+        del self.users[user]
+
+    def remove_stop(self, i, garbage):
+        self.remove_edges(i, garbage)
+        for v in self.vehicles:
+            for family in (self.p, self.cons2, self.cons3):
+                self.pop(family, (i, v), garbage)
+        for family in (self.pty, self.s, self.cons8):
+            self.pop(family, i, garbage)
+        del self.kind[i]
+
+    def set_params(self, time_limit=None, mip_gap=None, threads=None):
+        # None keeps the default of Gurobi
+        if time_limit is not None:
+            self.m.Params.TimeLimit = time_limit
+        if mip_gap is not None:
+            self.m.Params.MIPGap = mip_gap
+        if threads is not None:
+            self.m.Params.Threads = threads
+
+    def write_iis(self, path):
+        self.m.computeIIS()
+        self.m.write(path)
+
+    # SOLVE
+    def warm_start(self, routes=None):
+        # routes: vehicle -> stops from its origin as the MIP start, the current routes if None
+        # the stops on no route start unvisited
+        edges = set()
+        visits = set()
+        sequences = {}
+        for v in self.vehicles:
+            stops = [(loc, u) for loc, u, _ in v.route] if routes is None else routes[v]
+            stops = [self.origin(v)] + [i for i in stops if i in self.kind and self.kind[i] in ("pickup", "dropoff")]
+            for k, i in enumerate(stops):
+                visits.add((i, v))
+                sequences[i] = k + 1
+            visits.add((DEPOT, v))
+            edges.update((i, j, v) for i, j in zip(stops, stops[1:] + [DEPOT]))
+
+        m = self.m
+        m.setAttr("Start", list(self.e.values()), [1 if key in edges else 0 for key in self.e])
+        m.setAttr("Start", list(self.p.values()), [1 if key in visits else 0 for key in self.p])
+        m.setAttr("Start", list(self.pty.values()), [0 if i in sequences else 1 for i in self.pty])
+        m.setAttr("Start", list(self.s.values()), [sequences.get(i, GRB.UNDEFINED) for i in self.s])
+
+    def solve(self, routes=None):
+        m = self.m
+        self.warm_start(routes)
+
+        m._keys = list(self.e.keys())
+        m._vars = [self.e[key] for key in m._keys]
+        position = {i: k for k, i in enumerate(self.kind)}
+        fleet = {v: k for k, v in enumerate(self.vehicles)}
+        self.tails = np.fromiter((position[i] for i, j, v in m._keys), dtype=np.int64, count=len(m._keys))
+        self.heads = np.fromiter((position[j] for i, j, v in m._keys), dtype=np.int64, count=len(m._keys))
+        self.fleet = np.fromiter((fleet[v] for i, j, v in m._keys), dtype=np.int64, count=len(m._keys))
+        self.depot = position[DEPOT]
+        self.callbacks = 0
+        self.callback_time = 0
+        m.optimize(self.subtourlim)
+        return m.status
+
+    def subtourlim(self, model, where):
+        if where == GRB.Callback.MIPSOL:
+            start = time.perf_counter()
+            selected = np.asarray(model.cbGetSolution(model._vars)) > 0.5
+            for cycle in self.subtour(selected):
+                # add subtour elimination constraint for every pair of stops in the cycle, for its vehicle
+                inside = np.isin(self.tails, cycle) & np.isin(self.heads, cycle)
+                for v in np.unique(self.fleet[inside & selected]):
+                    edges = np.flatnonzero(inside & (self.fleet == v))
+                    model.cbLazy(gp.quicksum(model._vars[k] for k in edges) <= len(cycle) - 1)
+            self.callbacks += 1
+            self.callback_time += time.perf_counter() - start
+
+    def subtour(self, selected):
+        # every stop has at most one selected outgoing and ingoing edge, so the solution is made of routes ending at
+        # the depot and of cycles, the stops on a cycle never reach the end of a route
+        n = len(self.kind)
+        successor = np.full(n + 1, n, dtype=np.int64)   # n is the end of every route
+        successor[self.tails[selected]] = self.heads[selected]
+        successor[self.depot] = n
+
+        # pointer doubling, after log2(n) rounds every stop has jumped n stops ahead and carries the smallest
+        # position it passed, the same for every stop of a cycle
+        jump = successor
+        label = np.arange(n + 1)
+        for _ in range(int(np.ceil(np.log2(n + 1))) + 1):
+            label = np.minimum(label, label[jump])
+            jump = jump[jump]
+
+        on_cycle = np.flatnonzero(jump[:n] != n)
+        return [on_cycle[label[on_cycle] == first] for first in np.unique(label[on_cycle])]
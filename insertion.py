@@ -0,0 +1,181 @@
+# built-in
+import time
+
+
+# cheapest insertion of pickup and dropoff pairs into the vehicle routes
+# a route is the list of its stops (location, user or vehicle) from the origin of the vehicle, and nothing is inserted
+# before its frozen stops, the ones already passed and the one the vehicle is heading to
+class Insertion:
+    def __init__(self, cost, detour):
+        super(Insertion, self).__init__()
+        self.cost = cost            # cost between two locations
+        self.detour = detour
+
+        self.routes = {}            # vehicle -> stops
+        self.frozen = {}            # vehicle -> number of committed stops
+        self.length = {}            # vehicle -> cost of the route
+        self.owner = {}             # user -> vehicle, for the users inserted by this heuristic
+
+    # GET
+    def times(self, stops):
+        times = [0]
+        for frm, to in zip(stops[:-1], stops[1:]):
+            times.append(times[-1] + self.cost(frm[0], to[0]))
+        return times
+
+    def ratios(self, stops, times):
+        pickup = {}
+        ratio = {}
+        for (loc, user), tt in zip(stops[1:], times[1:]):
+            if user not in pickup:
+                pickup[user] = tt
+            elif user.shortest_time > 0:
+                ratio[user] = (tt - pickup[user]) / user.shortest_time
+        return ratio
+
+    def load(self, stops):
+        return sum(user.cap for user in {user for _, user in stops[1:]})
+
+    def total(self):
+        return sum(self.length.values())
+
+    def is_feasible(self, v, stops, times, before):
+        if times[-1] > v.working_time - v.offset:
+            return False
+        # a user already over the detour ratio may not get a longer ride
+        for user, ratio in self.ratios(stops, times).items():
+            if ratio > max(self.detour, before.get(user, 0)):
+                return False
+        return True
+
+    def best_insertion(self, v, stops, user):
+        if self.load(stops) + user.cap > v.capacity:
+            return None
+
+        # the costs between the stops and the new pickup and dropoff are looked up once, every candidate position
+        # then only shifts the base times of the stops after the pickup and after the dropoff
+        base = self.times(stops)
+        before = self.ratios(stops, base)
+        n = len(stops)
+        to_pu = [self.cost(loc, user.pu) for loc, _ in stops]
+        from_pu = [self.cost(user.pu, loc) for loc, _ in stops]
+        to_do = [self.cost(loc, user.do) for loc, _ in stops]
+        from_do = [self.cost(user.do, loc) for loc, _ in stops]
+        direct = self.cost(user.pu, user.do)
+
+        # positions of the pickup and dropoff of the users with both in the route, and their ratio limits
+        first = {}
+        pairs = []
+        for k, (loc, u) in enumerate(stops[1:], 1):
+            if u not in first:
+                first[u] = k
+            elif u.shortest_time > 0:
+                pairs.append((first[u], k, u.shortest_time, max(self.detour, before.get(u, 0))))
+        limit = v.working_time - v.offset
+
+        best = None
+        for i in range(max(self.frozen[v], 1), n + 1):
+            t_pu = base[i - 1] + to_pu[i - 1]
+            inner = t_pu + from_pu[i] - base[i] if i < n else 0       # shift of the stops between the pair
+            for j in range(i, n + 1):
+                t_do = t_pu + direct if j == i else base[j - 1] + inner + to_do[j - 1]
+                outer = t_do + from_do[j] - base[j] if j < n else 0   # shift of the stops after the dropoff
+                end = t_do if j == n else base[-1] + outer
+                if best is not None and end >= best[2]:
+                    continue
+                if end > limit:
+                    continue
+                if user.shortest_time > 0 and (t_do - t_pu) / user.shortest_time > self.detour:
+                    continue
+                if all((base[q] - base[p] + (self.shift(q, i, j, inner, outer) - self.shift(p, i, j, inner, outer)))
+                       / shortest <= ratio for p, q, shortest, ratio in pairs):
+                    best = (i, j, end)
+        if best is None:
+            return None
+        i, j, end = best
+        return stops[:i] + [(user.pu, user)] + stops[i:j] + [(user.do, user)] + stops[j:], end
+
+    @staticmethod
+    def shift(k, i, j, inner, outer):
+        # how much later stop k is reached with the pickup inserted before stop i and the dropoff before stop j
+        if k < i:
+            return 0
+        return inner if k < j else outer
+
+    # SET
+    def add_route(self, v, stops, frozen):
+        self.routes[v] = stops
+        self.frozen[v] = frozen
+        self.length[v] = self.times(stops)[-1]
+
+    def apply(self, v, user, stops, length):
+        self.routes[v] = stops
+        self.length[v] = length
+        self.owner[user] = v
+
+    def remove(self, v, user):
+        stops = [stop for stop in self.routes[v] if stop[1] is not user]
+        return stops, self.times(stops)[-1]
+
+    def insert(self, users):
+        # every user goes to the vehicle with the smallest added cost, unassignable users are returned
+        unassigned = []
+        for user in users:
+            best = None
+            for v, stops in self.routes.items():
+                res = self.best_insertion(v, stops, user)
+                if res is not None and (best is None or res[1] - self.length[v] < best[3]):
+                    best = (v, res[0], res[1], res[1] - self.length[v])
+            if best is None:
+                unassigned.append(user)
+            else:
+                self.apply(best[0], user, best[1], best[2])
+        return unassigned
+
+    # LOCAL SEARCH
+    def search(self, unassigned, deadline):
+        # relocate and exchange the inserted users while the total route cost improves, then retry the rest
+        improved = True
+        while improved and time.time() < deadline:
+            improved = self.relocate(deadline) or self.exchange(deadline)
+        return self.insert(unassigned)
+
+    def relocate(self, deadline):
+        for user, v in list(self.owner.items()):
+            if time.time() >= deadline:
+                return False
+            stops, length = self.remove(v, user)
+            for w in self.routes:
+                res = self.best_insertion(w, stops if w is v else self.routes[w], user)
+                if res is None:
+                    continue
+                if w is v:
+                    gain = self.length[v] - res[1]
+                else:
+                    gain = self.length[v] + self.length[w] - length - res[1]
+                if gain > 1e-6:
+                    if w is not v:
+                        self.routes[v], self.length[v] = stops, length
+                    self.apply(w, user, res[0], res[1])
+                    return True
+        return False
+
+    def exchange(self, deadline):
+        owners = list(self.owner.items())
+        for idx, (a, va) in enumerate(owners):
+            for b, vb in owners[idx + 1:]:
+                if time.time() >= deadline:
+                    return False
+                if va is vb:
+                    continue
+                stops_a, _ = self.remove(va, a)
+                stops_b, _ = self.remove(vb, b)
+                res_a = self.best_insertion(vb, stops_b, a)
+                res_b = self.best_insertion(va, stops_a, b)
+                if res_a is None or res_b is None:
+                    continue
+                if self.length[va] + self.length[vb] - res_a[1] - res_b[1] > 1e-6:
+                    self.apply(vb, a, res_a[0], res_a[1])
+                    self.apply(va, b, res_b[0], res_b[1])
+                    return True
+        return False
@@ -1,19 +1,28 @@
 # built-in
+import os
 import sys
 import time
+import heapq
+import pstats
+import cProfile
 import logging
+import asyncio
 import argparse
 import datetime
+import itertools
 import pandas as pd
 
 # solver
 from gurobipy import *
-from tabulate import tabulate
 
 # my own
 from user import User
 from system import System
 from vehicle import Vehicle
+from metrics import Metrics
+from report import REPORTS, open_report
+from service import DispatchService
+from zoning import Zoning, SCHEMES
 from astar.planner import *
 
 # initialize the logger
@@ -27,92 +36,114 @@ formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(messag
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
 
-def show_all_users(users):
-    print_pudo = {"request ID": [],
-                  "pickup location": [],
-                  "dropoff location": [],
-                  "# users": [],
-                  "waiting time": [],
-                  "travel time": [],
-                  "request time": [],
-                  "detour ratio": []}
-
-    for user in users:
-        print_pudo["request ID"].append(user.id)
-        print_pudo["pickup location"].append(user.pu)
-        print_pudo["dropoff location"].append(user.do)
-        print_pudo["# users"].append(user.cap)
-        print_pudo["waiting time"].append(round(user.expected_waiting_time, 2))
-        print_pudo["travel time"].append(round(user.expected_travel_time, 2))
-        print_pudo["request time"].append(user.time)
-        print_pudo["detour ratio"].append(user.expected_travel_time / user.shortest_time)
-
-    # print out
-    print("[Calls]")
-    print(tabulate(print_pudo, headers="keys", tablefmt="fancy_grid", missingval="N/A"))
-
-
-def show_all_vehicles(vehicles, time=None):
-    print_veh = {"vehicle ID": [],
-                 "origin": [],
-                 "capacity": [],
-                 "users": [],
-                 "# users": [],
-                 "path": [],
-                 "travel time": [],
-                 "start time": [],
-                 "location": []}
-
-    for veh in vehicles:
-        print_veh["vehicle ID"].append(veh.id)
-        print_veh["origin"].append(veh.loc)
-        print_veh["capacity"].append(veh.capacity)
-        print_veh["users"].append(veh.on_board)
-        print_veh["# users"].append(veh.num_users)
-        print_veh["path"].append([stop for stop, u, tt in veh.route])
-        print_veh["travel time"].append(round(veh.travel_time, 2))
-        print_veh["start time"].append(veh.time)
-        if veh.next_loc is None:
-            print_veh["location"].append(str(veh.here[0]))
-        else:
-            print_veh["location"].append(str(veh.here[0]) + "->" + str(veh.next_loc[0]))
-
-    # print out
-    print("[Vehicles]")
-    print(tabulate(print_veh, headers="keys", tablefmt="fancy_grid", missingval="N/A"))
+# event priorities, arrivals at the time of a dispatch join its batch
+ARRIVAL = 0
+DISPATCH = 1
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="three weights (alpha, beta, gamma), "
-                                                 "penalty given for not visiting a location, detour ratio limit")
-    parser.add_argument("-w", "--weight", type=int, required=True, nargs="+", help="alpha, beta, gamma")
-    parser.add_argument("-p", "--penalty", type=int, required=True, help="penalty for unvisited stations")
-    parser.add_argument("-d", "--detour", type=float, required=True, help="detour ratio")
+def snap(frame, planner):
+    # the locations given as raw coordinates ("pick up lon", "pick up lat", ...) are snapped to the nearest nodes
+    for column in ("pick up", "drop off", "location"):
+        if column + " lon" in frame.columns and len(frame) > 0:
+            frame[column] = planner.snap(frame[column + " lon"].tolist(), frame[column + " lat"].tolist())
+    return frame
 
-    args = parser.parse_args()
 
-    # system initialization
-    system = System(logger)
+def read_events(path, chunk_size, planner):
+    # rows of a time-ordered input file, read chunk by chunk
+    # the rows out of order within a chunk are sorted, a chunk starting before the end of the last one is an error
+    last = None
+    for chunk in pd.read_csv(path, chunksize=chunk_size):
+        chunk["time"] = pd.to_datetime(chunk["time"], format=TIME_FORMAT)
+        if not chunk["time"].is_monotonic_increasing:
+            logger.warning("The rows of %s are not sorted by time, they are sorted chunk by chunk.", path)
+            chunk = chunk.sort_values("time", kind="stable")
+        if last is not None and len(chunk) > 0 and chunk["time"].iloc[0] < last:
+            raise ValueError("%s is not sorted by time: %s comes after %s, sort the file or raise --chunk-size"
+                             % (path, chunk["time"].iloc[0], last))
+        if len(chunk) > 0:
+            last = chunk["time"].iloc[-1]
+        for row in snap(chunk, planner).to_dict("records"):
+            yield row
 
-    # routing planner
-    planner = RoutingPlanner(args.weight[0], args.weight[1], args.weight[2])
-    system.set_planner(planner)
 
+def dispatch(system, report, calls, vehicles, args, cycle):
+    profiler = None
+    if cycle == args.profile_cycle:
+        # the process id lets a sampling profiler (py-spy --pid) attach to the same cycle
+        logger.info("Profiling cycle %s of process %s.", cycle, os.getpid())
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    # add new passengers
+    users = []
+    ids = set()
+    for row in calls:
+        if row["id"] in system.users_ids or row["id"] in ids:
+            logger.info("%s is duplicate user ID.", row["id"])
+            sys.exit()
+        ids.add(row["id"])
+        users.append(User(row["time"],
+                          row["id"],
+                          row["pick up"],
+                          row["drop off"],
+                          row["num"],
+                          logger))
+    system.add_users(users)
+    # add new vehicles
+    new_vehicles = []
+    ids = set()
+    for row in vehicles:
+        if row["id"] in system.vehicles_ids or row["id"] in ids:
+            logger.info("%s is duplicate vehicle ID.", row["id"])
+            sys.exit()
+        ids.add(row["id"])
+        new_vehicles.append(Vehicle(row["time"],
+                                    row["id"],
+                                    row["location"],
+                                    row["working time"],
+                                    row["capacity"],
+                                    args.detour,
+                                    logger))
+    system.add_vehicles(new_vehicles)
+
+    report.input(system)
+
+    # optimize
+    if args.engine == "milp":
+        system.opt(args.penalty, args.detour)
+    else:
+        system.insert(args.detour, args.search_time)
+    logger.info("Objective: %s", system.objective(args.penalty))
+    logger.info("Distance cache: %s", system.distance.stats())
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile_output)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+        logger.info("Profile of cycle %s is saved in %s.", cycle, args.profile_output)
+    system.flush_metrics()
+    system.reset_timings()
+
+    # optimization result
+    report.result(system)
+
+
+def live(system, report, args, now, time_limit):
     # load passengers calls
-    call = pd.read_csv("./input/call-test.csv")
-    call["time"] = pd.to_datetime(call["time"], format="%Y/%m/%d %H:%M:%S")
+    call = snap(pd.read_csv(args.calls), system.planner)
+    call["time"] = pd.to_datetime(call["time"], format=TIME_FORMAT)
 
     # load vehicles
-    veh = pd.read_csv("./input/veh-test.csv")
-    veh["time"] = pd.to_datetime(veh["time"], format="%Y/%m/%d %H:%M:%S")
+    veh = snap(pd.read_csv(args.vehicles), system.planner)
+    veh["time"] = pd.to_datetime(veh["time"], format=TIME_FORMAT)
 
-    now = datetime.datetime.strptime("2024/08/16 00:00:00", "%Y/%m/%d %H:%M:%S")
     start_time = datetime.datetime.now()
     '''
     now = datetime.datetime.now()
     '''
-    time_limit = datetime.datetime.strptime("2024/08/16 00:08:00", "%Y/%m/%d %H:%M:%S")
     system.set_time(now)
 
     count = 0
@@ -137,41 +168,8 @@ if __name__ == "__main__":
             time.sleep(5)
             continue
 
-        # add new passengers
-        for idx, row in call_.iterrows():
-            if row["id"] in system.users_ids:
-                logger.info("%s is duplicate user ID.", row["id"])
-                sys.exit()
-            system.add_users(User(row["time"],
-                                  row["id"],
-                                  row["pick up"],
-                                  row["drop off"],
-                                  row["num"],
-                                  logger))
-        # add new vehicles
-        for idx, row in veh_.iterrows():
-            if row["id"] in system.vehicles_ids:
-                logger.info("%s is duplicate vehicle ID.", row["id"])
-                sys.exit()
-            system.add_vehicles(Vehicle(row["time"],
-                                        row["id"],
-                                        row["location"],
-                                        row["working time"],
-                                        row["capacity"],
-                                        args.detour,
-                                        logger))
-
-        print("##### INPUT #####")
-        show_all_users(system.users)
-        show_all_vehicles(system.vehicles)
-
-        # optimize
-        system.opt(args.penalty, args.detour)
-
-        # optimization result
-        print("##### RESULT #####")
-        show_all_users(system.users)
-        show_all_vehicles(system.vehicles, now)
+        dispatch(system, report, [row for idx, row in call_.iterrows()], [row for idx, row in veh_.iterrows()], args,
+                 count)
 
         # table drop
         call = call.drop(call_.index, axis=0)
@@ -179,3 +177,144 @@ if __name__ == "__main__":
 
         count += 1
 
+
+def replay(system, report, args, start, end):
+    # discrete event simulation, the clock jumps from event to event
+    # arrivals are streamed from the input files, the first arrival of a batch schedules a dispatch at the end of its
+    # batching window and the windows without arrivals are skipped
+    window = datetime.timedelta(seconds=args.window)
+    streams = {"call": read_events(args.calls, args.chunk_size, system.planner),
+               "vehicle": read_events(args.vehicles, args.chunk_size, system.planner)}
+    events = []
+    order = itertools.count()
+
+    def push_arrival(kind):
+        row = next(streams[kind], None)
+        if row is not None:
+            heapq.heappush(events, (row["time"], ARRIVAL, next(order), kind, row))
+
+    for kind in streams:
+        push_arrival(kind)
+
+    batch = {"call": [], "vehicle": []}
+    count = 0
+    start_time = time.time()
+    while events:
+        now, priority, _, kind, row = heapq.heappop(events)
+        if now > end:
+            break
+
+        if priority == DISPATCH:
+            system.set_time(now)
+            logger.info("The current time is %s.", now)
+            logger.info("The number of calls are %s and the number of vehicles entering service is %s.",
+                        len(batch["call"]), len(batch["vehicle"]))
+            dispatch(system, report, batch["call"], batch["vehicle"], args, count)
+            batch = {"call": [], "vehicle": []}
+            count += 1
+            continue
+
+        if len(batch["call"]) == 0 and len(batch["vehicle"]) == 0:
+            windows = max(0, -(-(now - start) // window))
+            heapq.heappush(events, (start + windows * window, DISPATCH, next(order), "dispatch", None))
+        batch[kind].append(row)
+        push_arrival(kind)
+
+    logger.info("Replayed %s dispatch cycles in %.1f s.", count, time.time() - start_time)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="three weights (alpha, beta, gamma), "
+                                                 "penalty given for not visiting a location, detour ratio limit")
+    parser.add_argument("-w", "--weight", type=int, required=True, nargs="+", help="alpha, beta, gamma")
+    parser.add_argument("-p", "--penalty", type=int, required=True, help="penalty for unvisited stations")
+    parser.add_argument("-d", "--detour", type=float, required=True, help="detour ratio")
+    parser.add_argument("--engine", type=str, default="milp", choices=["milp", "insertion"],
+                        help="dispatch by solving the MILP or by cheapest insertion")
+    parser.add_argument("--search-time", type=float, default=0,
+                        help="seconds of relocate/exchange local search after the insertion")
+    parser.add_argument("--time-limit", type=float, default=None, help="seconds the MILP may take per cycle")
+    parser.add_argument("--mip-gap", type=float, default=None, help="relative MIP gap at which the MILP stops")
+    parser.add_argument("--solver-threads", type=int, default=None, help="threads of the MILP solver")
+    parser.add_argument("--iis", type=str, default=None, help="file for the infeasible subsystem of an infeasible MILP")
+    parser.add_argument("--ch", action="store_true", help="answer cost queries with contraction hierarchies")
+    parser.add_argument("--threads", type=int, default=1, help="worker threads of the batched cost queries")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="distance cache file loaded at start and saved at exit, "
+                             "skipped if it was saved for other weights or another road network")
+    parser.add_argument("--cache-size", type=int, default=1000000, help="maximum number of cached distances")
+    parser.add_argument("--calls", type=str, default="./input/call-test.csv", help="passenger calls")
+    parser.add_argument("--vehicles", type=str, default="./input/veh-test.csv", help="vehicles entering service")
+    parser.add_argument("--start", type=str, default="2024/08/16 00:00:00", help="simulation start")
+    parser.add_argument("--end", type=str, default="2024/08/16 00:08:00", help="simulation end")
+    parser.add_argument("--replay", action="store_true", help="replay the inputs on an event clock as fast as possible")
+    parser.add_argument("--window", type=int, default=60, help="batching window (s) of the replay")
+    parser.add_argument("--metrics", type=str, default=None, help="per-cycle metrics file (JSON lines)")
+    parser.add_argument("--profile-cycle", type=int, default=None, help="dispatch cycle run under cProfile")
+    parser.add_argument("--profile-output", type=str, default="cycle.prof", help="profile of that cycle")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="rows read at once from the inputs in replay")
+    parser.add_argument("--rolling", action="store_true",
+                        help="retire the completed users and plan the routes from their committed prefixes")
+    parser.add_argument("--radius", type=float, default=None,
+                        help="exact costs only between the locations within this straight-line distance (m)")
+    parser.add_argument("--zones", type=int, default=1, help="number of zones solved in parallel by the MILP")
+    parser.add_argument("--partition", type=str, default="grid", choices=SCHEMES, help="zoning scheme")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes of the zones")
+    parser.add_argument("--serve", action="store_true", help="dispatch the events received over a socket or HTTP")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address of the service")
+    parser.add_argument("--port", type=int, default=8765, help="port of the JSON lines socket of the service")
+    parser.add_argument("--http-port", type=int, default=None, help="port of the HTTP endpoint of the service")
+    parser.add_argument("--batch-window", type=float, default=1.0, help="seconds a micro-batch of the service collects")
+    parser.add_argument("--max-batch", type=int, default=1000, help="maximum number of events of a micro-batch")
+    parser.add_argument("--report", type=str, default="summary", choices=REPORTS,
+                        help="state of the users and vehicles after every cycle")
+    parser.add_argument("--report-output", type=str, default="./report",
+                        help="JSON lines file or Parquet directory of the jsonl and parquet reports")
+
+    args = parser.parse_args()
+
+    # system initialization
+    system = System(logger, cache_size=args.cache_size, cache_path=args.cache, rolling=args.rolling,
+                    radius=args.radius)
+    if args.metrics is not None:
+        system.set_metrics(Metrics(args.metrics))
+    system.set_solver(args.time_limit, args.mip_gap, args.solver_threads, args.iis)
+
+    # routing planner
+    planner = RoutingPlanner(args.weight[0], args.weight[1], args.weight[2])
+    planner.set_threads(args.threads)
+    memory = planner.memory_usage()
+    logger.info("The road network has %s nodes and %s links (%.1f MB).",
+                memory["nodes"], memory["edges"], memory["bytes"] / 1e6)
+    if args.ch:
+        ch = planner.build_ch()
+        logger.info("Contraction hierarchy built in %.1f s with %s shortcuts.", ch["seconds"], ch["shortcuts"])
+        check = planner.verify_ch()
+        if check["mismatches"] > 0:
+            logger.info("Contraction hierarchy disagrees with A* on %s of %s pairs (max error %s).",
+                        check["mismatches"], check["samples"], check["max_error"])
+            sys.exit()
+    system.set_planner(planner, use_ch=args.ch)
+    if args.zones > 1:
+        system.set_zoning(Zoning(planner, args.zones, args.partition), args.workers)
+
+    start = datetime.datetime.strptime(args.start, TIME_FORMAT)
+    end = datetime.datetime.strptime(args.end, TIME_FORMAT)
+    report = open_report(args.report, logger, args.report_output)
+    report.watch(system)
+    if args.serve:
+        service = DispatchService(system, report, args.engine, args.penalty, args.detour, args.search_time,
+                                  args.batch_window, args.max_batch, logger)
+        try:
+            asyncio.run(service.run(args.host, args.port, args.http_port))
+        except KeyboardInterrupt:
+            logger.info("The service is stopped after %s dispatch cycles.", service.cycles)
+    elif args.replay:
+        replay(system, report, args, start, end)
+    else:
+        live(system, report, args, start, end)
+
+    report.close()
+    system.save_cache()
+    system.metrics.close()
+    system.close()
@@ -0,0 +1,64 @@
+# built-in
+import json
+import time
+import contextlib
+
+
+# counters, timers and values of one dispatch cycle, written as one JSON line per cycle
+class Metrics:
+    enabled = True
+
+    def __init__(self, path):
+        super(Metrics, self).__init__()
+        self.path = path
+        self.file = open(path, "w")
+        self.values = {}
+        self.cycle = 0
+
+    # ADD
+    def add(self, name, value=1):
+        self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    # FILE
+    def flush(self, now, **values):
+        record = {"cycle": self.cycle, "time": str(now)}
+        record.update(values)
+        record.update(self.values)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.values = {}
+        self.cycle += 1
+
+    def close(self):
+        self.file.close()
+
+
+# stand-in while the metrics are switched off, nothing is measured or stored
+class NoMetrics:
+    enabled = False
+
+    def add(self, name, value=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def timer(self, name):
+        return contextlib.nullcontext()
+
+    def flush(self, now, **values):
+        pass
+
+    def close(self):
+        pass
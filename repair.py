@@ -0,0 +1,86 @@
+# built-in
+import numpy as np
+
+
+# detour repair of a vehicle route, the users over the detour ratio limit are rejected one at a time
+# the cumulative travel times are kept in an array that every rejection shifts in place, and every candidate rejection
+# is scored at once by the ratios it leaves: the fewest users over the limit, then the smallest group
+class DetourRepair:
+    def __init__(self, cost, detour):
+        super(DetourRepair, self).__init__()
+        self.cost = cost            # cost between two locations
+        self.detour = detour
+
+    # GET
+    def positions(self, route, users):
+        # positions of the pickup and the dropoff of every user, 0 for the pickup of a user already on board
+        pickup = np.zeros(len(users), dtype=np.int64)
+        dropoff = np.zeros(len(users), dtype=np.int64)
+        index = {user: k for k, user in enumerate(users)}
+        for pos, (loc, user, _) in enumerate(route[1:], 1):
+            if loc == user.pu and pickup[index[user]] == 0:
+                pickup[index[user]] = pos
+            else:
+                dropoff[index[user]] = pos
+        return pickup, dropoff
+
+    def saving(self, route, legs, pos):
+        # cost saved by skipping the stop at pos
+        if pos == len(route) - 1:
+            return legs[pos]
+        return legs[pos] + legs[pos + 1] - self.cost(route[pos - 1][0], route[pos + 1][0])
+
+    def shifts(self, route, legs, pickup, dropoff):
+        # shifts[c, k]: how much earlier stop k is reached without the stops at pickup[c] and dropoff[c]
+        first = np.zeros(len(pickup))
+        second = np.zeros(len(pickup))
+        for c, (a, b) in enumerate(zip(pickup, dropoff)):
+            if b == a + 1 and b < len(route) - 1:
+                # back to back, the route goes from the stop before the pickup to the stop after the dropoff
+                first[c] = legs[a] + legs[b] + legs[b + 1] - self.cost(route[a - 1][0], route[b + 1][0])
+            elif b == a + 1:
+                first[c] = legs[a] + legs[b]
+            else:
+                first[c] = self.saving(route, legs, a)
+                second[c] = self.saving(route, legs, b)
+        positions = np.arange(len(route))
+        return (first[:, None] * (positions[None, :] > pickup[:, None])
+                + second[:, None] * (positions[None, :] > dropoff[:, None]))
+
+    # SET
+    def run(self, route, committed):
+        # returns the repaired route with its travel times and the rejected users with their ratios
+        times = np.array([tt for _, _, tt in route], dtype=float)
+        users = list(dict.fromkeys(user for _, user, _ in route[1:]))
+        rejected = []
+        while len(users) > 0:
+            pickup, dropoff = self.positions(route, users)
+            shortest = np.array([user.shortest_time for user in users], dtype=float)
+            start = np.array([times[a] if a > 0 else user.expected_waiting_time
+                              for user, a in zip(users, pickup)], dtype=float)
+            rides = times[dropoff] - start
+            ratios = np.divide(rides, shortest, out=np.zeros(len(users)), where=shortest > 0)
+
+            candidates = np.flatnonzero((ratios > self.detour) & (pickup > 0)
+                                        & np.array([user not in committed for user in users], dtype=bool))
+            if len(candidates) == 0:
+                break
+
+            # ratios of every user after each candidate rejection, column 0 of the shifts is always 0
+            legs = np.diff(times, prepend=times[0])
+            shifts = self.shifts(route, legs, pickup[candidates], dropoff[candidates])
+            after = (rides[None, :] - (shifts[:, dropoff] - shifts[:, pickup])) / \
+                np.where(shortest > 0, shortest, np.inf)[None, :]
+            after[np.arange(len(candidates)), candidates] = 0
+            over = (after > self.detour).sum(axis=1)
+            caps = np.array([users[c].cap for c in candidates])
+            best = np.lexsort((-ratios[candidates], caps, over))[0]
+
+            c = candidates[best]
+            rejected.append((users[c], ratios[c]))
+            times = times - shifts[best]
+            keep = [pos for pos in range(len(route)) if pos != pickup[c] and pos != dropoff[c]]
+            times = times[keep]
+            route = [(route[pos][0], route[pos][1], times[k]) for k, pos in enumerate(keep)]
+            users.pop(c)
+        return [(loc, user, float(tt)) for loc, user, tt in route], rejected
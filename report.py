@@ -0,0 +1,241 @@
+# built-in
+import os
+import abc
+import json
+import queue
+import threading
+import pandas as pd
+
+from tabulate import tabulate
+
+REPORTS = ("off", "summary", "table", "jsonl", "parquet")
+
+
+def user_record(user, owner):
+    # owner: user -> vehicle ID of the route it is on
+    return {"request ID": user.id,
+            "pickup location": user.pu,
+            "dropoff location": user.do,
+            "# users": user.cap,
+            "vehicle": owner.get(user),
+            "waiting time": round(user.expected_waiting_time, 2),
+            "travel time": round(user.expected_travel_time, 2),
+            "request time": str(user.time),
+            "detour ratio": user.expected_travel_time / user.shortest_time if user.shortest_time > 0 else None,
+            "picked up": user.pick_up,
+            "dropped off": user.drop_off}
+
+
+def owners(system):
+    return {user: v.id for v in system.vehicles for user in v.on_board}
+
+
+def vehicle_record(veh):
+    return {"vehicle ID": veh.id,
+            "origin": veh.loc,
+            "capacity": veh.capacity,
+            "users": [user.id for user in veh.on_board],
+            "# users": veh.num_users,
+            "path": [stop for stop, u, tt in veh.route],
+            "travel time": round(veh.travel_time, 2),
+            "driving time": round(veh.driving_time, 2),
+            "start time": str(veh.time),
+            "location": None if veh.here is None else veh.here[0],
+            "next location": None if veh.next_loc is None else veh.next_loc[0]}
+
+
+def scalar(value):
+    # numpy scalars of the pandas inputs
+    return value.item()
+
+
+# state of the users and vehicles after every dispatch cycle, written by a background thread
+# the system tracks the users and vehicles it changes, the dispatch loop only takes their records, drops the ones equal
+# to the records written last and queues the others, the writer thread formats and writes them
+class Report(abc.ABC):
+    enabled = True
+
+    def __init__(self, logger):
+        super(Report, self).__init__()
+        self.logger = logger
+        self.cycle = 0
+        self.users = {}         # user ID -> record written last, while the user is in the system
+        self.vehicles = {}      # vehicle ID -> record written last, while the vehicle is in the system
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="report", daemon=True)
+        self.thread.start()
+
+    # GET
+    def changed(self, objects, last, record, key, present):
+        # records of the objects that are new or changed, the objects that left are written once more and forgotten
+        changed = []
+        for obj in objects:
+            rec = record(obj)
+            if last.get(rec[key]) != rec:
+                changed.append(rec)
+            if obj in present:
+                last[rec[key]] = rec
+            else:
+                last.pop(rec[key], None)
+        return changed
+
+    # SET
+    def watch(self, system):
+        system.track()
+
+    def input(self, system):
+        pass
+
+    def result(self, system):
+        # a user changes along with the vehicles it joins or leaves, so its vehicle is among the changed ones
+        users, vehicles = system.take_dirty()
+        owner = {user: v.id for v in vehicles for user in v.on_board}
+        # the users dropped off in rolling horizon are no longer on board, they keep the vehicle that carried them
+        owner.update({user: user.vehicle.id for user in users if user.drop_off and user.vehicle is not None})
+        users = self.changed(users, self.users, lambda x: user_record(x, owner), "request ID", system.users)
+        vehicles = self.changed(vehicles, self.vehicles, vehicle_record, "vehicle ID", system.vehicles)
+        self.queue.put((self.cycle, str(system.time), users, vehicles))
+        self.cycle += 1
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.write(*item)
+            except Exception:
+                self.logger.exception("The report of cycle %s could not be written.", item[0])
+
+    @abc.abstractmethod
+    def write(self, cycle, now, users, vehicles):
+        pass
+
+    # FILE
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.finish()
+
+    def finish(self):
+        pass
+
+
+# stand-in while the report is switched off
+class NoReport:
+    enabled = False
+
+    def watch(self, system):
+        pass
+
+    def input(self, system):
+        pass
+
+    def result(self, system):
+        pass
+
+    def close(self):
+        pass
+
+
+# one line per cycle with the counts of the users and vehicles
+class SummaryReport(Report):
+    def watch(self, system):
+        pass
+
+    def result(self, system):
+        users = list(system.users)
+        owner = owners(system)
+        served = [user for user in users if user in owner]
+        waiting = [user.expected_waiting_time for user in served if not user.pick_up]
+        busy = sum(1 for v in system.vehicles if len(v.on_board) > 0)
+        self.queue.put((self.cycle, str(system.time), len(users), len(served), waiting, len(system.vehicles), busy))
+        self.cycle += 1
+
+    def write(self, cycle, now, users, served, waiting, vehicles, busy):
+        self.logger.info("Cycle %s at %s: %s of %s users served, %s waiting (mean %.1f s), %s of %s vehicles busy.",
+                         cycle, now, served, users, len(waiting), sum(waiting) / max(len(waiting), 1), busy, vehicles)
+
+
+# the tables of every user and vehicle before and after every cycle
+class TableReport(Report):
+    def watch(self, system):
+        pass
+
+    def input(self, system):
+        self.tables("INPUT", system)
+
+    def result(self, system):
+        self.tables("RESULT", system)
+        self.cycle += 1
+
+    def tables(self, stage, system):
+        owner = owners(system)
+        self.queue.put((stage, [user_record(user, owner) for user in system.users],
+                        [vehicle_record(v) for v in system.vehicles]))
+
+    def write(self, stage, users, vehicles):
+        print("##### %s #####" % stage)
+        print("[Calls]")
+        print(tabulate(users, headers="keys", tablefmt="fancy_grid", missingval="N/A"))
+        print("[Vehicles]")
+        print(tabulate(vehicles, headers="keys", tablefmt="fancy_grid", missingval="N/A"))
+
+
+# JSON lines of the changed users and vehicles, buffered by the file and flushed when closed
+class JsonReport(Report):
+    def __init__(self, logger, path):
+        self.file = open(path, "w")
+        super(JsonReport, self).__init__(logger)
+
+    def write(self, cycle, now, users, vehicles):
+        for kind, records in (("user", users), ("vehicle", vehicles)):
+            for rec in records:
+                rec = dict({"cycle": cycle, "time": now, "type": kind}, **rec)
+                self.file.write(json.dumps(rec, default=scalar) + "\n")
+
+    def finish(self):
+        self.file.close()
+
+
+# Parquet files of the changed users and vehicles, one pair of files every `rows` buffered records
+# the directory reads back as one table with pd.read_parquet(path + "/users") and pd.read_parquet(path + "/vehicles")
+class ParquetReport(Report):
+    def __init__(self, logger, path, rows=100000):
+        pd.io.parquet.get_engine("auto")   # pyarrow or fastparquet, fail before the dispatch starts
+        self.path = path
+        self.rows = rows
+        self.part = 0
+        self.buffer = {"users": [], "vehicles": []}
+        for kind in self.buffer:
+            os.makedirs(os.path.join(path, kind), exist_ok=True)
+        super(ParquetReport, self).__init__(logger)
+
+    def write(self, cycle, now, users, vehicles):
+        for kind, records in (("users", users), ("vehicles", vehicles)):
+            self.buffer[kind].extend(dict({"cycle": cycle, "time": now}, **rec) for rec in records)
+        if len(self.buffer["users"]) + len(self.buffer["vehicles"]) >= self.rows:
+            self.dump()
+
+    # FILE
+    def dump(self):
+        for kind, records in self.buffer.items():
+            if len(records) > 0:
+                pd.DataFrame(records).to_parquet(os.path.join(self.path, kind, "part-%05d.parquet" % self.part))
+        self.buffer = {"users": [], "vehicles": []}
+        self.part += 1
+
+    def finish(self):
+        self.dump()
+
+
+def open_report(mode, logger, path=None):
+    if mode == "off":
+        return NoReport()
+    if mode == "summary":
+        return SummaryReport(logger)
+    if mode == "table":
+        return TableReport(logger)
+    if mode == "jsonl":
+        return JsonReport(logger, path)
+    return ParquetReport(logger, path)
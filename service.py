@@ -0,0 +1,322 @@
+# built-in
+import json
+import math
+import time
+import asyncio
+import datetime
+import collections
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+# my own
+from user import User
+from vehicle import Vehicle
+
+# fields of the events, the locations may be given as "<field> lon" and "<field> lat" instead
+FIELDS = {"call": ("id", "pick up", "drop off", "num"),
+          "vehicle": ("id", "location", "working time", "capacity")}
+LOCATIONS = {"call": ("pick up", "drop off"),
+             "vehicle": ("location",)}
+
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found"}
+
+
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_number(value):
+    return (isinstance(value, (int, float)) and not isinstance(value, bool)) and math.isfinite(value)
+
+
+# dispatch service, the calls and vehicles arrive as JSON events over a socket (one event per line) or over HTTP
+# (POST /calls, POST /vehicles) and are queued into micro-batches, every batch is dispatched on a worker thread while
+# the event loop keeps accepting events, and every call is answered with its assignment once its batch is dispatched
+# the socket clients that send {"type": "subscribe"} receive every assignment, GET /metrics returns the counters
+class DispatchService:
+    def __init__(self, system, report, engine, penalty, detour, search_time=0, window=1.0, max_batch=1000,
+                 logger=None):
+        super(DispatchService, self).__init__()
+        self.system = system
+        self.report = report
+        self.engine = engine
+        self.penalty = penalty
+        self.detour = detour
+        self.search_time = search_time
+        self.window = window            # seconds a batch collects events after its first one
+        self.max_batch = max_batch
+        self.logger = logger
+        self.nodes = set(system.planner.node_ids().tolist())    # node IDs of the road network
+
+        self.queue = None               # received event, its future and its arrival time (perf counter)
+        self.pending = {"call": set(), "vehicle": set()}    # IDs queued and not dispatched yet
+        self.subscribers = set()
+        # the system is only touched by one dispatch at a time
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dispatch")
+
+        self.cycles = 0
+        self.counters = collections.Counter()
+        self.max_depth = 0
+        self.latency = collections.deque(maxlen=10000)  # seconds from the arrival of a call to its assignment
+
+    # GET
+    def validate(self, event):
+        # every event is checked on its own before it is queued, so a bad one never reaches a batch
+        kind = event.get("type")
+        if kind not in FIELDS:
+            return "unknown event type %s" % kind
+        for field in FIELDS[kind]:
+            if field in LOCATIONS[kind] and field not in event:
+                if field + " lon" not in event or field + " lat" not in event:
+                    return "missing %s" % field
+                if not is_number(event[field + " lon"]) or not is_number(event[field + " lat"]):
+                    return "invalid coordinates of %s" % field
+            elif field not in event:
+                return "missing %s" % field
+            elif field in LOCATIONS[kind]:
+                if not is_integer(event[field]) or event[field] not in self.nodes:
+                    return "unknown node %s of %s" % (event[field], field)
+            elif field == "id":
+                if not is_integer(event[field]) and not isinstance(event[field], str):
+                    return "invalid id %s" % event[field]
+            elif not is_number(event[field]) or event[field] <= 0:
+                return "invalid %s %s" % (field, event[field])
+        ids = self.system.users_ids if kind == "call" else self.system.vehicles_ids
+        if event["id"] in ids or event["id"] in self.pending[kind]:
+            return "duplicate %s ID %s" % (kind, event["id"])
+        return None
+
+    def stats(self):
+        latency = np.array(self.latency) if len(self.latency) > 0 else np.zeros(1)
+        return {"cycles": self.cycles,
+                "queue depth": self.queue.qsize() if self.queue is not None else 0,
+                "max queue depth": self.max_depth,
+                "calls": self.counters["call"],
+                "vehicles": self.counters["vehicle"],
+                "assigned": self.counters["assigned"],
+                "unserved": self.counters["unserved"],
+                "errors": self.counters["error"],
+                "latency mean": float(latency.mean()),
+                "latency p95": float(np.percentile(latency, 95)),
+                "latency max": float(latency.max())}
+
+    # SET
+    async def submit(self, event):
+        # queues the event and waits for its batch
+        error = self.validate(event)
+        if error is not None:
+            self.counters["error"] += 1
+            return {"type": "error", "id": event.get("id"), "error": error}
+        self.pending[event["type"]].add(event["id"])
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((event, future, time.perf_counter()))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return await future
+
+    def locate(self, events, kind):
+        # the locations given as coordinates are snapped to the nearest nodes, a whole batch at once
+        for field in LOCATIONS[kind]:
+            located = [event for event in events if field not in event]
+            if len(located) > 0:
+                nodes = self.system.planner.snap([event[field + " lon"] for event in located],
+                                                 [event[field + " lat"] for event in located])
+                for event, node in zip(located, nodes):
+                    event[field] = int(node)
+
+    def add(self, events, now):
+        # the users and vehicles of the events, nothing of them stays in the system if one cannot be added
+        users = [User(now, row["id"], row["pick up"], row["drop off"], row["num"], self.logger)
+                 for row in events if row["type"] == "call"]
+        vehicles = [Vehicle(now, row["id"], row["location"], row["working time"], row["capacity"], self.detour,
+                            self.logger) for row in events if row["type"] == "vehicle"]
+        self.system.add_users(users)
+        try:
+            self.system.add_vehicles(vehicles)
+        except Exception:
+            self.system.remove_users(users)
+            raise
+        return users, vehicles
+
+    def dispatch(self, events):
+        # one dispatch cycle on the worker thread, returns one message per event of the batch
+        now = datetime.datetime.now()
+        self.system.set_time(now)
+        for kind in FIELDS:
+            self.locate([event for event in events if event["type"] == kind], kind)
+
+        errors = {}     # position in the batch -> error of the event
+        try:
+            users, vehicles = self.add(events, now)
+        except Exception:
+            # the events are added one at a time, only the ones that fail are answered with an error
+            users, vehicles = [], []
+            for k, event in enumerate(events):
+                try:
+                    users_, vehicles_ = self.add([event], now)
+                except Exception as e:
+                    self.logger.warning("The %s %s is rejected: %s", event["type"], event["id"], e)
+                    errors[k] = str(e)
+                    continue
+                users += users_
+                vehicles += vehicles_
+        self.report.input(self.system)
+
+        if self.engine == "milp":
+            self.system.opt(self.penalty, self.detour)
+        else:
+            self.system.insert(self.detour, self.search_time)
+        self.report.result(self.system)
+
+        owner = {user: v for v in self.system.vehicles for user in v.on_board}
+        users = iter(users)
+        messages = []
+        for k, event in enumerate(events):
+            if k in errors:
+                messages.append({"type": "error", "id": event["id"], "error": errors[k]})
+            elif event["type"] == "call":
+                user = next(users)
+                messages.append({"type": "assignment",
+                                 "id": user.id,
+                                 "vehicle": owner[user].id if user in owner else None,
+                                 "waiting time": round(user.expected_waiting_time, 2),
+                                 "travel time": round(user.expected_travel_time, 2)})
+            else:
+                messages.append({"type": "vehicle", "id": event["id"], "accepted": True})
+        return messages
+
+    async def publish(self, message):
+        line = (json.dumps(message) + "\n").encode()
+        for writer in list(self.subscribers):
+            try:
+                writer.write(line)
+                await writer.drain()
+            except ConnectionError:
+                self.subscribers.discard(writer)
+
+    async def batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(self.window)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            start = time.perf_counter()
+            try:
+                messages = await loop.run_in_executor(self.executor, self.dispatch, [event for event, _, _ in batch])
+            except Exception as e:
+                self.logger.exception("The dispatch of %s events failed.", len(batch))
+                for event, future, _ in batch:
+                    self.pending[event["type"]].discard(event["id"])
+                    if not future.done():
+                        future.set_result({"type": "error", "id": event["id"], "error": str(e)})
+                continue
+            solve_time = time.perf_counter() - start
+            depth = self.queue.qsize()      # events received while the batch was dispatched
+
+            # answers in the order of the batch, the vehicles are acknowledged and the rejected events get their error
+            latency = []
+            for (event, future, arrival), message in zip(batch, messages):
+                self.pending[event["type"]].discard(event["id"])
+                if not future.done():     # the client may have left
+                    future.set_result(message)
+                if message["type"] == "error":
+                    self.counters["error"] += 1
+                    continue
+                self.counters[event["type"]] += 1
+                if event["type"] == "call":
+                    self.counters["assigned" if message["vehicle"] is not None else "unserved"] += 1
+                    latency.append(time.perf_counter() - arrival)
+                await self.publish(message)
+            self.latency.extend(latency)
+
+            self.cycles += 1
+            self.logger.info("Dispatched %s calls and %s vehicles in %.3f s, %s events queued meanwhile.",
+                             sum(1 for message in messages if message["type"] == "assignment"),
+                             sum(1 for message in messages if message["type"] == "vehicle"), solve_time, depth)
+            metrics = self.system.metrics
+            if metrics.enabled:
+                metrics.set("batch size", len(batch))
+                metrics.set("queue depth", depth)
+                metrics.set("latency mean", sum(latency) / len(latency) if len(latency) > 0 else None)
+                metrics.set("latency max", max(latency, default=None))
+            self.system.flush_metrics()
+            self.system.reset_timings()
+
+    # FILE
+    async def handle_socket(self, reader, writer):
+        # one JSON event per line, every answer is one JSON line as well, in the order the batches finish
+        tasks = set()
+
+        async def answer(event):
+            message = await self.submit(event)
+            writer.write((json.dumps(message) + "\n").encode())
+            await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    event = None
+                if not isinstance(event, dict):
+                    writer.write((json.dumps({"type": "error", "error": "invalid JSON object"}) + "\n").encode())
+                    continue
+                if event.get("type") == "subscribe":
+                    self.subscribers.add(writer)
+                    continue
+                tasks.add(asyncio.ensure_future(answer(event)))
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
+
+    async def handle_http(self, reader, writer):
+        # one request per connection, POST /calls and POST /vehicles answer once the event is dispatched
+        try:
+            method, path, _ = (await reader.readline()).decode().split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode().partition(":")
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "GET" and path == "/metrics":
+                status, message = 200, self.stats()
+            elif method == "POST" and path in ("/calls", "/vehicles"):
+                event = json.loads(body)
+                if not isinstance(event, dict):
+                    raise ValueError("the body is no JSON object")
+                message = await self.submit(dict(event, type="call" if path == "/calls" else "vehicle"))
+                status = 400 if message["type"] == "error" else 200
+            else:
+                status, message = 404, {"type": "error", "error": "unknown path %s" % path}
+        except (ValueError, asyncio.IncompleteReadError):
+            status, message = 400, {"type": "error", "error": "invalid request"}
+
+        payload = json.dumps(message).encode()
+        writer.write(("HTTP/1.1 %s %s\r\nContent-Type: application/json\r\nContent-Length: %s\r\n"
+                      "Connection: close\r\n\r\n" % (status, HTTP_STATUS[status], len(payload))).encode() + payload)
+        await writer.drain()
+        writer.close()
+
+    async def run(self, host, port, http_port=None):
+        self.queue = asyncio.Queue()
+        servers = [await asyncio.start_server(self.handle_socket, host, port)]
+        if http_port is not None:
+            servers.append(await asyncio.start_server(self.handle_http, host, http_port))
+        self.logger.info("Serving events on %s:%s%s.", host, port,
+                         "" if http_port is None else " and HTTP on %s:%s" % (host, http_port))
+        try:
+            await self.batches()
+        finally:
+            for server in servers:
+                server.close()
+            self.executor.shutdown()
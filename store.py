@@ -0,0 +1,38 @@
+# users or vehicles in the order they entered the system
+# every object gets a stable integer index when it is added, the index of a removed object is never reused
+class Store:
+    def __init__(self):
+        super(Store, self).__init__()
+        self.items = {}         # index -> object
+        self.next_index = 0
+
+    def __iter__(self):
+        return iter(list(self.items.values()))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, obj):
+        return self.items.get(getattr(obj, "index", None)) is obj
+
+    # GET
+    def get(self, index):
+        return self.items[index]
+
+    # ADD
+    def add(self, obj):
+        obj.index = self.next_index
+        self.items[obj.index] = obj
+        self.next_index += 1
+
+    # REMOVE
+    def remove(self, obj):
+        del self.items[obj.index]
+
+    def discard(self, obj):
+        if obj in self:
+            self.remove(obj)
+
+    def difference_update(self, objs):
+        for obj in objs:
+            self.discard(obj)
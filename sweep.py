@@ -0,0 +1,138 @@
+# built-in
+import os
+import json
+import time
+import logging
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from tabulate import tabulate
+
+# my own
+from system import System
+from bench import read_inputs, cycles, arrive, kpis
+from astar.planner import *
+
+logger = logging.getLogger("Sweep")
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.WARNING)
+
+# road network, inputs and cost matrices shared with the worker processes
+# set before the pool forks them and only read afterwards, so the pages are shared copy-on-write
+SHARED = {}
+
+
+def locations(call, veh):
+    # every location the scenario can visit, the rolling origins are stops as well
+    return list(dict.fromkeys(int(loc) for loc in
+                              call["pick up"].tolist() + call["drop off"].tolist() + veh["location"].tolist()))
+
+
+def cost_matrices(planner, locs, weights, threads):
+    # one cost matrix per distinct weighting, every combination with the same weights reuses it
+    matrices = {}
+    for w in dict.fromkeys(weights):
+        start = time.perf_counter()
+        matrices[w] = planner.metric_matrix(locs, locs, list(w), threads)
+        logger.warning("Cost matrix of weights %s between %s locations in %.2f s.", w, len(locs),
+                       time.perf_counter() - start)
+    return matrices
+
+
+def run(combination):
+    # one replay of the scenario in a worker process, returns its solve times and service KPIs
+    weights, penalty, detour = combination
+    args = SHARED["args"]
+    call, veh = SHARED["inputs"]
+    locs = SHARED["locations"]
+
+    system = System(logger, cache_size=max(1000000, 2 * len(locs) ** 2), rolling=args.rolling)
+    system.set_planner(SHARED["planner"], weights=list(weights))
+    system.store_costs(locs, locs, SHARED["matrices"][weights])
+    # the processes share the cores, one solver thread each
+    system.set_solver(args.time_limit, args.mip_gap, 1)
+    misses = system.distance.stats()["misses"]
+
+    solve = []
+    for now, call_, veh_ in cycles(call, veh, args.step):
+        arrive(system, now, call_, veh_, detour)
+        start = time.perf_counter()
+        if args.engine == "milp":
+            system.opt(penalty, detour)
+        else:
+            system.insert(detour, args.search_time)
+        solve.append(time.perf_counter() - start)
+
+    service = kpis(system, penalty)
+    record = {"weights": "%s %s %s" % weights,
+              "penalty": penalty,
+              "detour": detour,
+              "cycles": len(solve),
+              "solve mean (s)": round(float(np.mean(solve)), 4) if solve else 0,
+              "solve max (s)": round(max(solve, default=0), 4),
+              "users": service["users"],
+              "served": service["served"],
+              "rejected": service["rejected"],
+              "waiting time": round(service["waiting time"], 1),
+              "detour ratio": round(service["detour ratio"], 3),
+              "objective": service["objective"],
+              "queries": system.distance.stats()["misses"] - misses}
+    system.close()
+    return record
+
+
+def sweep(args):
+    planner = RoutingPlanner(*args.weight[0])
+    call, veh = read_inputs(args.calls, args.vehicles)
+    locs = locations(call, veh)
+    weights = [tuple(w) for w in args.weight]
+    combinations = list(itertools.product(dict.fromkeys(weights), args.penalty, args.detour))
+
+    SHARED.update({"args": args,
+                   "planner": planner,
+                   "inputs": (call, veh),
+                   "locations": locs,
+                   "matrices": cost_matrices(planner, locs, weights, args.threads)})
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=min(args.workers, len(combinations)),
+                             mp_context=multiprocessing.get_context("fork")) as pool:
+        records = list(pool.map(run, combinations))
+    elapsed = time.perf_counter() - start
+
+    with open(args.output, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+    result = {key: [record[key] for record in records] for key in records[0]}
+    print("[%s combinations, %s calls, %s vehicles, %s engine]" % (len(combinations), len(call), len(veh),
+                                                                  args.engine))
+    print(tabulate(result, headers="keys", tablefmt="fancy_grid"))
+    print("Swept in %.1f s with %s workers, the records are in %s." % (elapsed, args.workers, args.output))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay one scenario for every combination of the weights, "
+                                                 "penalties and detour ratios over one loaded road network")
+    parser.add_argument("-w", "--weight", type=int, nargs=3, action="append", help="alpha, beta, gamma (repeatable)")
+    parser.add_argument("-p", "--penalty", type=int, nargs="+", default=[10], help="penalties for unvisited stations")
+    parser.add_argument("-d", "--detour", type=float, nargs="+", default=[1.5], help="detour ratios")
+    parser.add_argument("--calls", type=str, default="./input/call-test.csv", help="passenger calls")
+    parser.add_argument("--vehicles", type=str, default="./input/veh-test.csv", help="vehicles entering service")
+    parser.add_argument("--step", type=int, default=60, help="seconds between dispatch cycles")
+    parser.add_argument("--engine", type=str, default="milp", choices=["milp", "insertion"])
+    parser.add_argument("--search-time", type=float, default=0, help="seconds of local search")
+    parser.add_argument("--time-limit", type=float, default=None, help="seconds the MILP may take per cycle")
+    parser.add_argument("--mip-gap", type=float, default=None, help="relative MIP gap of the MILP")
+    parser.add_argument("--rolling", action="store_true", help="rolling-horizon dispatch")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes of the sweep")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(), help="threads of the cost matrices")
+    parser.add_argument("-o", "--output", type=str, default="./sweep.jsonl", help="one record per combination")
+
+    args = parser.parse_args()
+    if args.weight is None:
+        args.weight = [[0, 1, 0]]
+    sweep(args)
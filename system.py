@@ -1,12 +1,20 @@
 # built-in
-import sys
-import copy
+import math
+import time
 import datetime
+import multiprocessing
 import numpy as np
 
-# solver
-import gurobipy as gp
-from gurobipy import *
+from concurrent.futures import ProcessPoolExecutor
+
+# my own
+from cache import DistanceCache
+from dispatch import DispatchModel, DEPOT
+from insertion import Insertion
+from metrics import NoMetrics
+from repair import DetourRepair
+from store import Store
+from zoning import solve_zone, init_worker, handlers
 
 # optimization status dictionary
 status_dict = {1: "loaded",
@@ -27,20 +35,62 @@ status_dict = {1: "loaded",
                16: "work limit",
                17: "memory limit"}
 
+# mean radius of the earth (m)
+EARTH_RADIUS = 6371000
+# locations that stay candidates of every new location beyond the radius, among the stops and the route ends
+NEAREST = 3
+
+
+def haversine(frm, to):
+    # straight-line distances (m) between two arrays of longitude, latitude rows
+    frm = np.radians(frm)[:, None, :]
+    to = np.radians(to)[None, :, :]
+    a = (np.sin((to[..., 1] - frm[..., 1]) / 2) ** 2
+         + np.cos(frm[..., 1]) * np.cos(to[..., 1]) * np.sin((to[..., 0] - frm[..., 0]) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+# phases of a dispatch cycle: cost queries, model update, solve and route bookkeeping
+PHASES = ("routing", "build", "solve", "post")
+
 
 class System:
-    def __init__(self, logger):
+    def __init__(self, logger, cache_size=1000000, cache_path=None, rolling=False, radius=None):
         super(System, self).__init__()
         self.time = None
         self.vehicles_ids = set()
         self.users_ids = set()
 
-        self.vehicles = set()
-        self.users = set()
-        self.stops = [(0, 0)]
+        self.vehicles = Store()
+        self.users = Store()
+        self.stops = [DEPOT]
 
-        self.distance = {0: {}}     # 0 is artificial depot
+        # 0 is artificial depot, its costs are always 0 and never stored
+        self.distance = DistanceCache(cache_size, logger)
+        self.duration = DistanceCache(cache_size, logger)   # travel time (s) along the optimal path
+        self.cache_path = cache_path
         self.planner = None
+        self.use_ch = False         # query the contraction hierarchy of the planner instead of A*
+        self.weights = None
+        self.model = DispatchModel(logger)  # kept alive across the dispatch cycles
+        self.timings = dict.fromkeys(PHASES, 0.0)  # seconds spent per phase since the last reset
+        self.metrics = NoMetrics()
+        self.cache_stats = self.distance.stats()    # distance cache counters at the last metrics flush
+        self.rolling = rolling      # retire the completed users and plan every route from its committed prefix
+        self.zoning = None          # one model per zone instead of the single model, if set
+        self.pool = None            # worker processes of the zone models
+        self.radius = radius        # exact costs only between the locations this close (m), all of them if None
+        self.candidates = {}        # location -> stop locations whose costs from and to it are exact under the radius
+        self.coords = {}            # location -> longitude, latitude
+        self.solver = {}            # time limit, MIP gap and threads of the models
+        self.iis_path = None        # the irreducible infeasible subsystem of an infeasible model is written here
+        self.rejected = []          # users rejected by the detour repair, waiting for the reinsertion pass
+        self.rejections = 0         # users rejected by the detour repair so far
+        # totals of the served users that already left the system, for the KPIs of the whole run
+        self.completed = {"users": 0, "seats": 0, "waiting time": 0.0, "detour ratio": 0.0}
+        # users and vehicles whose records may have changed since the report took them, if tracked
+        self.dirty_users = None
+        self.dirty_vehicles = None
 
         self.logger = logger
 
@@ -48,291 +98,534 @@ class System:
     def set_time(self, time):
         self.time = time
 
-    def set_planner(self, planner):
+    def set_planner(self, planner, use_ch=False, weights=None):
         self.planner = planner
+        self.use_ch = use_ch
+        self.weights = weights      # alpha, beta, gamma of the queries, the weights of the planner if None
+        # the warm-start distances are only valid for the same weights and road network
+        self.distance.load(self.cache_path, self.signature())
+
+    def set_metrics(self, metrics):
+        self.metrics = metrics
+
+    def track(self):
+        self.dirty_users = {}
+        self.dirty_vehicles = {}
+
+    def touch(self, users=(), vehicles=()):
+        # dicts as ordered sets, the records are taken in the order the objects changed
+        if self.dirty_users is not None:
+            self.dirty_users.update(dict.fromkeys(users))
+            self.dirty_vehicles.update(dict.fromkeys(vehicles))
+
+    def take_dirty(self):
+        users, vehicles = list(self.dirty_users), list(self.dirty_vehicles)
+        self.track()
+        return users, vehicles
+
+    def set_zoning(self, zoning, workers):
+        # spawned workers, a forked child would share the Gurobi environment of this process
+        self.zoning = zoning
+        self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=init_worker,
+                                        initargs=(self.logger.name, self.logger.level, handlers(self.logger)))
+
+    def set_solver(self, time_limit=None, mip_gap=None, threads=None, iis_path=None):
+        self.solver = {"time_limit": time_limit, "mip_gap": mip_gap, "threads": threads}
+        self.iis_path = iis_path
+        self.model.set_params(**self.solver)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
 
     # GET
-    def get_cost(self, frm, to):
-        if frm in self.distance.keys():
-            if to not in self.distance[frm].keys():
-                if frm == 0 or to == 0:
-                    self.distance[frm][to] = 0
-                else:
-                    self.planner.init()
-                    self.distance[frm][to] = self.planner.astar(frm, to)
-        else:
-            self.distance[frm] = {to: 0}
-            if frm == 0 or to == 0:
-                self.distance[frm][to] = 0
+    def query(self, frm, to):
+        with self.metrics.timer("query time"):
+            if self.use_ch:
+                cost = self.planner.ch_query(frm, to)
+            elif self.weights is not None:
+                cost = self.planner.route(frm, to, self.weights)["cost"]
             else:
                 self.planner.init()
-                self.distance[frm][to] = self.planner.astar(frm, to)
+                cost = self.planner.astar(frm, to)
+        if self.metrics.enabled:
+            self.metrics.add("queries")
+            self.metrics.add("settled nodes", self.planner.stats()["settled"])
+        return cost
 
+    def get_cost(self, frm, to):
+        if frm == 0 or to == 0:
+            return 0
+        cost = self.distance.get(frm, to)
+        if cost is None:
+            cost = self.query(frm, to)
+            self.distance.put(frm, to, cost)
+        return cost
+
+    def get_candidate_cost(self, frm, to):
+        # the pairs that are no candidates are neither looked up nor computed, they cost inf
+        if self.radius is None or frm == 0 or to == 0 or to in self.candidates.get(frm, ()):
+            return self.get_cost(frm, to)
+        return math.inf
+
+    def coordinates(self, locs):
+        missing = [loc for loc in dict.fromkeys(locs) if loc not in self.coords]
+        if len(missing) > 0:
+            for loc, coord in zip(missing, self.planner.coordinates(missing)):
+                self.coords[loc] = coord
+        return np.array([self.coords[loc] for loc in locs], dtype=float).reshape(-1, 2)
+
+    def get_costs(self, frms, tos):
+        frms = [frm for frm in dict.fromkeys(frms) if frm != 0]
+        tos = [to for to in dict.fromkeys(tos) if to != 0]
+
+        # one search tree per source with missing entries, probed without counting lookups or touching the LRU order
+        sources = [frm for frm in frms if any((frm, to) not in self.distance for to in tos)]
+        if len(sources) == 0 or len(tos) == 0:
+            return
+        start = time.perf_counter()
+        if self.use_ch:
+            matrix = self.planner.ch_cost_matrix(sources, tos)
+            for i, frm in enumerate(sources):
+                for j, to in enumerate(tos):
+                    self.distance.put(frm, to, float(matrix[i, j]))
+        else:
+            self.store_costs(sources, tos, self.planner.metric_matrix(sources, tos, self.weights))
+        if self.metrics.enabled:
+            self.metrics.add("matrix time", time.perf_counter() - start)
+            self.metrics.add("matrix sources", len(sources))
+            self.metrics.add("settled nodes", self.planner.stats()["settled"])
+
+    def get_duration(self, frm, to):
+        if frm == 0 or to == 0:
+            return 0
+        duration = self.duration.get(frm, to)
+        if duration is None:
+            duration = self.planner.route(frm, to, self.weights)["travel_time"]
+            self.duration.put(frm, to, duration)
+        return duration
+
+    def vehicle_path(self, v):
+        # node IDs and coordinates along the route of a vehicle, and the position of every stop in them
+        ids, coords, offsets = self.planner.route_path([loc for loc, _, _ in v.route], self.weights)
+        return {"nodes": ids, "coordinates": coords, "stops": offsets}
+
+    def signature(self):
+        signature = self.planner.signature()
+        weights = signature["weights"] if self.weights is None else self.weights
+        return {"weights": [float(w) for w in weights], "graph": signature["graph"]}
+
+    def save_cache(self):
+        self.distance.save(self.cache_path, self.signature())
+
+    def flush_metrics(self):
+        # cost lookups of the cycle, from the counters of the distance cache
+        stats = self.distance.stats()
+        self.metrics.set("cost lookups", stats["hits"] + stats["misses"]
+                         - self.cache_stats["hits"] - self.cache_stats["misses"])
+        self.metrics.set("cache hits", stats["hits"] - self.cache_stats["hits"])
+        self.metrics.set("cache size", stats["size"])
+        self.cache_stats = stats
+        self.metrics.flush(self.time, **self.timings)
+
+    def update_costs(self, new_locs):
+        start = time.perf_counter()
+        locs = [loc for loc, _ in self.stops]
+        if self.radius is None:
+            self.get_costs(new_locs, locs)
+            self.get_costs(locs, new_locs)
+        else:
+            # only the candidate pairs, by the straight-line distance
+            new_locs = [loc for loc in dict.fromkeys(new_locs) if loc != 0]
+            locs = [loc for loc in dict.fromkeys(locs) if loc != 0]
+            distances = haversine(self.coordinates(new_locs), self.coordinates(locs))
+            near = distances <= self.radius
+            # the nearest stops and the nearest route ends are candidates beyond the radius, so every new stop can be
+            # reached and left and every new call can be appended to a route
+            rows = np.arange(len(new_locs))[:, None]
+            near[rows, np.argsort(distances, axis=1)[:, :NEAREST]] = True
+            ends = np.flatnonzero(np.isin(locs, [v.route[-1][0] if len(v.route) > 0 else v.origin
+                                                 for v in self.vehicles]))
+            if len(ends) > 0:
+                near[rows, ends[np.argsort(distances[:, ends], axis=1)[:, :NEAREST]]] = True
+            # one search tree per row and per column, each only as deep as its candidates
+            for loc, row in zip(new_locs, near):
+                tos = [to for to, candidate in zip(locs, row) if candidate]
+                self.get_costs([loc], tos)
+                self.add_candidates((loc, to) for to in tos)
+            for frm, column in zip(locs, near.T):
+                tos = [to for to, candidate in zip(new_locs, column) if candidate]
+                if len(tos) > 0:
+                    self.get_costs([frm], tos)
+            if self.metrics.enabled:
+                self.metrics.add("candidate pairs", 2 * int(near.sum()))
+                self.metrics.add("all pairs", 2 * near.size)
+        self.timings["routing"] += time.perf_counter() - start
+
+    def add_candidates(self, pairs):
+        for frm, to in pairs:
+            self.candidates.setdefault(frm, set()).add(to)
+            self.candidates.setdefault(to, set()).add(frm)
+
+    def prune_candidates(self):
+        # the candidates follow the stops, the locations no stop is at any more are dropped
+        locs = {loc for loc, _ in self.stops}
+        for loc in [loc for loc in self.candidates if loc not in locs]:
+            for other in self.candidates.pop(loc):
+                if other in self.candidates:
+                    self.candidates[other].discard(loc)
+
+    def store_costs(self, frms, tos, matrix):
+        # cost, length, travel time, emission of every pair, as returned by the metric matrix of the planner
+        for i, frm in enumerate(frms):
+            for j, to in enumerate(tos):
+                self.distance.put(frm, to, float(matrix[i, j, 0]))
+                self.duration.put(frm, to, float(matrix[i, j, 2]))
+
+    def reset_timings(self):
+        self.timings = dict.fromkeys(PHASES, 0.0)
 
     # ADD
-    def add_vehicles(self, veh):
-        self.vehicles_ids.add(veh.id)   # add ids set
-        self.vehicles.add(veh)          # add vehicles set
-
-        # calculating distance from/to artificial depot
-        self.get_cost(0, veh.loc)
-        self.get_cost(veh.loc, 0)
-        self.stops.append((veh.loc, veh))
+    def add_vehicles(self, vehicles):
+        new_locs = []
+        for veh in vehicles:
+            self.vehicles_ids.add(veh.id)   # add ids set
+            self.vehicles.add(veh)          # add vehicles store
+            self.stops.append((veh.origin, veh))
+            new_locs.append(veh.origin)
+
+        # calculating distance from/to all stops including the artificial depot
+        try:
+            self.update_costs(new_locs)
+        except Exception:
+            # nothing of the vehicles stays if their costs cannot be computed
+            self.remove_vehicles(vehicles)
+            raise
+        self.touch(vehicles=vehicles)
+
+    def add_users(self, users):
+        new_locs = []
+        for user in users:
+            self.users_ids.add(user.id)     # add ids set
+            self.users.add(user)            # add users store
+            self.stops.append((user.pu, user))
+            self.stops.append((user.do, user))
+            new_locs += [user.pu, user.do]
+
+        # calculating distance from/to all stops including the artificial depot
+        try:
+            self.update_costs(new_locs)
+            for user in users:
+                user.shortest_time = self.get_cost(user.pu, user.do)
+        except Exception:
+            # nothing of the users stays if their costs cannot be computed
+            self.remove_users(users)
+            raise
+
+        # the own leg of a user is always exact, whatever the radius
+        self.add_candidates((user.pu, user.do) for user in users)
+        self.touch(users=users)
+
+    def remove_vehicles(self, vehicles):
+        # vehicles just added, before any dispatch
+        vehicles = set(vehicles)
+        for veh in vehicles:
+            self.vehicles_ids.discard(veh.id)
+            self.vehicles.discard(veh)
+        self.stops = [stop for stop in self.stops if stop[1] not in vehicles]
+        self.prune_candidates()
+
+    def remove_users(self, users):
+        # users just added, before any dispatch
+        users = set(users)
+        for user in users:
+            self.users_ids.discard(user.id)
+            self.users.discard(user)
+        self.stops = [stop for stop in self.stops if stop[1] not in users]
+        self.prune_candidates()
+
+    def complete(self, users):
+        # the served users leave the system, only their totals are kept
+        for user in users:
+            self.completed["users"] += 1
+            self.completed["seats"] += user.cap
+            self.completed["waiting time"] += user.expected_waiting_time
+            self.completed["detour ratio"] += user.expected_travel_time / user.shortest_time
+
+    def retire(self, veh):
+        # the users of a vehicle at the end of its working time are served and leave with it
+        self.logger.info("%s finished its working time with %s.", veh, veh.on_board)
+        self.touch(veh.on_board, [veh])
+        self.complete(veh.on_board)
+        self.vehicles.remove(veh)
+        self.stops.remove((veh.origin, veh))
+        # the pickups of the riding users are already gone in rolling horizon
+        self.users.difference_update(veh.on_board)
+        self.stops = [(loc, u) for loc, u in self.stops if u not in veh.on_board]
+
+    def collapse(self, v):
+        # the stops passed and the one the vehicle is heading to are committed, the latter becomes the origin
+        if len(v.route) <= 1:
+            return
+        idx = min(v.passed(self.time), len(v.route) - 1)
+        if idx == 0:
+            return
+        old = (v.origin, v)
+        self.touch([u for _, u, _ in v.route[1:idx + 1]], [v])
+        done = v.collapse(idx, v.route[idx][2])
+        if len(done) > 0:
+            self.logger.info("%s dropped off %s.", v, done)
+        self.users.difference_update(done)
+        self.complete(done)
+
+        # committed pickups and dropoffs leave the stops, the origin takes the place of the old one
+        committed = {(loc, u) for loc, u in self.stops if u in done or (u in v.riding and loc == u.pu)}
+        self.stops = [(v.origin, v) if stop == old else stop for stop in self.stops if stop not in committed]
+        self.update_costs([v.origin])
+
+    def refresh(self):
+        for veh in [v for v in self.vehicles
+                    if (v.time + datetime.timedelta(seconds=v.working_time)) <= self.time]:
+            self.retire(veh)
+
+        if self.rolling:
+            for v in self.vehicles:
+                self.collapse(v)
+        self.prune_candidates()
 
-        for v in self.vehicles:
-            self.get_cost(v.loc, veh.loc)
-            self.get_cost(veh.loc, v.loc)
-
-        for u in self.users:
-            self.get_cost(u.pu, veh.loc)
-            self.get_cost(veh.loc, u.pu)
-            self.get_cost(u.do, veh.loc)
-            self.get_cost(veh.loc, u.do)
-
-    def add_users(self, user):
-        self.users_ids.add(user.id)     # add ids set
-        self.users.add(user)            # add users set
-        self.get_cost(user.pu, user.do)
-        self.stops.append((user.pu, user))
-        self.stops.append((user.do, user))
-        user.shortest_time = self.distance[user.pu][user.do]
-
-        # calculating distance from/to artificial depot
-        self.get_cost(0, user.pu)
-        self.get_cost(user.pu, 0)
-        self.get_cost(0, user.do)
-        self.get_cost(user.do, 0)
-
-        for v in self.vehicles:
-            self.get_cost(v.loc, user.pu)
-            self.get_cost(user.pu, v.loc)
-            self.get_cost(v.loc, user.do)
-            self.get_cost(user.do, v.loc)
-
-        for u in self.users:
-            self.get_cost(u.pu, user.pu)
-            self.get_cost(user.pu, u.pu)
-            self.get_cost(u.do, user.pu)
-            self.get_cost(user.pu, u.do)
-            self.get_cost(u.pu, user.do)
-            self.get_cost(user.do, u.pu)
-            self.get_cost(u.do, user.do)
-            self.get_cost(user.do, u.do)
-
-    def opt(self, pty, detour):
-        # optimization model
-        m = gp.Model()
-        m.Params.outputFlag = False
-
-        # idx -> stop
-        idx = 0
-        nv = 0
-        idx_stops = {}
-        stops_idx = {}
         for loc, user in self.stops:
-            if (user in self.vehicles) and (user.time + datetime.timedelta(seconds=user.working_time)) <= self.time:
-                self.vehicles.remove(user)
-                continue
-            # if (user in self.users) and (user.vehicle != None):
-            #     continue
-            idx_stops[idx] = (loc, user)
-            stops_idx[(loc, user)] = idx
-            idx += 1
-
-        # number of stops
-        n = len(idx_stops)
-        # number of vehicles
-        nv = len(self.vehicles)
-
-        # origins, pickups, dropoffs
-        origins = []
-        pickups = []
-        dropoffs = []
-        for (loc, user), idx in stops_idx.items():
-            if user in self.vehicles:
-                origins.append(idx)
-            elif user in self.users and user.pu == loc:
-                pickups.append(idx)
+            if user in self.users and user.pu == loc:
                 user.reset()
-            elif user in self.users and user.do == loc:
-                dropoffs.append(idx)
-
-        # capacity
-        p = {}
-        penalty = {}
-        for i in range(n):
-            for v in range(nv):
-                if i in pickups:
-                    p[(i, v)] = -1 * idx_stops[i][1].cap
-                else:
-                    p[(i, v)] = 0
-            penalty[i] = pty
-        penalty[0] = 0
-
-        # vehicles
-        vehicles = list(self.vehicles)
-
-        # edges
-        e_vars = m.addVars([(i, j, k)
-                            for i in range(n) for j in range(n) for k in range(nv) if i != j],
-                           vtype=GRB.BINARY, name="e")
-        # passengers
-        p_vars = m.addVars(p.keys(), obj=p, vtype=GRB.BINARY, name="p")
-        # penalty
-        pty_vars = m.addVars(penalty.keys(), obj=penalty, vtype=GRB.BINARY, name="penalty")
-        # sequences
-        s_vars = m.addVars(np.arange(1, n + 1), lb=1, ub=n, vtype=GRB.INTEGER, name="sequence")
-
-        #
-        for v in range(nv):
-            for user in vehicles[v].on_board:
-                m.addConstr(p_vars[stops_idx[(user.pu, user)], v] == 1)
-            if vehicles[v].next_loc is not None:
-                m.addConstr(e_vars[stops_idx[vehicles[v].here], stops_idx[vehicles[v].next_loc], v] == 1)
-
-        cons1 = m.addConstrs(p_vars.sum(i, "*") <= 1 for i in range(n) if i != 0)
-        # Constraint 2: visited node i must have an outgoing edge.
-        cons2 = m.addConstrs(e_vars.sum(i, "*", v) == p_vars[(i, v)] for i in range(n) for v in range(nv)
-                             if i not in origins and i != 0)
-        # Constraint 3: visited node j must have an ingoing edge.
-        cons3 = m.addConstrs(e_vars.sum("*", j, v) == p_vars[(j, v)] for j in range(n) for v in range(nv)
-                             if j not in origins and j != 0)
-        # # Constraint 4: considering the origin.
-        cons4_1 = m.addConstr(p_vars.sum(0, "*") == nv)
-        cons4_2 = m.addConstrs(e_vars.sum("*", 0, v) == 1 for v in range(nv))
-        cons4_3 = m.addConstrs(e_vars.sum(0, "*", v) == 0 for v in range(nv))
-        # # Constraint 5: fixed initial positions.
-        cons5_1 = m.addConstrs(p_vars[stops_idx[(vehicles[v].loc, vehicles[v])], v] == 1 for v in range(nv))
-        cons5_2 = m.addConstrs(e_vars.sum(stops_idx[(vehicles[v].loc, vehicles[v])], "*", v) ==
-                               p_vars[stops_idx[(vehicles[v].loc, vehicles[v])], v] for v in range(nv))
-        cons5_3 = m.addConstrs(e_vars.sum("*", stops_idx[(vehicles[v].loc, vehicles[v])], "*") == 0 for v in range(nv))
-        # Constraint 6: working time limit.
-        cons6 = m.addConstrs(gp.quicksum(e_vars[i, j, v] * self.distance[idx_stops[i][0]][idx_stops[j][0]]
-                                         for i in range(n) for j in range(n) if i != j) <= vehicles[v].working_time
-                             for v in range(nv))
-        # Constraint 7: capacity limit
-        cons7 = m.addConstrs(gp.quicksum(-1 * p[i, v] * p_vars[i, v] for i in range(n)) <= vehicles[v].capacity
-                             for v in range(nv))
-        # Constraint 8: penalty
-        cons8 = m.addConstrs(1 - p_vars.sum(i, "*") == pty_vars[i] for i in range(n) if i != 0)
-        # # Constraint 9: pickup-dropoff pairs
-        cons9 = m.addConstrs(p_vars[stops_idx[(user.pu, user)], v] == p_vars[stops_idx[(user.do, user)], v]
-                             for user in self.users for v in range(nv))
-        # Constraint 10: sequences
-        cons10_1 = m.addConstrs(s_vars[i] <= s_vars[j] + n * (1 - e_vars[i, j, k]) - 1
-                                for i, j, k in e_vars.keys() if i != 0 and j != 0)
-        cons10_2 = m.addConstrs(s_vars[stops_idx[(user.pu, user)]] + 1 <= s_vars[stops_idx[(user.do, user)]]
-                                for user in self.users)
-
-        def subtourlim(model, where):
-            if where == GRB.Callback.MIPSOL:
-                # make a list of edges selected in the solution
-                vals = model.cbGetSolution(model._vars)
-                selected = gp.tuplelist((i, j, k) for i, j, k in model._vars.keys() if vals[i, j, k] > 0.5)
-                # find the shortest cycle in the selected edge list
-                tour = subtour(selected)
-                for v in range(nv):
-                    if tour[v]:
-                        for tv in tour[v]:
-                            if len(tv) < n:
-                                # add subtour elimination constraint for every pair of cities in tour
-                                model.cbLazy(gp.quicksum(model._vars[i, j, v] for i, j in itertools.permutations(tv, 2))
-                                             <= len(tv) - 1)
-
-        def subtour(edges, exclude_depot=True):
-            cycle = [[] for v in range(nv)]
-
-            for v in range(nv):
-                unvisited = list(np.arange(0, n))
-
-                while unvisited:  # true if list is non-empty
-                    this_cycle = []
-                    neighbors = unvisited
-
-                    while neighbors:
-                        current = neighbors[0]
-                        this_cycle.append(current)
-                        unvisited.remove(current)
-                        neighbors = [j for i, j, k in edges.select(current, '*', '*') if (j in unvisited) and (k == v)]
-
-                    if len(this_cycle) > 1:
-                        if exclude_depot:
-                            if not (0 in this_cycle):
-                                cycle[v].append(this_cycle)
-            return cycle
-
-        m._vars = e_vars
-        m._dvars = p_vars
-        m._ddvars = penalty
-        m._svars = s_vars
-        m.Params.lazyConstraints = 1
-        m.optimize(subtourlim)
 
-        # status
-        self.logger.info("Solved (%s)", status_dict[m.status])
-
-        if m.status != 2:
-            if m.status == 3:
-                m.computeIIS()
-                m.write("model.ilp")
-            sys.exit("There is no solution. Check constraints again.")
+    def opt(self, pty, detour):
+        if self.zoning is not None:
+            return self.opt_zones(pty, detour)
+        self.refresh()
+        start = time.perf_counter()
+
+        # add and remove the variables and constraints of the stops and vehicles that changed since the last cycle
+        # the riding users are only left with their dropoffs
+        riding = {user for v in self.vehicles for user in v.riding}
+        self.model.update(self.stops, self.vehicles, [user for user in self.users if user not in riding],
+                          self.get_candidate_cost, pty, detour)
+        self.model.fix(self.vehicles)
+
+        # the MIP start inserts the new users into the current routes, so a solve stopped at a limit serves them too
+        heuristic = self.insertion(detour)
+        assigned = {user for v in self.vehicles for user in v.on_board}
+        heuristic.insert(sorted((user for user in self.users if user not in assigned),
+                                key=lambda x: (-x.cap, x.time, x.id)))
+        self.timings["build"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        status = self.model.solve(heuristic.routes)
+        self.timings["solve"] += time.perf_counter() - start
+        if self.metrics.enabled:
+            m = self.model.m
+            self.metrics.set("variables", m.NumVars)
+            self.metrics.set("constraints", m.NumConstrs)
+            self.metrics.set("runtime", m.Runtime)
+            self.metrics.set("node count", m.NodeCount)
+            self.metrics.set("mip gap", m.MIPGap if m.SolCount > 0 else None)
+            self.metrics.set("subtour callbacks", self.model.callbacks)
+            self.metrics.set("callback time", self.model.callback_time)
 
-        e_vals = m.getAttr('x', e_vars)
+        # status
+        self.logger.info("Solved (%s) in %.3f s, %s subtour callbacks took %.1f ms.", status_dict[status],
+                         time.perf_counter() - start, self.model.callbacks, 1000 * self.model.callback_time)
+
+        if self.model.m.SolCount == 0:
+            # not even the current routes are a solution, the new users are inserted into them instead
+            if status == 3 and self.iis_path is not None:
+                self.model.write_iis(self.iis_path)
+            self.logger.info("There is no solution (%s), the new users are inserted into the current routes.",
+                             status_dict[status])
+            return self.insert(detour)
+        if status != 2:
+            self.logger.info("The incumbent is accepted (%s, MIP gap %.2f%%).", status_dict[status],
+                             100 * self.model.m.MIPGap)
 
         # get solutions
-        sol = {}
-        for car in range(nv):
-            sol[car] = {}
-        for i, j, k in e_vals.keys():
-            if e_vals[i, j, k] > 0.5:
-                sol[k][i] = j
-
-        for v_idx, v in enumerate(self.vehicles):
-            v.reset()
-            route = sol[v_idx]
-            station = stops_idx[(v.loc, v)]
-
-            travel_time = 0
-            over_system_time = False
-            while True:
-                station_ = copy.copy(station)
+        start = time.perf_counter()
+        sol = self.model.routes()
+
+        for v in self.vehicles:
+            route = sol[v]
+            stations = []
+            station = route[(v.origin, v)]
+            while station != DEPOT:
+                stations.append(station)
                 station = route[station]
-                travel_time += self.distance[idx_stops[station_][0]][idx_stops[station][0]]
-                if station == 0:
-                    break
-                elif station in pickups:
-                    user = idx_stops[station][1]
-                    user.set_waiting_time(travel_time)
-                    v.accept_user(user)
-                elif station in dropoffs:
-                    user = idx_stops[station][1]
-                    user.set_travel_time(travel_time - user.expected_waiting_time)
-                    v.detour_ratio[user] = user.expected_travel_time / user.shortest_time
-                v.add_route((idx_stops[station][0], idx_stops[station][1], travel_time))
-
-                if not over_system_time:
-                    if self.time <= v.time + datetime.timedelta(seconds=travel_time):
-                        over_system_time = True
-
-                v.travel_time = travel_time
-
-            # is detour
-            while v.is_detour(detour):
-                users_over_limit = []
-                booking = None
-                for user, dr in v.detour_ratio.items():
-                    if dr > detour:
-                        if user != v.next_loc[1]:
-                            users_over_limit.append(user)
-                        else:
-                            booking = user
-
-                if booking is not None:
-                    v.detour_ratio.pop(booking)
-
-                if len(users_over_limit) > 0:
-                    min_cap_user = min(users_over_limit, key=lambda x: x.cap)
-                    min_cap_user.stopover(v)
-                    v.reject_user(min_cap_user, self.distance, self.time)
-
-            v.move(self.time)
\ No newline at end of file
+            self.set_route(v, stations, detour)
+        self.reinsert(detour)
+        self.timings["post"] += time.perf_counter() - start
+
+    def opt_zones(self, pty, detour):
+        self.refresh()
+        start = time.perf_counter()
+
+        # every zone is solved on its own, with the costs between its locations
+        owner = {user: v for v in self.vehicles for user in v.on_board}
+        zones, boundary = self.zoning.split(self.vehicles, self.users, owner)
+        jobs = []
+        for vehicles, users in zones:
+            members = set(vehicles) | set(users)
+            stops = [DEPOT] + [stop for stop in self.stops if stop[1] in members]
+            locs = {loc for loc, _ in stops[1:]} | {user.pu for user in users}
+            costs = {(frm, to): self.get_candidate_cost(frm, to) for frm in locs for to in locs}
+            riding = {user for v in vehicles for user in v.riding}
+            jobs.append((stops, vehicles, [user for user in users if user not in riding], costs, pty, detour,
+                         self.solver, self.logger))
+        self.timings["build"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = list(self.pool.map(solve_zone, jobs))
+        self.timings["solve"] += time.perf_counter() - start
+        self.logger.info("Solved %s zones in %.3f s (slowest %.3f s), %s boundary requests.", len(zones),
+                         time.perf_counter() - start, max((runtime for _, _, runtime in results), default=0),
+                         len(boundary))
+        if self.metrics.enabled:
+            self.metrics.set("zones", len(zones))
+            self.metrics.set("boundary requests", len(boundary))
+
+        start = time.perf_counter()
+        for (vehicles, users), (status, routes, _) in zip(zones, results):
+            if routes is None:
+                # the vehicles of the zone keep their routes and its new users are reconciled with the others
+                self.logger.info("There is no solution in a zone (%s), its routes are kept.", status_dict[status])
+                for v in vehicles:
+                    self.set_route(v, [(loc, u) for loc, u, _ in v.route[1:]], detour)
+                continue
+            ids = {user.id: user for user in users}
+            for v in vehicles:
+                self.set_route(v, [(loc, ids[uid]) for loc, uid in routes[v.id]], detour)
+
+        # the boundary requests and the users left unserved in their zones are inserted across the zones
+        # the users rejected by the detour repair of the zone routes are among them
+        self.rejected = []
+        served = {user for v in self.vehicles for user in v.on_board}
+        users = sorted((user for user in self.users if user not in served), key=lambda x: (-x.cap, x.time, x.id))
+        heuristic = self.insertion(detour)
+        unassigned = heuristic.insert(users)
+        for v in {heuristic.owner[user] for user in heuristic.owner}:
+            self.set_route(v, heuristic.routes[v][1:], detour)
+        self.logger.info("Reconciled %s of %s users across the zones.", len(users) - len(unassigned), len(users))
+        self.reinsert(detour)
+        self.timings["post"] += time.perf_counter() - start
+
+    def insertion(self, detour):
+        # insertion heuristic over the current routes
+        heuristic = Insertion(self.get_candidate_cost, detour)
+        for v in self.vehicles:
+            route = v.route if len(v.route) > 0 else [(v.origin, v, v.offset)]
+            # the stops already passed and the one the vehicle is heading to are committed
+            frozen = min(v.passed(self.time) + 1, len(route))
+            heuristic.add_route(v, [(loc, u) for loc, u, _ in route], frozen)
+        return heuristic
+
+    def insert(self, detour, search_time=0):
+        self.refresh()
+        start = time.perf_counter()
+        deadline = time.time() + search_time
+
+        heuristic = self.insertion(detour)
+        assigned = {user for v in self.vehicles for user in v.on_board}
+
+        # the largest groups first, they weigh the most in the objective
+        users = sorted((user for user in self.users if user not in assigned), key=lambda x: (-x.cap, x.time, x.id))
+        unassigned = heuristic.insert(users)
+        if search_time > 0:
+            unassigned = heuristic.search(unassigned, deadline)
+        self.timings["solve"] += time.perf_counter() - start
+
+        self.logger.info("Inserted %s of %s users in %.3f s (route cost %.1f).",
+                         len(users) - len(unassigned), len(users), time.perf_counter() - start, heuristic.total())
+
+        start = time.perf_counter()
+        for v in self.vehicles:
+            self.set_route(v, heuristic.routes[v][1:], detour)
+        self.reinsert(detour)
+        self.timings["post"] += time.perf_counter() - start
+
+    def set_route(self, v, stations, detour):
+        # the users that leave the route and the ones that join it
+        self.touch(v.on_board + [user for _, user in stations], [v])
+        v.reset()
+        travel_time = v.offset
+        over_system_time = False
+        station = (v.origin, v)
+        for station_, station in zip([station] + stations[:-1], stations):
+            travel_time += self.get_cost(station_[0], station[0])
+            user = station[1]
+            if user.pu == station[0]:
+                user.set_waiting_time(travel_time)
+                v.accept_user(user)
+            else:
+                user.set_travel_time(travel_time - user.expected_waiting_time)
+                v.detour_ratio[user] = user.expected_travel_time / user.shortest_time
+            v.add_route((station[0], station[1], travel_time))
+
+            if not over_system_time:
+                if self.time <= v.time + datetime.timedelta(seconds=travel_time):
+                    over_system_time = True
+
+            v.travel_time = travel_time
+
+        # is detour
+        with self.metrics.timer("detour repair"):
+            self.repair(v, detour)
+        if self.radius is not None:
+            # the legs the route uses stay exact for the insertions and the model of the next cycles
+            self.add_candidates((frm, to) for (frm, _, _), (to, _, _) in zip(v.route[:-1], v.route[1:]))
+
+        v.driving_time = sum(self.get_duration(frm, to)
+                             for (frm, _, _), (to, _, _) in zip(v.route[:-1], v.route[1:]))
+        v.move(self.time)
+
+    def repair(self, v, detour):
+        # the riding users and the user the vehicle is heading to cannot be rejected
+        committed = set(v.riding)
+        if v.next_loc is not None:
+            committed.add(v.next_loc[1])
+        route, rejected = DetourRepair(self.get_cost, detour).run(v.route, committed)
+        if len(rejected) == 0:
+            return
+
+        for user, ratio in rejected:
+            v.reject_user(user, ratio)
+            user.stopover(v)
+        self.rejected.extend(user for user, _ in rejected)
+        self.rejections += len(rejected)
+
+        # the stops after the first rejected one are reached earlier
+        v.route = route
+        v.travel_time = route[-1][2]
+        for loc, user, tt in route[1:]:
+            if user.pu == loc:
+                user.set_waiting_time(tt)
+            else:
+                user.set_travel_time(tt - user.expected_waiting_time)
+                v.detour_ratio[user] = user.expected_travel_time / user.shortest_time
+
+    def reinsert(self, detour):
+        # the users rejected by the detour repair are inserted into the other routes, or wait for the next cycle
+        users = sorted(self.rejected, key=lambda x: (-x.cap, x.time, x.id))
+        if len(users) == 0:
+            return
+        heuristic = self.insertion(detour)
+        unassigned = heuristic.insert(users)
+        for v in {heuristic.owner[user] for user in heuristic.owner}:
+            self.set_route(v, heuristic.routes[v][1:], detour)
+        self.logger.info("Reinserted %s of %s users rejected by the detour repair.",
+                         len(users) - len(unassigned), len(users))
+        if self.metrics.enabled:
+            self.metrics.set("rejected", len(users))
+            self.metrics.set("reinserted", len(users) - len(unassigned))
+        # the users rejected again are not retried until the next cycle
+        self.rejected = []
+
+    def objective(self, pty):
+        # objective of the MILP, served users are rewarded and both stops of an unserved user are penalized
+        served = {user for v in self.vehicles for user in v.on_board}
+        return sum(-1 * user.cap if user in served else 2 * pty for user in self.users)
@@ -1,4 +1,7 @@
 class User:
+    __slots__ = ("time", "id", "pu", "do", "cap", "shortest_time", "expected_waiting_time", "expected_travel_time",
+                 "vehicle", "pick_up", "drop_off", "index", "logger")
+
     def __init__(self, time, id, pu, do, cap, logger):
         super(User, self).__init__()
         self.time = time
@@ -14,6 +17,7 @@ class User:
         self.vehicle = None
         self.pick_up = False
         self.drop_off = False
+        self.index = None       # position in the user store of the system
 
         self.logger = logger
 
@@ -1,12 +1,18 @@
-import datetime
+import bisect
 
 
 class Vehicle:
+    __slots__ = ("time", "id", "loc", "origin", "offset", "riding", "here", "next_loc", "working_time", "capacity",
+                 "detour_ratio", "route", "on_board", "num_users", "travel_time", "driving_time", "index", "logger")
+
     def __init__(self, time, id, loc, working_time, cap, detour_ratio, logger):
         super(Vehicle, self).__init__()
         self.time = time
         self.id = id
         self.loc = loc
+        self.origin = loc       # where the route is planned from, moves forward in rolling horizon
+        self.offset = 0         # seconds from the start time to the origin
+        self.riding = []        # users picked up before the origin and not dropped off yet
         self.here = (loc, self)
         self.next_loc = None
         self.working_time = working_time
@@ -18,6 +24,8 @@ class Vehicle:
         self.num_users = 0
         self.detour_ratio = {}
         self.travel_time = 0
+        self.driving_time = 0
+        self.index = None       # position in the vehicle store of the system
 
         self.logger = logger
 
@@ -26,11 +34,37 @@ class Vehicle:
 
     # RESET
     def reset(self):
-        self.route = [(self.loc, self, 0)]
-        self.on_board = []
+        self.route = [(self.origin, self, self.offset)]
+        self.on_board = list(self.riding)
         self.detour_ratio = {}
-        self.travel_time = 0
-        self.num_users = 0
+        self.travel_time = self.offset
+        self.driving_time = 0
+        self.num_users = sum(user.cap for user in self.riding)
+
+    # GET
+    def passed(self, now):
+        # number of route stops reached by now, the travel times along the route never decrease
+        return bisect.bisect_right([tt for _, _, tt in self.route], (now - self.time).total_seconds())
+
+    # SET
+    def collapse(self, idx, offset):
+        # route[idx] becomes the origin, the users picked up until there ride on and the others are done
+        done = []
+        for loc, u, tt in self.route[1:idx + 1]:
+            if loc == u.pu and u not in self.riding:
+                u.pick_up = True
+                u.fix_car(self)
+                self.riding.append(u)
+            else:
+                u.drop_off = True
+                self.riding.remove(u)
+                done.append(u)
+        self.origin = self.route[idx][0]
+        self.offset = offset
+        self.route = [(self.origin, self, offset)] + self.route[idx + 1:]
+        self.here = (self.origin, self)
+        self.next_loc = None
+        return done
 
     # ADD
     def add_route(self, stop):
@@ -42,26 +76,18 @@ class Vehicle:
             self.num_users += user.cap
 
     def move(self, now):
-        for idx, (loc, u, tt) in enumerate(self.route):
-            if self.time + datetime.timedelta(seconds=tt) > now:
-                self.here = (self.route[idx-1][0], self.route[idx-1][1])
-                self.next_loc = (loc, u)
-                break
+        # nothing changes on the way to the origin or after the last stop
+        idx = self.passed(now)
+        if 0 < idx < len(self.route):
+            self.here = (self.route[idx-1][0], self.route[idx-1][1])
+            self.next_loc = (self.route[idx][0], self.route[idx][1])
 
-    def reject_user(self, user, distance, system_time):
-        self.logger.info("%s tried to board vehicle %s, but was rejected because the detour ratio was %s", user, self.id, round(self.detour_ratio[user], 2))
+    def reject_user(self, user, ratio):
+        # the route itself is revised by the detour repair
+        self.logger.info("%s tried to board vehicle %s, but was rejected because the detour ratio was %s", user, self.id, round(ratio, 2))
         self.on_board.remove(user)
         self.detour_ratio.pop(user)
         self.num_users -= user.cap
-        revised = [(loc, u, tt) for loc, u, tt in self.route
-                   if not (u == user and (loc == user.pu or loc == user.do))]
-        for idx, (loc, u, tt) in enumerate(revised):
-            if u == self:
-                continue
-            flag = (loc, u, revised[idx-1][2] + distance[revised[idx-1][0]][revised[idx][0]])
-            revised[idx] = flag
-        self.route = revised
-        self.travel_time = self.route[-1][2]
 
     def is_detour(self, limit):
         if any(detour > limit for detour in self.detour_ratio.values()):
@@ -0,0 +1,136 @@
+# built-in
+import logging
+import numpy as np
+
+# my own
+from dispatch import DispatchModel, DEPOT
+
+SCHEMES = ("grid", "kmeans")
+
+
+# vehicles and users grouped into zones by the coordinates of their nodes, every zone is dispatched on its own
+# "grid" splits the bounding box of the road network into equal cells, "kmeans" clusters the current vehicles and
+# pickups every cycle, starting from the centers of the last one so that the zones move slowly
+class Zoning:
+    def __init__(self, planner, zones, scheme="grid", seed=0):
+        super(Zoning, self).__init__()
+        self.planner = planner
+        self.zones = zones
+        self.scheme = scheme
+        self.rng = np.random.default_rng(seed)
+        self.coords = {}        # node -> longitude, latitude
+        self.centers = None     # k-means centers of the last cycle
+
+        if scheme == "grid":
+            coords = planner.coordinates(planner.node_ids().tolist())
+            self.low = coords.min(axis=0)
+            self.size = np.maximum(coords.max(axis=0) - self.low, 1e-9)
+            self.cols = int(np.ceil(np.sqrt(zones)))
+            self.rows = int(np.ceil(zones / self.cols))
+
+    # GET
+    def coordinates(self, locs):
+        missing = [loc for loc in dict.fromkeys(locs) if loc not in self.coords]
+        if len(missing) > 0:
+            for loc, coord in zip(missing, self.planner.coordinates(missing)):
+                self.coords[loc] = coord
+        return np.array([self.coords[loc] for loc in locs], dtype=float).reshape(-1, 2)
+
+    def assign(self, locs):
+        # zone of every location
+        coords = self.coordinates(locs)
+        if self.scheme == "grid":
+            cells = ((coords - self.low) / self.size * [self.cols, self.rows]).astype(int)
+            cells = np.minimum(cells, [self.cols - 1, self.rows - 1])
+            return np.minimum(cells[:, 1] * self.cols + cells[:, 0], self.zones - 1)
+        distances = ((coords[:, None, :] - self.centers[None, :, :]) ** 2).sum(axis=2)
+        return distances.argmin(axis=1)
+
+    def split(self, vehicles, users, owner):
+        # vehicles by their current location, users with a vehicle follow it and the others their pickup
+        # the users whose dropoff lies in another zone, or in a zone without vehicles, are the boundary requests
+        vehicles = list(vehicles)
+        free = [user for user in users if user not in owner]
+        self.fit([v.here[0] for v in vehicles] + [user.pu for user in free])
+
+        zones = [([], []) for _ in range(self.zones)]
+        zone_of = dict(zip(vehicles, self.assign([v.here[0] for v in vehicles])))
+        for v, zone in zone_of.items():
+            zones[zone][0].append(v)
+        for user in users:
+            if user in owner:
+                zones[zone_of[owner[user]]][1].append(user)
+
+        boundary = []
+        for user, pu, do in zip(free, self.assign([user.pu for user in free]), self.assign([user.do for user in free])):
+            if pu == do and len(zones[pu][0]) > 0:
+                zones[pu][1].append(user)
+            else:
+                boundary.append(user)
+        return [zone for zone in zones if len(zone[0]) > 0], boundary
+
+    # SET
+    def fit(self, locs):
+        if self.scheme != "kmeans" or len(locs) == 0:
+            return
+        coords = self.coordinates(locs)
+        if self.centers is None:
+            self.centers = coords[self.rng.choice(len(coords), self.zones, replace=len(coords) < self.zones)]
+
+        # Lloyd iterations, an empty cluster keeps its center
+        for _ in range(10):
+            labels = ((coords[:, None, :] - self.centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+            centers = self.centers.copy()
+            for k in np.unique(labels):
+                centers[k] = coords[labels == k].mean(axis=0)
+            if np.allclose(centers, self.centers):
+                break
+            self.centers = centers
+
+
+def handlers(logger):
+    # level and format of every handler of the logger, a spawned worker starts without them
+    return [(h.level, h.formatter._fmt if h.formatter is not None else None) for h in logger.handlers]
+
+
+def init_worker(name, level, formats):
+    # initializer of the worker processes, the logger of the jobs logs like the one of the parent process
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    for handler_level, fmt in formats:
+        handler = logging.StreamHandler()
+        handler.setLevel(handler_level)
+        handler.setFormatter(logging.Formatter(fmt))
+        logger.addHandler(handler)
+
+
+def solve_zone(job):
+    # runs in a worker process with its own Gurobi environment
+    # the zone model is built again every cycle: its stops are keyed by the users and vehicles of the job, which are
+    # new copies in every cycle, and a zone is not tied to one worker, so a kept model would be rebuilt anyway
+    # the costs between the locations of the zone are shipped with the job, the routes come back with user IDs
+    stops, vehicles, users, costs, pty, detour, params, logger = job
+
+    def cost(frm, to):
+        if frm == 0 or to == 0:
+            return 0
+        return costs[frm, to]
+
+    model = DispatchModel(logger)
+    model.set_params(**params)
+    model.update(stops, vehicles, users, cost, pty, detour)
+    model.fix(vehicles)
+    status = model.solve()
+    if model.m.SolCount == 0:
+        return status, None, model.m.Runtime
+
+    sol = model.routes()
+    routes = {}
+    for v in vehicles:
+        stations = []
+        station = sol[v][model.origin(v)]
+        while station != DEPOT:
+            stations.append((station[0], station[1].id))
+            station = sol[v][station]
+        routes[v.id] = stations
+    return status, routes, model.m.Runtime